@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark of do_backup.py on synthetic source trees and backup histories.
+
+Times a full run, an incremental run (with --link-dest against the
+previous backup), pruning and link-dir discovery, and writes the results
+as JSON so that versions can be compared on the same machine:
+
+    ./bench/bench_do_backup.py --files 20000 --output before.json
+    (change do_backup.py)
+    ./bench/bench_do_backup.py --files 20000 --compare before.json
+'''
+
+import argparse
+from datetime import datetime, timedelta
+from logging import getLogger, StreamHandler, NullHandler, DEBUG
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import do_backup  # noqa: E402
+
+# Random data files are cut from, instead of calling os.urandom() per file.
+_RANDOM_BLOCK_SIZE = 1024 * 1024
+
+# Times _find_link_dir() and _find_link_dirs() are called per repetition,
+# as one call takes microseconds.
+_LINK_DIR_CALLS = 1000
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files',
+                        action='store',
+                        type=int,
+                        default=10000,
+                        help='Number of files in the source tree')
+    parser.add_argument('--depth',
+                        action='store',
+                        type=int,
+                        default=3,
+                        help='Depth of directories in the source tree')
+    parser.add_argument('--fanout',
+                        action='store',
+                        type=int,
+                        default=8,
+                        help='Subdirectories of each directory')
+    parser.add_argument('--min-size',
+                        action='store',
+                        type=int,
+                        metavar='BYTES',
+                        default=0,
+                        help='Smallest file size')
+    parser.add_argument('--max-size',
+                        action='store',
+                        type=int,
+                        metavar='BYTES',
+                        default=256 * 1024,
+                        help=('Largest file size. Sizes are distributed'
+                              ' log-uniformly, so most files are small'
+                              ' as in real trees'))
+    parser.add_argument('--change-rate',
+                        action='store',
+                        type=float,
+                        metavar='RATIO',
+                        default=0.05,
+                        help=('Ratio of files rewritten (and also added)'
+                              ' before the incremental run'))
+    parser.add_argument('--history',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        default=60,
+                        help=('Number of existing backups pruning and'
+                              ' link-dir discovery run against'))
+    parser.add_argument('--layout',
+                        choices=['daily', 'hourly'],
+                        default='daily',
+                        help='One backup per day or per hour')
+    parser.add_argument('--removal-threshold',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        default=31,
+                        help=('Days (hours with --layout=hourly) of backups'
+                              ' pruning keeps'))
+    parser.add_argument('--prune-jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        default=do_backup._DEFAULT_PRUNE_JOBS,
+                        help='Same as --prune-jobs of do_backup.py')
+    parser.add_argument('--engine',
+                        choices=['rsync', 'native'],
+                        default='rsync',
+                        help='Same as --engine of do_backup.py')
+    parser.add_argument('-c', '--rsync-command',
+                        default='rsync',
+                        help='Same as --rsync-command of do_backup.py')
+    parser.add_argument('--repeat',
+                        action='store',
+                        type=int,
+                        default=3,
+                        help='Repetitions of each benchmark')
+    parser.add_argument('--seed',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Seed of the generated trees')
+    parser.add_argument('--work-dir',
+                        action='store',
+                        type=str,
+                        metavar='DIR',
+                        help=('Directory trees are generated in, which'
+                              ' should be on the disk being measured'
+                              ' (default: a temporary directory)'))
+    parser.add_argument('--keep',
+                        action='store_true',
+                        help='Leave generated trees in --work-dir')
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        type=str,
+                        metavar='PATH',
+                        help='Where JSON results go (default: stdout)')
+    parser.add_argument('--compare',
+                        action='store',
+                        type=str,
+                        metavar='PATH',
+                        help=('JSON results of an earlier run, to which'
+                              ' the ratio of each benchmark is printed'))
+    parser.add_argument('-d', '--debug',
+                        action='store_true',
+                        help='Show log of do_backup.py')
+    args = parser.parse_args(argv)
+    for name in ['files', 'depth', 'fanout', 'history', 'repeat',
+                 'prune_jobs']:
+        if getattr(args, name) < 1:
+            parser.error('--{} must be 1 or more'
+                         .format(name.replace('_', '-')))
+    if not 0 <= args.min_size <= args.max_size:
+        parser.error('--min-size must be between 0 and --max-size')
+    if not 0 <= args.change_rate <= 1:
+        parser.error('--change-rate must be between 0 and 1')
+    return args
+
+
+def _get_random_size(rng, min_size, max_size):
+    """\
+    Log-uniform between min_size and max_size.
+    """
+    low = max(min_size, 1)
+    size = int(round(low * (max_size / low) ** rng.random()))
+    if min_size == 0 and rng.random() < 0.05:
+        return 0
+    return min(max(size, min_size), max_size)
+
+
+def _write_random_file(path, size, rng, block):
+    with open(path, 'wb') as f:
+        while size > 0:
+            count = min(size, len(block))
+            offset = rng.randrange(len(block) - count + 1)
+            f.write(block[offset:offset + count])
+            size -= count
+
+
+def _get_dir_paths(top, depth, fanout):
+    paths = [top]
+    level = [top]
+    for _ in range(depth - 1):
+        level = [os.path.join(x, 'd{:03d}'.format(i))
+                 for x in level for i in range(fanout)]
+        paths.extend(level)
+    return paths
+
+
+def _generate_tree(top, args, rng, block):
+    """\
+    Creates args.files files spread over directories args.depth deep.
+    Returns the list of file paths and the total size.
+    """
+    dir_paths = _get_dir_paths(top, args.depth, args.fanout)
+    for path in dir_paths:
+        os.makedirs(path)
+    file_paths = []
+    total_size = 0
+    for i in range(args.files):
+        path = os.path.join(rng.choice(dir_paths), 'f{:07d}'.format(i))
+        size = _get_random_size(rng, args.min_size, args.max_size)
+        _write_random_file(path, size, rng, block)
+        file_paths.append(path)
+        total_size += size
+    return file_paths, total_size
+
+
+def _change_tree(file_paths, args, rng, block):
+    """\
+    Rewrites and adds args.change_rate of files.
+    Returns the number of bytes written.
+    """
+    count = int(len(file_paths) * args.change_rate)
+    written = 0
+    for path in rng.sample(file_paths, count):
+        size = _get_random_size(rng, args.min_size, args.max_size)
+        _write_random_file(path, size, rng, block)
+        written += size
+    for i in range(count):
+        path = '{}.new{}'.format(rng.choice(file_paths), i)
+        size = _get_random_size(rng, args.min_size, args.max_size)
+        _write_random_file(path, size, rng, block)
+        written += size
+    return written
+
+
+def _link_tree(src, dest):
+    """\
+    Same as "cp -al src dest", which is how rsync --link-dest leaves
+    unchanged files.
+    """
+    for dir_path, dir_names, file_names in os.walk(src):
+        dest_dir = os.path.join(dest, os.path.relpath(dir_path, src))
+        os.makedirs(dest_dir)
+        for name in file_names:
+            os.link(os.path.join(dir_path, name),
+                    os.path.join(dest_dir, name))
+
+
+def _get_layout(args):
+    if args.layout == 'hourly':
+        return do_backup._DEFAULT_DIR_FORMAT_HOURLY, timedelta(hours=1)
+    return do_backup._DEFAULT_DIR_FORMAT, timedelta(days=1)
+
+
+def _make_history(base_dir, src, today, args):
+    """\
+    Creates args.history backups of src before today in base_dir.
+    """
+    dir_format, step = _get_layout(args)
+    os.makedirs(base_dir)
+    for i in range(1, args.history + 1):
+        _link_tree(src, do_backup._get_backup_dir_path(
+            today - step * i, base_dir, dir_format))
+
+
+def _get_backup_args(args, src, base_dir):
+    argv = [src, '--base-dir', base_dir, '--engine', args.engine,
+            '--rsync-command', args.rsync_command, '--removal-threshold', '0']
+    if args.layout == 'hourly':
+        argv.append('--hourly')
+    return do_backup._parse_args(argv)
+
+
+def _run_backup(args, src, base_dir, logger):
+    """\
+    Runs do_backup.py once and returns (elapsed, {phase: seconds}).
+    """
+    metrics = do_backup.RunMetrics()
+    backup_args = _get_backup_args(args, src, base_dir)
+    start_time = time.time()
+    successful = do_backup._main_inter(backup_args, logger, metrics)
+    elapsed = time.time() - start_time
+    if not successful:
+        raise RuntimeError('Backup of "{}" failed'.format(src))
+    return elapsed, dict((name, value) for (_, name), value
+                         in metrics.phases.items())
+
+
+def _summarize(samples, phases=None):
+    samples = sorted(samples)
+    result = {'seconds': samples,
+              'min': samples[0],
+              'median': samples[len(samples) // 2]}
+    if phases:
+        result['phases'] = phases
+    return result
+
+
+def _bench_runs(args, work_dir, src, file_paths, rng, block, logger):
+    """\
+    Full run into an empty base-dir, then an incremental run after
+    changing the source, with the full backup as the previous one.
+    """
+    dir_format, step = _get_layout(args)
+    full, incremental = [], []
+    full_phases, incremental_phases = {}, {}
+    for i in range(args.repeat):
+        base_dir = os.path.join(work_dir, 'runs{}'.format(i))
+        elapsed, full_phases = _run_backup(args, src, base_dir, logger)
+        full.append(elapsed)
+        # Make the full backup the previous one, then change the source.
+        today = datetime.today()
+        os.rename(do_backup._get_backup_dir_path(today, base_dir,
+                                                 dir_format),
+                  do_backup._get_backup_dir_path(today - step, base_dir,
+                                                 dir_format))
+        _change_tree(file_paths, args, rng, block)
+        elapsed, incremental_phases = _run_backup(args, src, base_dir,
+                                                  logger)
+        incremental.append(elapsed)
+        shutil.rmtree(base_dir)
+    return {'full_run': _summarize(full, full_phases),
+            'incremental_run': _summarize(incremental, incremental_phases)}
+
+
+def _bench_prune(args, work_dir, src, logger):
+    dir_format, _ = _get_layout(args)
+    catalog_samples, prune_samples = [], []
+    num_removed = 0
+    for i in range(args.repeat):
+        base_dir = os.path.join(work_dir, 'prune{}'.format(i))
+        today = datetime.today()
+        _make_history(base_dir, src, today, args)
+        start_time = time.time()
+        catalog = do_backup._build_snapshot_catalog(base_dir, dir_format,
+                                                    logger=logger)
+        catalog_samples.append(time.time() - start_time)
+        start_time = time.time()
+        num_removed = do_backup._remove_old_backups_if_exist(
+            today, catalog, args.removal_threshold,
+            args.layout == 'hourly', jobs=args.prune_jobs, logger=logger)
+        prune_samples.append(time.time() - start_time)
+        shutil.rmtree(base_dir)
+    result = _summarize(prune_samples)
+    result['removed_backups'] = num_removed
+    return {'build_catalog': _summarize(catalog_samples),
+            'prune': result}
+
+
+def _bench_link_dirs(args, work_dir, logger):
+    """\
+    Times link-dir discovery against args.history empty backups,
+    since it only looks at their names.
+    """
+    dir_format, step = _get_layout(args)
+    base_dir = os.path.join(work_dir, 'link_dirs')
+    today = datetime.today()
+    os.makedirs(base_dir)
+    for i in range(1, args.history + 1):
+        os.mkdir(do_backup._get_backup_dir_path(today - step * i, base_dir,
+                                                dir_format))
+    catalog = do_backup._build_snapshot_catalog(base_dir, dir_format,
+                                                logger=logger)
+    single, multiple = [], []
+    for _ in range(args.repeat):
+        start_time = time.time()
+        for _ in range(_LINK_DIR_CALLS):
+            do_backup._find_link_dir(today, catalog, logger=logger)
+        single.append((time.time() - start_time) / _LINK_DIR_CALLS)
+        start_time = time.time()
+        for _ in range(_LINK_DIR_CALLS):
+            do_backup._find_link_dirs(today, catalog, newest=3, weekly=4,
+                                      logger=logger)
+        multiple.append((time.time() - start_time) / _LINK_DIR_CALLS)
+    shutil.rmtree(base_dir)
+    return {'find_link_dir': _summarize(single),
+            'find_link_dirs': _summarize(multiple)}
+
+
+def _compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print('{:<20} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline',
+                                              'current', 'ratio'),
+          file=sys.stderr)
+    for name, result in sorted(results['results'].items()):
+        old = baseline.get('results', {}).get(name)
+        if not old or not old['median']:
+            continue
+        print('{:<20} {:>12.6f} {:>12.6f} {:>8.3f}'
+              .format(name, old['median'], result['median'],
+                      result['median'] / old['median']),
+              file=sys.stderr)
+
+
+def main():
+    args = _parse_args()
+    logger = getLogger('bench_do_backup')
+    if args.debug:
+        logger.addHandler(StreamHandler())
+        logger.setLevel(DEBUG)
+    else:
+        logger.addHandler(NullHandler())
+    if args.engine == 'rsync' and not shutil.which(args.rsync_command):
+        print('{} is not found (use --engine=native or --rsync-command)'
+              .format(args.rsync_command), file=sys.stderr)
+        sys.exit(1)
+    work_dir = tempfile.mkdtemp(prefix='bench_do_backup.',
+                                dir=args.work_dir)
+    rng = random.Random(args.seed)
+    block = rng.getrandbits(8 * _RANDOM_BLOCK_SIZE).to_bytes(
+        _RANDOM_BLOCK_SIZE, 'little')
+    try:
+        src = os.path.join(work_dir, 'src')
+        file_paths, total_size = _generate_tree(src, args, rng, block)
+        results = {}
+        results.update(_bench_prune(args, work_dir, src, logger))
+        results.update(_bench_link_dirs(args, work_dir, logger))
+        results.update(_bench_runs(args, work_dir, src, file_paths, rng,
+                                   block, logger))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+    output = {'version': do_backup.Version,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'time': datetime.now().isoformat(),
+              'parameters': dict((k, v) for k, v in vars(args).items()
+                                 if k not in ['output', 'compare', 'debug',
+                                              'keep', 'work_dir']),
+              'source': {'files': len(file_paths), 'bytes': total_size},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+    if args.compare:
+        _compare(output, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,53 @@
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
 
 '''
 A script doing periodical backup.
 '''
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
-from __future__ import unicode_literals
-
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import fcntl
+from collections import namedtuple
 from datetime import datetime, timedelta
+import dateutil.parser
 import dateutil.relativedelta
 from logging import getLogger, StreamHandler, Formatter, NullHandler
+from logging import LoggerAdapter
 from logging import DEBUG, WARN
 from logging.handlers import RotatingFileHandler
+import gzip
+import hashlib
+import json
+import multiprocessing
 import os
 import os.path
 import platform
+import re
+import selectors
 import subprocess
 import shlex
 import shutil
+import signal
 import stat
 import sys
+import tarfile
+import tempfile
 import threading
 import time
 import traceback
+import zlib
 
-if sys.version_info[0] == 3:
-    unicode = str
+if sys.version_info < (3, 6):
+    sys.exit('do_backup.py requires Python 3.6 or later')
 
 Version = '3.7.0'
 
+# With --incremental, a full run verifying the whole SRC is done
+# after this number of incremental runs.
 _FULL_BACKUP_INTERVAL = 30
 _DEFAULT_DIR = '/mnt/disk0/backup'
 _DEFAULT_DIR_FORMAT = '{hostname}-%Y%m%d'
@@ -44,8 +59,136 @@ _DEFAULT_DIR_FORMAT_HOURLY = '{hostname}-%Y%m%d-%H'
 # If a user changes the directory name format,
 # this script will just fail to detect/delete old backups.
 _DEFAULT_REMOVAL_THRESHOLD = 31
-# This script looks for old directories until this index.
-_DEFAULT_REMOVAL_SEARCH_THRESHOLD = 100
+
+# Each backup is built in "<name>.inprogress" and renamed to <name> only
+# after rsync succeeds, so that an interrupted one never looks complete.
+# rsync keeps partially transferred files in _PARTIAL_DIR_NAME (relative
+# to the directory of each file) so that the next run resumes them.
+_INPROGRESS_SUFFIX = '.inprogress'
+_PARTIAL_DIR_NAME = '.rsync-partial'
+
+# With --prune-for-space, bytes written by recent runs are kept in this
+# file under base_dir, and the next run is expected to write up to
+# _SPACE_PREDICTION_FACTOR times the largest of them.
+_SPACE_HISTORY_NAME = '.do_backup_space.json'
+_SPACE_HISTORY_LENGTH = 14
+_SPACE_PREDICTION_FACTOR = 1.2
+
+# Old backups are renamed into this directory under base_dir first,
+# then removed while (or after) rsync is running.
+_TRASH_DIR_NAME = '.do_backup_trash'
+_DEFAULT_PRUNE_JOBS = 4
+
+# rsync output is read in chunks of this size.
+_PUMP_CHUNK_SIZE = 256 * 1024
+# Lines of rsync's stderr logged when rsync fails.
+_STDERR_TAIL_LINES = 20
+
+# Default number of threads copying files in the native engine.
+_DEFAULT_NATIVE_JOBS = 4
+# Buffer size used when the kernel cannot copy files by itself.
+_NATIVE_COPY_CHUNK_SIZE = 1024 * 1024
+# Copies queued per thread of the native engine. The walk waits for the
+# oldest ones beyond this, so memory does not grow with the tree.
+_NATIVE_PENDING_PER_JOB = 64
+# ioctl cloning a whole file on btrfs, XFS and such (FICLONE in linux/fs.h).
+_FICLONE = 0x40049409
+# Unit --reflink compares and rewrites. A multiple of filesystem block
+# sizes, so that unchanged blocks stay shared with the previous backup.
+_REFLINK_BLOCK_SIZE = 64 * 1024
+
+# Suffix of the change manifest written next to each backup directory.
+_CHANGE_MANIFEST_SUFFIX = '.changes.gz'
+# Output format of rsync while --change-manifest is in effect.
+# Same as the default of -i except that the file size is included.
+_CHANGE_OUT_FORMAT = '%i %l %n'
+
+# Upper limit of --link-dest options rsync accepts.
+_MAX_LINK_DEST = 20
+_DEFAULT_LINK_DEST_COUNT = 1
+_DEFAULT_LINK_DEST_WEEKLY = 0
+
+# Timings of each top-level entry recorded by sharded runs.
+_SHARD_STATE_NAME = '.do_backup_shards.json'
+
+# Per-SRC manifest of the previous run used by --incremental.
+_SOURCE_MANIFEST_PREFIX = '.do_backup_manifest.'
+_SOURCE_MANIFEST_SUFFIX = '.json.gz'
+_SOURCE_MANIFEST_VERSION = 1
+
+# Held while a run uses base_dir.
+_LOCK_FILE_NAME = '.do_backup.lock'
+# Interval (sec) at which --daemon checks whether jobs are due.
+_DAEMON_TICK = 30
+# See ionice(1)
+_IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# --adaptive-throttle: the transfer rate is reconsidered at this
+# interval (sec), reduced by _THROTTLE_DECREASE when the disk or CPUs are
+# busy and raised by _THROTTLE_INCREASE otherwise.
+_THROTTLE_INTERVAL = 5
+_THROTTLE_DECREASE = 0.7
+_THROTTLE_INCREASE = 1.2
+_DEFAULT_MAX_DISK_LATENCY = 50
+_DEFAULT_MAX_LOAD = 1.0
+_DEFAULT_MIN_BWLIMIT = 1024
+# rsync is restarted with a new --bwlimit only when the rate changed by
+# this ratio, and not more often than _THROTTLE_RESTART_INTERVAL (sec).
+_THROTTLE_RESTART_RATIO = 0.25
+_THROTTLE_RESTART_INTERVAL = 120
+
+# With --ssh-control-dir, master ssh connections are kept this long (sec)
+# after the last use.
+_DEFAULT_SSH_CONTROL_PERSIST = 600
+_SSH_COMPRESSIONS = ['rsync', 'ssh', 'none']
+# Data sent to each host for each cipher by --ssh-benchmark
+_SSH_BENCHMARK_SIZE = 16 * 1024 * 1024
+# Ciphers tried by --ssh-benchmark unless --ssh-cipher is given
+_SSH_BENCHMARK_CIPHERS = ['aes128-gcm@openssh.com',
+                          'chacha20-poly1305@openssh.com',
+                          'aes128-ctr']
+
+# Index of file hashes kept by --dedup in base_dir.
+_DEDUP_INDEX_NAME = '.do_backup_dedup.json.gz'
+_DEDUP_INDEX_VERSION = 2
+# Smaller files are not worth hashing for --dedup.
+_DEFAULT_DEDUP_MIN_SIZE = 64 * 1024
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Checksum database of --verify, kept in base_dir by default.
+_VERIFY_DB_NAME = '.do_backup_verify.json.gz'
+_VERIFY_DB_VERSION = 1
+# Files are verified again after this number of days.
+_DEFAULT_VERIFY_INTERVAL = 30
+
+# Inodes of each backup cached by --report, in this directory of base_dir.
+_REPORT_CACHE_DIR_NAME = '.do_backup_report'
+_REPORT_CACHE_SUFFIX = '.json.gz'
+_REPORT_CACHE_VERSION = 2
+_DEFAULT_REPORT_JOBS = 8
+
+# --archive-after moves old backups into gzipped tar files in this
+# directory of base_dir, each with an index of its members.
+# Data is compressed in independent gzip members of _ARCHIVE_CHUNK_SIZE
+# bytes, so that compression runs in parallel and extraction can start
+# in the middle.
+_ARCHIVE_DIR_NAME = '.do_backup_archive'
+_ARCHIVE_SUFFIX = '.tar.gz'
+_ARCHIVE_INDEX_SUFFIX = '.index.json.gz'
+_ARCHIVE_INDEX_VERSION = 1
+_ARCHIVE_CHUNK_SIZE = 4 * 1024 * 1024
+_DEFAULT_ARCHIVE_LEVEL = 6
+# Types of archive members (tar typeflag) as --restore shows them.
+_TAR_FILE_KINDS = {'0': 'file', '1': 'file', '2': 'symlink', '5': 'dir'}
+
+# Threads copying files back from a backup with --restore.
+_DEFAULT_RESTORE_JOBS = 8
+
+# --prune-for-space never leaves fewer backups (including archived ones).
+_DEFAULT_MIN_BACKUPS = 7
+
+# Bumped whenever the layout of the catalog index file changes.
+_CATALOG_INDEX_VERSION = 1
 
 _DEFAULT_INCLUDED_DIR = []
 
@@ -65,12 +208,31 @@ class AppException(Exception):
     pass
 
 
-def _parse_args():
+class BaseDirLocked(AppException):
+    pass
+
+
+# One backup directory found under base_dir.
+# "timestamp" is the datetime reverse-parsed from the directory name,
+# so its granularity is the one of dir-format (a day or an hour).
+Snapshot = namedtuple('Snapshot', ['name', 'path', 'timestamp'])
+
+# A unit of backup. "name" is None when all SRC go to base_dir at once.
+Job = namedtuple('Job', ['name', 'src_list', 'base_dir'])
+JobResult = namedtuple('JobResult', ['name', 'successful', 'elapsed'])
+
+# A path as found in one backup, listed by --restore.
+# "inode" is (dev, ino), or None when the backup is archived.
+FileVersion = namedtuple('FileVersion', ['snapshot', 'inode', 'mtime', 'size',
+                                         'kind', 'archived'])
+
+
+def _parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description=('Do backup to (another) local disk.'))
     parser.add_argument('src', metavar='SRC',
                         type=str,
-                        nargs='+')
+                        nargs='*')
     parser.add_argument('-b', '--base-dir',
                         action='store',
                         type=str,
@@ -86,11 +248,89 @@ def _parse_args():
     parser.add_argument('-i', '--identity-file',
                         type=str,
                         help='Let ssh use this private key.')
+    parser.add_argument('--rsh',
+                        action='store',
+                        type=str,
+                        metavar='COMMAND',
+                        help='Remote shell rsync uses (default: ssh)',
+                        default='ssh')
+    parser.add_argument('--ssh-control-dir',
+                        action='store',
+                        type=str,
+                        metavar='DIR',
+                        help=('Share one ssh connection per host among'
+                              ' rsync runs through control sockets in DIR,'
+                              ' keeping it open for --ssh-control-persist'
+                              ' seconds after the last use'))
+    parser.add_argument('--ssh-control-persist',
+                        action='store',
+                        type=int,
+                        metavar='SEC',
+                        help=('See --ssh-control-dir (default: {})'
+                              .format(_DEFAULT_SSH_CONTROL_PERSIST)),
+                        default=_DEFAULT_SSH_CONTROL_PERSIST)
+    parser.add_argument('--ssh-cipher',
+                        action='append',
+                        type=str,
+                        metavar='[HOST=]CIPHER',
+                        help=('Cipher of ssh connections (to HOST only when'
+                              ' prefixed). Can be specified multiple times.'))
+    parser.add_argument('--ssh-compression',
+                        action='append',
+                        type=str,
+                        metavar='[HOST=]{rsync,ssh,none}',
+                        help=('Who compresses data from remote SRC:'
+                              ' rsync (-z, default), ssh (-C) or none.'
+                              ' Can be specified multiple times.'))
+    parser.add_argument('--ssh-benchmark',
+                        action='store_true',
+                        help=('Measure the handshake time and throughput'
+                              ' to each remote SRC with each cipher and'
+                              ' compression, then exit without backup'))
     parser.add_argument('-f', '--force-full-backup',
                         action='store_true',
                         help=('Do not use --link-dest even when precedeng'
                               ' backup directory exists, consuming much more'
                               ' disk possibly.'))
+    parser.add_argument('--link-dest-count',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Give rsync the newest N backups with'
+                              ' --link-dest (default: {})'
+                              .format(_DEFAULT_LINK_DEST_COUNT)),
+                        default=_DEFAULT_LINK_DEST_COUNT)
+    parser.add_argument('--link-dest-weekly',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('In addition to --link-dest-count, give'
+                              ' rsync the newest backup of each of N'
+                              ' preceding weeks with --link-dest'
+                              ' (default: {})'
+                              .format(_DEFAULT_LINK_DEST_WEEKLY)),
+                        default=_DEFAULT_LINK_DEST_WEEKLY)
+    parser.add_argument('--report-link-savings',
+                        action='store_true',
+                        help=('After backup, report how much was hardlinked'
+                              ' thanks to --link-dest directories other than'
+                              ' the newest one. This walks the new backup.'))
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help=('Compare local SRC with the manifest recorded'
+                              ' by the previous run, then make the backup'
+                              ' by hardlinking the previous backup and'
+                              ' transferring only new and changed files.'
+                              ' Directories whose mtime did not change'
+                              ' are not listed again.'))
+    parser.add_argument('--full-walk-interval',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('With --incremental, do a full run after N'
+                              ' incremental runs (default: {})'
+                              .format(_FULL_BACKUP_INTERVAL)),
+                        default=_FULL_BACKUP_INTERVAL)
     parser.add_argument('-r', '--removal-threshold',
                         action='store',
                         type=int,
@@ -103,6 +343,231 @@ def _parse_args():
                                ' 0 or less means no removal.')
                               .format(example=_DEFAULT_REMOVAL_THRESHOLD)),
                         default=_DEFAULT_REMOVAL_THRESHOLD)
+    for tier, unit in [('hourly', 'hours'), ('daily', 'days'),
+                       ('weekly', 'weeks'), ('monthly', 'months')]:
+        if tier == 'hourly':
+            help_text = 'Keep all backups of the last N hours'
+        else:
+            help_text = ('Keep the newest backup of each of the last N {}'
+                         .format(unit))
+        parser.add_argument('--keep-{}'.format(tier),
+                            action='store',
+                            type=int,
+                            metavar='N',
+                            help=help_text + ('. Any of --keep-* options'
+                                              ' replaces --removal-threshold'
+                                              ' with these tiers.'),
+                            default=0)
+    parser.add_argument('--prune-for-space',
+                        action='store_true',
+                        help=('Before transfer, remove the oldest backups'
+                              ' (archived ones first) until base-dir has'
+                              ' space for what this run is expected to'
+                              ' write (estimated from recent runs) plus'
+                              ' --min-free-space, keeping --min-backups'))
+    parser.add_argument('--min-free-space',
+                        action='store',
+                        type=str,
+                        metavar='SIZE',
+                        help=('Bytes (with K, M, G or T) to keep free with'
+                              ' --prune-for-space (default: 0)'),
+                        default='0')
+    parser.add_argument('--min-backups',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('--prune-for-space does not remove backups'
+                              ' (archived ones included) below N. When'
+                              ' space is still short, the run fails'
+                              ' without transfer. (default: {})'
+                              .format(_DEFAULT_MIN_BACKUPS)),
+                        default=_DEFAULT_MIN_BACKUPS)
+    parser.add_argument('--archive-after',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Move backups older than N days (or hours'
+                              ' with --hourly) into compressed tar archives'
+                              ' in --archive-dir, out of base-dir.'
+                              ' Done after backup or with --prune-only.'
+                              ' Each archive holds all the data of its'
+                              ' backup, including files shared by hardlinks'
+                              ' with other backups, so it costs as much as'
+                              ' a compressed full copy. Archives are removed'
+                              ' by --removal-threshold or --keep-* as'
+                              ' backups are.'))
+    parser.add_argument('--archive-dir',
+                        action='store',
+                        type=str,
+                        metavar='DIR',
+                        help=('Directory storing archives (default: "{}"'
+                              ' in base-dir)'.format(_ARCHIVE_DIR_NAME)))
+    parser.add_argument('--archive-jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Number of threads compressing archives'
+                              ' (default: number of CPUs)'))
+    parser.add_argument('--archive-level',
+                        action='store',
+                        type=int,
+                        choices=range(1, 10),
+                        metavar='1-9',
+                        help=('gzip compression level of archives'
+                              ' (default: {})'
+                              .format(_DEFAULT_ARCHIVE_LEVEL)),
+                        default=_DEFAULT_ARCHIVE_LEVEL)
+    parser.add_argument('--catalog-index',
+                        action='store',
+                        type=str,
+                        help=('Cache the list of existing backups in this'
+                              ' file so that directory names do not need to'
+                              ' be parsed again while base-dir is unchanged.'
+                              ' Should be placed outside base-dir, since'
+                              ' writing it inside base-dir invalidates it.'))
+    parser.add_argument('-j', '--jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Back up each SRC as a separate job into'
+                              ' its own directory under base-dir, running'
+                              ' at most N jobs at once.'
+                              ' Without this option, all SRC are backed up'
+                              ' by a single rsync command.'))
+    parser.add_argument('--shards',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Split a local SRC by its top-level entries'
+                              ' into N groups and run one rsync for each'
+                              ' group in parallel. Groups are rebalanced'
+                              ' using timings of the previous run.'
+                              ' Note that -H (of --src-type=local) sees'
+                              ' one group at a time, so a file hardlinked'
+                              ' from entries in different groups is'
+                              ' stored once per group.'))
+    parser.add_argument('--prune-jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Number of threads removing old backups'
+                              ' (default: {})'.format(_DEFAULT_PRUNE_JOBS)),
+                        default=_DEFAULT_PRUNE_JOBS)
+    parser.add_argument('--prune-only',
+                        action='store_true',
+                        help=('Only remove old backups (including ones'
+                              ' left by --defer-prune) without doing'
+                              ' backup. SRC is not needed.'))
+    parser.add_argument('--defer-prune',
+                        action='store_true',
+                        help=('Just move old backups aside and leave'
+                              ' actual removal to a later --prune-only run,'
+                              ' instead of removing them while rsync'
+                              ' is running.'))
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        help=('After backup, hardlink identical files'
+                              ' across all backups even when their paths'
+                              ' differ (e.g. renamed files). Hashes are'
+                              ' cached, so only new files are hashed.'))
+    parser.add_argument('--dedup-jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Number of processes hashing files for'
+                              ' --dedup (default: number of CPUs)'))
+    parser.add_argument('--dedup-min-size',
+                        action='store',
+                        type=int,
+                        metavar='BYTES',
+                        help=('Files smaller than this are ignored by'
+                              ' --dedup (default: {})'
+                              .format(_DEFAULT_DEDUP_MIN_SIZE)),
+                        default=_DEFAULT_DEDUP_MIN_SIZE)
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help=('Only check that files in existing backups'
+                              ' still have the content they had when first'
+                              ' verified, without doing backup.'
+                              ' Each hardlinked file is read once, and only'
+                              ' new files and ones verified more than'
+                              ' --verify-interval days ago are read.'
+                              ' SRC is not needed.'))
+    parser.add_argument('--verify-db',
+                        action='store',
+                        type=str,
+                        metavar='PATH',
+                        help=('Checksum database of --verify'
+                              ' (default: "{}" in base-dir)'
+                              .format(_VERIFY_DB_NAME)))
+    parser.add_argument('--verify-interval',
+                        action='store',
+                        type=float,
+                        metavar='DAYS',
+                        help=('See --verify (default: {})'
+                              .format(_DEFAULT_VERIFY_INTERVAL)),
+                        default=_DEFAULT_VERIFY_INTERVAL)
+    parser.add_argument('--verify-jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Number of processes reading files for'
+                              ' --verify (default: number of CPUs)'))
+    parser.add_argument('--report',
+                        action='store_true',
+                        help=('Only report disk usage of each existing'
+                              ' backup, split into bytes no other backup'
+                              ' shares (freed by removing it) and shared'
+                              ' ones, without doing backup. Results of'
+                              ' each backup are cached, so only new ones'
+                              ' are scanned. SRC is not needed.'))
+    parser.add_argument('--report-jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Number of threads listing directories for'
+                              ' --report (default: {})'
+                              .format(_DEFAULT_REPORT_JOBS)),
+                        default=_DEFAULT_REPORT_JOBS)
+    parser.add_argument('--restore',
+                        action='store',
+                        type=str,
+                        metavar='PATH',
+                        help=('Only list distinct versions of PATH'
+                              ' (relative to a backup, e.g. "etc/hosts")'
+                              ' found in existing and archived backups,'
+                              ' or restore one of them with --restore-to,'
+                              ' without doing backup. SRC is not needed.'))
+    parser.add_argument('--restore-to',
+                        action='store',
+                        type=str,
+                        metavar='DIR',
+                        help=('Directory --restore writes PATH into,'
+                              ' keeping hardlinks, permissions, ACLs and'
+                              ' xattrs'))
+    parser.add_argument('--restore-from',
+                        action='store',
+                        type=str,
+                        metavar='NAME',
+                        help=('Name of the backup --restore-to copies from'
+                              ' (default: the newest one having PATH)'))
+    parser.add_argument('--restore-before',
+                        action='store',
+                        type=str,
+                        metavar='DATETIME',
+                        help=('Make --restore-to copy from the newest'
+                              ' backup taken before DATETIME'
+                              ' (e.g. "2026-10-13 09:00", in local time'
+                              ' unless an offset such as "+09:00" is'
+                              ' given)'))
+    parser.add_argument('--restore-jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Number of threads copying files for'
+                              ' --restore-to (default: {})'
+                              .format(_DEFAULT_RESTORE_JOBS)),
+                        default=_DEFAULT_RESTORE_JOBS)
     parser.add_argument('--hourly',
                         action='store_true',
                         help=('Relevant operations will be applied'
@@ -136,6 +601,30 @@ def _parse_args():
                         help='Include rsync output to DEBUG log')
     parser.add_argument('--verbose-rsync', action='store_true',
                         help='Set --verbose option to rsync')
+    parser.add_argument('--rsync-log-dir',
+                        action='store',
+                        type=str,
+                        metavar='DIR',
+                        help=('Store raw output of each rsync run into a'
+                              ' gzipped file in DIR. Unlike'
+                              ' --log-rsync-output, the output is'
+                              ' neither decoded nor sent to loggers.'))
+    parser.add_argument('--metrics-file',
+                        action='store',
+                        type=str,
+                        metavar='PATH',
+                        help=('Write timings of each phase, rsync --stats'
+                              ' figures and sizes of the backup catalog'
+                              ' into PATH, in the Prometheus text format'
+                              ' when PATH ends with ".prom" or in JSON'
+                              ' otherwise.'))
+    parser.add_argument('--change-manifest', action='store_true',
+                        help=('Count new/changed/deleted files from rsync'
+                              ' output and store them into a gzipped'
+                              ' manifest next to the backup directory'
+                              ' (e.g. "{}")'
+                              .format('host-20150101'
+                                      + _CHANGE_MANIFEST_SUFFIX)))
     parser.add_argument('--verbose-log-file',
                         action='store',
                         type=str,
@@ -148,15 +637,209 @@ def _parse_args():
                         type=str,
                         default='local',
                         help='Can Specify "local", "ssh", or "rough"')
+    parser.add_argument('--engine',
+                        choices=['rsync', 'native'],
+                        default='rsync',
+                        help=('Program doing actual copies. "native" copies'
+                              ' files within this script without rsync and'
+                              ' is available only with "local" src-type.'))
+    parser.add_argument('--native-jobs',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help=('Number of threads copying files with'
+                              ' --engine=native (default: {})'
+                              .format(_DEFAULT_NATIVE_JOBS)),
+                        default=_DEFAULT_NATIVE_JOBS)
+    parser.add_argument('--reflink',
+                        action='store_true',
+                        help=('With --engine=native, a file changed since'
+                              ' the previous backup is cloned from it and'
+                              ' only blocks that differ are written, when'
+                              ' BASE_DIR supports reflinks (btrfs, XFS).'
+                              ' Otherwise it is copied as usual.'))
+    parser.add_argument('--daemon',
+                        action='store',
+                        type=str,
+                        metavar='JOB_TABLE',
+                        help=('Keep running and do backups listed in'
+                              ' JOB_TABLE on schedule, instead of doing'
+                              ' a backup once. Each line of JOB_TABLE is'
+                              ' "NAME hourly[:MM]|daily[:HH:MM] ARGS..."'
+                              ' where ARGS are arguments of this script.'
+                              ' --nice and --ionice-* are given here for'
+                              ' all jobs, not in JOB_TABLE.'))
+    parser.add_argument('--nice',
+                        action='store',
+                        type=int,
+                        metavar='N',
+                        help='Increment niceness of this script and rsync')
+    parser.add_argument('--ionice-class',
+                        choices=sorted(_IONICE_CLASSES),
+                        help='I/O scheduling class of this script and rsync')
+    parser.add_argument('--ionice-level',
+                        action='store',
+                        type=int,
+                        choices=range(8),
+                        metavar='0-7',
+                        help=('I/O priority within --ionice-class'
+                              ' (0 is the highest)'))
     parser.add_argument('-c', '--rsync-command', default='rsync',
                         help='Exact command name to use')
     parser.add_argument('--rsync-bwlimit', metavar='KBPS',
                         help='Value for rsync\'s --bwlimit option')
+    parser.add_argument('--adaptive-throttle',
+                        action='store_true',
+                        help=('Lower the transfer rate while the disk of'
+                              ' BASE_DIR or CPUs are busy, and raise it'
+                              ' (up to --rsync-bwlimit) otherwise'))
+    parser.add_argument('--max-disk-latency',
+                        action='store',
+                        type=float,
+                        metavar='MS',
+                        help=('Average I/O latency of the disk of BASE_DIR'
+                              ' regarded as busy with --adaptive-throttle'
+                              ' (default: {})'
+                              .format(_DEFAULT_MAX_DISK_LATENCY)),
+                        default=_DEFAULT_MAX_DISK_LATENCY)
+    parser.add_argument('--max-load',
+                        action='store',
+                        type=float,
+                        metavar='LOAD',
+                        help=('Load average per CPU regarded as busy with'
+                              ' --adaptive-throttle (default: {})'
+                              .format(_DEFAULT_MAX_LOAD)),
+                        default=_DEFAULT_MAX_LOAD)
+    parser.add_argument('--min-bwlimit',
+                        action='store',
+                        type=int,
+                        metavar='KBPS',
+                        help=('Lowest rate --adaptive-throttle goes down to'
+                              ' (default: {})'.format(_DEFAULT_MIN_BWLIMIT)),
+                        default=_DEFAULT_MIN_BWLIMIT)
+    parser.add_argument('--max-net-rate',
+                        action='store',
+                        type=int,
+                        metavar='KBPS',
+                        help=('Received rate of this host (over all'
+                              ' interfaces but loopback) regarded as busy'
+                              ' with --adaptive-throttle when SRC is remote,'
+                              ' e.g. to leave room for other traffic'
+                              ' (default: the network is not watched)'))
     parser.add_argument('-v', '--version',
                         action='version',
                         version='{}'.format(Version),
                         help='Show version and exit')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    modes = [x for x in ['prune_only', 'verify', 'report', 'restore']
+             if getattr(args, x)]
+    if not args.src and not (modes or args.daemon):
+        parser.error('SRC is required unless --prune-only, --verify,'
+                     ' --report, --restore or --daemon is specified')
+    if len(modes) > 1:
+        parser.error('{} cannot be used together'.format(
+            ' and '.join('--' + x.replace('_', '-') for x in modes)))
+    for tier in ['hourly', 'daily', 'weekly', 'monthly']:
+        if getattr(args, 'keep_' + tier) < 0:
+            parser.error('--keep-{} must be 0 or more'.format(tier))
+    try:
+        args.min_free_space = _parse_size(args.min_free_space)
+    except ValueError:
+        parser.error('Invalid --min-free-space "{}"'
+                     .format(args.min_free_space))
+    if args.min_backups < 1:
+        parser.error('--min-backups must be 1 or more')
+    if args.archive_after is not None and args.archive_after < 1:
+        parser.error('--archive-after must be 1 or more')
+    if args.archive_jobs is None:
+        args.archive_jobs = os.cpu_count() or 1
+    elif args.archive_jobs < 1:
+        parser.error('--archive-jobs must be 1 or more')
+    if args.report_jobs < 1:
+        parser.error('--report-jobs must be 1 or more')
+    if args.restore is not None:
+        args.restore = os.path.normpath('/' + args.restore).lstrip('/')
+        if not args.restore:
+            parser.error('--restore needs a path inside backups')
+    for name in ['restore_to', 'restore_from', 'restore_before']:
+        if getattr(args, name) and args.restore is None:
+            parser.error('--{} needs --restore'
+                         .format(name.replace('_', '-')))
+    for name in ['restore_from', 'restore_before']:
+        if getattr(args, name) and not args.restore_to:
+            parser.error('--{} needs --restore-to'
+                         .format(name.replace('_', '-')))
+    if args.restore_from and args.restore_before:
+        parser.error('--restore-from and --restore-before cannot be'
+                     ' used together')
+    if args.restore_before:
+        try:
+            args.restore_before = dateutil.parser.parse(args.restore_before)
+        except (ValueError, OverflowError):
+            parser.error('Invalid --restore-before "{}"'
+                         .format(args.restore_before))
+        if args.restore_before.tzinfo:
+            # Backup names are in local time without an offset.
+            args.restore_before = args.restore_before.astimezone().replace(
+                tzinfo=None)
+    if args.restore_jobs < 1:
+        parser.error('--restore-jobs must be 1 or more')
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be 1 or more')
+    if args.rsync_log_dir and not os.path.isdir(args.rsync_log_dir):
+        parser.error('{} is not a directory'.format(args.rsync_log_dir))
+    if args.link_dest_count < 1:
+        parser.error('--link-dest-count must be 1 or more')
+    if args.link_dest_weekly < 0:
+        parser.error('--link-dest-weekly must be 0 or more')
+    if args.engine == 'native':
+        if args.src_type != 'local':
+            parser.error('--engine=native is available only with'
+                         ' "local" src-type')
+        remote = [x for x in args.src if _is_remote_src(x)]
+        if remote:
+            parser.error('--engine=native cannot handle remote SRC ({})'
+                         .format(', '.join(remote)))
+    if args.incremental:
+        remote = [x for x in args.src if _is_remote_src(x)]
+        if remote:
+            parser.error('--incremental cannot handle remote SRC ({})'
+                         .format(', '.join(remote)))
+    if args.native_jobs < 1:
+        parser.error('--native-jobs must be 1 or more')
+    if args.reflink and args.engine != 'native':
+        parser.error('--reflink is available only with --engine=native')
+    if args.shards is not None and args.shards < 1:
+        parser.error('--shards must be 1 or more')
+    if args.prune_jobs < 1:
+        parser.error('--prune-jobs must be 1 or more')
+    for value in args.ssh_compression or []:
+        if value.rpartition('=')[2] not in _SSH_COMPRESSIONS:
+            parser.error('--ssh-compression must be one of {}'
+                         .format(', '.join(_SSH_COMPRESSIONS)))
+    if args.ssh_control_dir and not os.path.isdir(args.ssh_control_dir):
+        parser.error('{} is not a directory'.format(args.ssh_control_dir))
+    if args.ssh_benchmark and not any(_get_remote_host(x) for x in args.src):
+        parser.error('--ssh-benchmark needs SRC on a remote host')
+    if args.dedup_jobs is None:
+        args.dedup_jobs = os.cpu_count() or 1
+    elif args.dedup_jobs < 1:
+        parser.error('--dedup-jobs must be 1 or more')
+    if args.verify_jobs is None:
+        args.verify_jobs = os.cpu_count() or 1
+    elif args.verify_jobs < 1:
+        parser.error('--verify-jobs must be 1 or more')
+    if args.min_bwlimit < 1:
+        parser.error('--min-bwlimit must be 1 or more')
+    if args.max_net_rate is not None and args.max_net_rate < 1:
+        parser.error('--max-net-rate must be 1 or more')
+    if args.adaptive_throttle and args.rsync_bwlimit:
+        try:
+            _parse_bwlimit(args.rsync_bwlimit)
+        except ValueError:
+            parser.error('--rsync-bwlimit "{}" is not understood'
+                         ' by --adaptive-throttle'
+                         .format(args.rsync_bwlimit))
     return args
 
 
@@ -165,23 +848,201 @@ def _get_backup_dir_path(thatday, base_dir, dir_format):
 
 
 def _get_backup_dir_name(thatday, dir_format):
-    return thatday.strftime(dir_format.format(
-        hostname=platform.node()))
+    return thatday.strftime(_get_dir_name_pattern(dir_format))
+
+
+def _get_dir_name_pattern(dir_format):
+    """\
+    Returns dir_format with {hostname} expanded,
+    which is usable both with strftime() and strptime().
+    """
+    return dir_format.format(hostname=platform.node())
+
+
+def _parse_backup_dir_name(name, pattern):
+    """\
+    Reverse-parses a directory name created with the strftime pattern.
+    Returns a datetime, or None when the name does not come from the pattern.
+    """
+    try:
+        thatday = datetime.strptime(name, pattern)
+    except ValueError:
+        return None
+    # strptime() is lenient about zero-padding and such.
+    # Accept only names that exactly round-trip.
+    if thatday.strftime(pattern) != name:
+        return None
+    return thatday
+
+
+class SnapshotCatalog:
+    """\
+    Backups existing under base_dir, sorted from the newest to the oldest.
+
+    Built from a single scan of base_dir instead of guessing
+    a directory name for each candidate date,
+    so the cost depends only on the number of existing entries.
+    """
+
+    def __init__(self, base_dir, dir_format, snapshots):
+        self.base_dir = base_dir
+        self.dir_format = dir_format
+        self.snapshots = sorted(snapshots,
+                                key=lambda x: x.timestamp, reverse=True)
+
+    def __iter__(self):
+        return iter(self.snapshots)
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def older_than(self, thatday):
+        """\
+        Returns snapshots strictly older than thatday, newest first.
+        """
+        return [s for s in self.snapshots if s.timestamp < thatday]
+
+    def not_newer_than(self, thatday):
+        return [s for s in self.snapshots if s.timestamp <= thatday]
+
+    def add(self, snapshot):
+        self.discard(snapshot)
+        self.snapshots.append(snapshot)
+        self.snapshots.sort(key=lambda x: x.timestamp, reverse=True)
+
+    def discard(self, snapshot):
+        self.snapshots = [s for s in self.snapshots
+                          if s.name != snapshot.name]
+
+
+def _scan_snapshot_entries(base_dir, pattern, logger=None):
+    logger = logger or _null_logger
+    snapshots = []
+    for entry in os.scandir(base_dir):
+        # Note: "<name>.inprogress" does not match and is never listed.
+        thatday = _parse_backup_dir_name(entry.name, pattern)
+        if thatday is None:
+            continue
+        if not entry.is_dir(follow_symlinks=False):
+            logger.warning('{} is not a directory. Ignoring.'
+                           .format(entry.path))
+            continue
+        snapshots.append(Snapshot(entry.name, entry.path, thatday))
+    return snapshots
+
+
+def _load_catalog_index(index_path, pattern, base_dir_mtime_ns,
+                        logger=None):
+    """\
+    Returns a list of (name, timestamp) pairs stored in the index file,
+    or None when the index is missing or stale.
+    """
+    logger = logger or _null_logger
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug('Unable to read catalog index "{}" ({})'
+                     .format(index_path, e))
+        return None
+    if (not isinstance(index, dict)
+            or index.get('version') != _CATALOG_INDEX_VERSION
+            or index.get('pattern') != pattern
+            or index.get('base_dir_mtime_ns') != base_dir_mtime_ns):
+        logger.debug('Catalog index "{}" is stale'.format(index_path))
+        return None
+    return [(name, datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S'))
+            for name, ts in index.get('entries', [])]
+
+
+def _save_catalog_index(index_path, catalog, base_dir_mtime_ns,
+                        logger=None):
+    logger = logger or _null_logger
+    index = {'version': _CATALOG_INDEX_VERSION,
+             'pattern': _get_dir_name_pattern(catalog.dir_format),
+             'base_dir_mtime_ns': base_dir_mtime_ns,
+             'entries': [[s.name, s.timestamp.strftime('%Y-%m-%dT%H:%M:%S')]
+                         for s in catalog]}
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp_path, index_path)
+    except OSError as e:
+        logger.warning('Unable to write catalog index "{}" ({})'
+                       .format(index_path, e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _refresh_catalog_index(index_path, catalog, dest_dir_path, logger=None):
+    """\
+    Records the backup just taken into the index, so that modifications
+    made by this script itself do not invalidate it for the next run.
+    """
+    pattern = _get_dir_name_pattern(catalog.dir_format)
+    name = os.path.basename(dest_dir_path)
+    thatday = _parse_backup_dir_name(name, pattern)
+    if thatday is not None and os.path.isdir(dest_dir_path):
+        catalog.add(Snapshot(name, dest_dir_path, thatday))
+    _save_catalog_index(index_path, catalog,
+                        os.stat(catalog.base_dir).st_mtime_ns, logger=logger)
+
+
+def _build_snapshot_catalog(base_dir, dir_format, index_path=None,
+                            logger=None):
+    """\
+    Lists backups under base_dir whose names match dir_format.
+
+    When index_path is given, the result is cached there and reused
+    while the modification time of base_dir stays the same
+    (i.e. while no entry is added, removed or renamed in base_dir).
+    """
+    logger = logger or _null_logger
+    pattern = _get_dir_name_pattern(dir_format)
+    if index_path:
+        base_dir_mtime_ns = os.stat(base_dir).st_mtime_ns
+        entries = _load_catalog_index(index_path, pattern, base_dir_mtime_ns,
+                                      logger=logger)
+        if entries is not None:
+            logger.debug('Loaded {} backups from catalog index "{}"'
+                         .format(len(entries), index_path))
+            snapshots = [Snapshot(name, os.path.join(base_dir, name), ts)
+                         for name, ts in entries]
+            return SnapshotCatalog(base_dir, dir_format, snapshots)
+    snapshots = _scan_snapshot_entries(base_dir, pattern, logger=logger)
+    catalog = SnapshotCatalog(base_dir, dir_format, snapshots)
+    logger.debug('Found {} backups in "{}"'.format(len(catalog), base_dir))
+    if index_path:
+        _save_catalog_index(index_path, catalog, base_dir_mtime_ns,
+                            logger=logger)
+    return catalog
+
+
+def _get_expiration_boundary(today, dir_format, removal_threshold, hourly):
+    """\
+    Returns the timestamp of the newest backup that should be removed.
+    Backups with this timestamp or older are expired.
+
+    The boundary is reverse-parsed from the directory name of that date,
+    so that it has the same granularity as timestamps in the catalog.
+    """
+    if hourly:
+        thatday = today - timedelta(hours=removal_threshold + 1)
+    else:
+        thatday = today - timedelta(days=removal_threshold + 1)
+    pattern = _get_dir_name_pattern(dir_format)
+    return _parse_backup_dir_name(thatday.strftime(pattern), pattern)
 
 
 def _is_permission_error(e):
     """\
     受け取った例外がアクセス権限のものであればTrue、そうでなければFalseを返す
     """
-    # See PEP 3151
-    if sys.version_info[0:2] < (3, 2):
-        return (isinstance(e, OSError) or isinstance(e, IOError)
-                and e.args[0] == 13)
-    else:
-        return isinstance(e, PermissionError)
+    return isinstance(e, PermissionError)
 
 
-def _del_rw(function, path, exc_info, logger=None):
+def _del_rw(function, path, exc_info, logger=None, checked=None):
     """\
     ディレクトリツリー上でpathの親以上にあたるディレクトリを
     ルートから辿り、アクセス権限があるかを確認する。
@@ -195,8 +1056,14 @@ def _del_rw(function, path, exc_info, logger=None):
     loggerを使用する場合は、rmtree()のonerrorに
     lambda a, b, c: _del_rw(a, b, c, logger=logger)
     などと指定すれば良い。
+
+    checkedには確認(修正)済みのディレクトリを記録するsetを渡せる。
+    同じsetを使い回すことで、同じ祖先ディレクトリを何度もstatせずに済む。
+    function(path)を再実行した結果を返す。
     """
     logger = logger or _null_logger
+    if checked is None:
+        checked = set()
     if _is_permission_error(exc_info[1]):
         logger.debug('Permission denied found (path: "{}", exc_info: {}).'
                      ' Try fixing the permission.'
@@ -210,7 +1077,7 @@ def _del_rw(function, path, exc_info, logger=None):
         target_dirs_stack = []
         parent_dir_path = os.path.dirname(path)
         cur_path = parent_dir_path
-        while cur_path != '/':
+        while cur_path != '/' and (cur_path, os.X_OK) not in checked:
             target_dirs_stack.append(cur_path)
             cur_path = os.path.dirname(cur_path)
         while target_dirs_stack:
@@ -226,231 +1093,3675 @@ def _del_rw(function, path, exc_info, logger=None):
                                  ' is different from current user (euid: {})'
                                  .format(cur_path, os.geteuid()))
                     raise exc_info[1]
-            if (cur_path == parent_dir_path
-                and not (os.stat(cur_path).st_mode & stat.S_IWUSR)):
+            checked.add((cur_path, os.X_OK))
+        if (parent_dir_path != '/'
+                and (parent_dir_path, os.W_OK) not in checked):
+            if not (os.stat(parent_dir_path).st_mode & stat.S_IWUSR):
                 logger.debug('"{}" is not writable. Try modifying it.'
-                             .format(cur_path))
-                os.chmod(cur_path,
-                         os.stat(cur_path).st_mode | stat.S_IWUSR)
-        function(path)
+                             .format(parent_dir_path))
+                os.chmod(parent_dir_path,
+                         os.stat(parent_dir_path).st_mode | stat.S_IWUSR)
+            checked.add((parent_dir_path, os.W_OK))
+        ret = function(path)
         logger.debug('Successfully fixed permission problem (path: {})'
                      .format(path))
+        return ret
     else:
         logger.debug('Unacceptable exception (exc_info: {})'.format(exc_info))
         raise exc_info[1]
 
 
-def _remove_old_backups_if_exist(today, base_dir, dir_format,
-                                 first_index, last_index, hourly,
-                                 logger=None):
-    logger = logger or _null_logger
-    for i in range(first_index, last_index + 1):
-        if hourly:
-            thatday = today - timedelta(hours=i)
-        else:
-            thatday = today - timedelta(days=i)
-        dir_path = _get_backup_dir_path(thatday, base_dir, dir_format)
-        if os.path.exists(dir_path):
-            if not os.path.isdir(dir_path):
-                logger.warn('{} is not a directory. Ignoring.'
-                            .format(dir_path))
-                continue
-            logger.info('Removing old backup "{}"'.format(dir_path))
-            shutil.rmtree(dir_path,
-                          onerror=lambda a, b, c: _del_rw(a, b, c,
-                                                          logger=logger))
-            logger.debug('Finished removing "{}"'.format(dir_path))
-        else:
-            # 流石に少しverboseすぎる
-            # logger.debug('"{}" does not exist.'.format(dir_path))
-            pass
+def _call_fixing_permission(function, path, checked, logger=None):
+    try:
+        return function(path)
+    except OSError:
+        return _del_rw(function, path, sys.exc_info(),
+                       logger=logger, checked=checked)
+
+
+def _list_dir_entries(path):
+    with os.scandir(path) as it:
+        return list(it)
 
 
-def _find_link_dir(today, base_dir, dir_format,
-                   first_index, last_index, is_hourly_backup,
-                   logger=None):
+def _remove_tree(path, jobs, logger=None):
     """\
-    Finds the directory that will be used with --link-dest option.
+    shutil.rmtree() equivalent that unlinks files with a pool of
+    at most "jobs" threads, each of which handles one directory at a time.
+    Permission problems are fixed with _del_rw(). Entries removed by
+    someone else meanwhile are skipped.
     """
     logger = logger or _null_logger
-    for i in range(first_index, last_index + 1):
-        if is_hourly_backup:
-            thatday = today - timedelta(hours=i)
-        else:
-            thatday = today - timedelta(days=i)
-        dir_path = _get_backup_dir_path(thatday, base_dir, dir_format)
-        if os.path.isdir(dir_path):
-            return dir_path
-    return None
+    checked = set()
 
+    def _call(function, path, default=None):
+        try:
+            return _call_fixing_permission(function, path, checked,
+                                           logger=logger)
+        except FileNotFoundError:
+            return default
 
-def _log_thread(file_in, logger, prefix):
-    for line in iter(file_in.readline, b''):
-        uni_line = unicode(line, encoding='utf-8', errors='replace')
-        msg = prefix + uni_line.rstrip()
-        logger.debug(msg)
+    def _clear_dir(dir_path):
+        subdirs = []
+        for entry in _call(_list_dir_entries, dir_path, default=[]):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            else:
+                _call(os.unlink, entry.path)
+        return subdirs
 
+    # Directories in the order of discovery. Parents always come first.
+    dirs = [path]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = set([executor.submit(_clear_dir, path)])
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    dirs.append(subdir)
+                    pending.add(executor.submit(_clear_dir, subdir))
+    for dir_path in reversed(dirs):
+        _call(os.rmdir, dir_path)
 
-def _construct_rsync_opts(args, link_dir_path, included_dirs, excluded_dirs,
-                          logger=None):
+
+def _move_to_trash(path, trash_dir, logger=None):
+    """\
+    Renames path into trash_dir, which must be on the same filesystem.
+    Returns the new path, or None when the rename is not possible.
+    """
     logger = logger or _null_logger
-    if args.src_type == 'ssh':
-        # Note: do not rely on archive mode (-a)
-        rsync_opts = ['-irtlz', '--delete', '--no-specials', '--no-devices']
-    elif args.src_type == 'rough':
-        # "Rough" backup, meaning you just want to preserve file content, while
-        # you don't care much about permission, storage usage, etc.
-        rsync_opts = ['-irtL', '--no-specials', '--no-devices']
-    else:
-        rsync_opts = ['-iaAHXLu', '--delete', '--no-specials', '--no-devices']
-    if args.verbose_rsync:
-        rsync_opts.append('--verbose')
-    if link_dir_path:
-        rsync_opts.append('--link-dest={}'.format(link_dir_path))
-    rsync_opts.extend(map(lambda x: '--include ' + x, included_dirs))
-    rsync_opts.extend(map(lambda x: '--exclude ' + x, excluded_dirs))
-    if args.exclude_from:
-        rsync_opts.append(args.exclude_from)
-    if args.identity_file:
-        if not os.path.exists(args.identity_file):
-            err_msg = ('Identity file "{}" does not exist.'
-                       .format(args.identity_file))
-            raise AppException(err_msg)
-        rsync_opts.append('-e "ssh -i {}"'.format(args.identity_file))
-    if args.rsync_bwlimit:
-        rsync_opts.append('--bwlimit "{}"'.format(args.rsync_bwlimit))
-    return rsync_opts
+    if not os.path.isdir(trash_dir):
+        os.mkdir(trash_dir)
+    name = os.path.basename(path)
+    trash_path = os.path.join(trash_dir, name)
+    suffix = 0
+    while os.path.lexists(trash_path):
+        suffix += 1
+        trash_path = os.path.join(trash_dir, '{}.{}'.format(name, suffix))
+    try:
+        os.rename(path, trash_path)
+    except OSError as e:
+        logger.debug('Unable to move "{}" to "{}" ({})'
+                     .format(path, trash_path, e))
+        return None
+    return trash_path
 
 
-def _do_actual_backup(src_list, dest_dir_path, link_dir_path,
-                      included_dirs, excluded_dirs, logger, args):
-    '''
-    Returns exit status code of rsync command.
-    '''
-    cmd_base = args.rsync_command
-    rsync_opts = _construct_rsync_opts(args, link_dir_path,
-                                       included_dirs, excluded_dirs,
-                                       logger=logger)
-    cmd = '{} {} {} {}'.format(cmd_base, ' '.join(rsync_opts),
-                               ' '.join(src_list), dest_dir_path)
-    logger.debug('Running: {}'.format(cmd))
-    if args.log_rsync_output:
-        t_logger = logger
-    else:
-        t_logger = _null_logger
-    exec_args = shlex.split(cmd)
-    stdout_thread = None
-    stderr_thread = None
-    try:
-        # Start executing rsync and track its output asynchronously.
-        # Two separate threads will do that job.
-        p = subprocess.Popen(exec_args,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        stdout_args = (p.stdout, t_logger, '{}(stdout): '.format(exec_args[0]))
-        stderr_args = (p.stderr, t_logger, '{}(stderr): '.format(exec_args[0]))
-        stdout_thread = threading.Thread(target=_log_thread, args=stdout_args)
-        stderr_thread = threading.Thread(target=_log_thread, args=stderr_args)
-        stdout_thread.start()
-        stderr_thread.start()
-        p.wait()
-        # Note: rsync itself mostly exist with non-0 status code,
-        # so the caller won't need to check this code anyway.
-        return p.returncode
-    finally:
-        logger.debug('Waiting for threads\' exiting.')
-        if stdout_thread:
-            stdout_thread.join()
-        if stderr_thread:
-            stderr_thread.join()
-        logger.debug('Confirmed threads exited.')
+def _empty_trash(trash_dir, jobs, logger=None):
+    logger = logger or _null_logger
+    if not os.path.isdir(trash_dir):
+        return
+    for entry in _list_dir_entries(trash_dir):
+        logger.debug('Removing "{}"'.format(entry.path))
+        if entry.is_dir(follow_symlinks=False):
+            _remove_tree(entry.path, jobs, logger=logger)
+        else:
+            os.unlink(entry.path)
+        logger.debug('Finished removing "{}"'.format(entry.path))
+    os.rmdir(trash_dir)
 
 
-def _main_inter(args, logger):
-    if args.hourly:
-        if args.dir_format == _DEFAULT_DIR_FORMAT:
-            logger.debug('Automatically switch to "hourly" dir_format ("{}")'
-                         .format(_DEFAULT_DIR_FORMAT_HOURLY))
-            args.dir_format = _DEFAULT_DIR_FORMAT_HOURLY
-        else:
-            # If the user changes the format, check if the new version
-            # contains "%H"
-            if '%H' not in args.dir_format:
-                logger.warn('dir_format does not contain %H while --hourly'
-                            ' option is specified')
+class TrashPruner:
+    """\
+    Empties the trash directory in a background thread,
+    so that removing old backups does not delay rsync.
+    """
 
-    org_base_dir = args.base_dir
-    norm_base_dir = os.path.normpath(args.base_dir)
-    logger.debug('Normalized base_dir: "{}"'.format(norm_base_dir))
+    def __init__(self, trash_dir, jobs, logger=None):
+        self.trash_dir = trash_dir
+        self.jobs = jobs
+        self.logger = logger or _null_logger
+        self.successful = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
 
-    if args.base_dir == "/":
-        logger.error("base-dir looks root to me ({})"
-                     .format(args.base_dir))
-        return False
+    def _run(self):
+        try:
+            _empty_trash(self.trash_dir, self.jobs, logger=self.logger)
+            self.successful = True
+        except Exception:
+            self.logger.error('Failed to empty "{}"\n{}'
+                              .format(self.trash_dir, traceback.format_exc()))
+            self.successful = False
 
-    if os.path.exists(norm_base_dir):
-        # If base_dir exists, check if it is a writable directory.
-        if not os.path.isdir(norm_base_dir):
-            logger.error('Path "{}" is not a directory'
-                         .format(org_base_dir))
-            return False
-        if not os.access(norm_base_dir, os.W_OK):
-            logger.error('Directory "{}" is not writable'
-                         .format(org_base_dir))
-        logger.debug('Directory "{}" exists and writable.'
-                     .format(org_base_dir))
-    else:
-        logger.info('Directory "{}" does not exist. Creating it.'
-                    .format(org_base_dir))
-        # If base_dir does not exists, check parent's dir.
-        # If parent's dir exists, try creating base_dir.
-        parent_dir = os.path.dirname(norm_base_dir)
-        if (not os.path.exists(parent_dir)
-            or not os.path.isdir(parent_dir)):
-            logger.error('Parent dir "{}" is not accessible'
-                         .format(parent_dir))
-            return False
-        os.mkdir(args.base_dir)
+    def start(self):
+        self._thread.start()
+        return self
 
-    if args.base_dir == "/":
-        logger.error("base-dir looks root to me ({})".format(args.base_dir))
-        return False
+    def join(self):
+        self._thread.join()
+        return self.successful
 
-    today = datetime.today()
-    src_str = ', '.join(map(lambda x: '"{}"'.format(x), args.src))
-    dest_dir_path = _get_backup_dir_path(today, args.base_dir, args.dir_format)
-    logger.debug('Backup {} to "{}"'.format(src_str, dest_dir_path))
 
-    if args.removal_threshold > 0:
-        logger.debug('Remove old backups if exist (threshold: {})'
-                     .format(args.removal_threshold))
-        first_index = args.removal_threshold + 1
-        last_index = _DEFAULT_REMOVAL_SEARCH_THRESHOLD
-        _remove_old_backups_if_exist(today, args.base_dir, args.dir_format,
-                                     first_index, last_index,
-                                     args.hourly, logger=logger)
-    if args.force_full_backup:
-        logger.debug('Force full-backup')
-    else:
-        link_dir_path = _find_link_dir(today, args.base_dir, args.dir_format,
-                                       1, args.removal_threshold, args.hourly,
-                                       logger=logger)
-        if link_dir_path:
-            logger.debug('Will hardlink to "{}" with --link-dest'
-                         .format(link_dir_path))
+def _find_inprogress_dirs(base_dir, pattern):
+    """\
+    Returns paths of in-progress backups under base_dir, newest first.
+    """
+    found = []
+    for entry in os.scandir(base_dir):
+        if not entry.name.endswith(_INPROGRESS_SUFFIX):
+            continue
+        thatday = _parse_backup_dir_name(
+            entry.name[:-len(_INPROGRESS_SUFFIX)], pattern)
+        if thatday is not None and entry.is_dir(follow_symlinks=False):
+            found.append((thatday, entry.path))
+    found.sort(reverse=True)
+    return [path for _, path in found]
+
+
+def _prepare_inprogress_dir(dest_dir_path, catalog, resumable, trash_dir,
+                            logger=None):
+    """\
+    Returns the in-progress directory where the backup for dest_dir_path
+    is built, to be published by _publish_backup_dir().
+
+    When resumable, the in-progress directory left by an interrupted run
+    (of any day) is reused, so that rsync transfers only what is missing.
+    Otherwise the backup is built from scratch and leftovers are moved to
+    trash_dir.
+
+    A complete backup of the same period is never touched here. It stays
+    as is until the new one is published, and serves as the first
+    --link-dest meanwhile (see _backup_with_catalog()).
+    """
+    logger = logger or _null_logger
+    pattern = _get_dir_name_pattern(catalog.dir_format)
+    inprogress_path = dest_dir_path + _INPROGRESS_SUFFIX
+    leftovers = _find_inprogress_dirs(catalog.base_dir, pattern)
+    if inprogress_path in leftovers:
+        leftovers.remove(inprogress_path)
+        leftovers.insert(0, inprogress_path)
+    resumed = None
+    for path in leftovers:
+        if resumable and resumed is None:
+            logger.info('Resuming backup in "{}"'.format(path))
+            if path != inprogress_path:
+                os.rename(path, inprogress_path)
+            resumed = path
+            continue
+        logger.info('Discarding interrupted backup "{}"'.format(path))
+        if not _move_to_trash(path, trash_dir, logger=logger):
+            raise AppException('Failed to move "{}" to "{}"'
+                               .format(path, trash_dir))
+    return inprogress_path
+
+
+def _publish_backup_dir(inprogress_path, dest_dir_path, trash_dir,
+                        logger=None):
+    """\
+    Renames the in-progress directory to dest_dir_path, replacing the
+    backup taken before in the same period if any.
+    """
+    logger = logger or _null_logger
+    if os.path.isdir(dest_dir_path):
+        # Removed by TrashPruner of the next run.
+        if not _move_to_trash(dest_dir_path, trash_dir, logger=logger):
+            raise AppException('Failed to move "{}" to "{}"'
+                               .format(dest_dir_path, trash_dir))
+    logger.debug('Publishing "{}" as "{}"'.format(inprogress_path,
+                                                  dest_dir_path))
+    os.rename(inprogress_path, dest_dir_path)
+
+
+def _remove_old_backups_if_exist(today, catalog, removal_threshold, hourly,
+                                 trash_dir=None, jobs=1, logger=None):
+    """\
+    Removes backups older than removal_threshold from the catalog.
+
+    When trash_dir is given, they are just renamed into trash_dir and
+    actual removal is left to _empty_trash().
+    Otherwise (or when the rename fails) they are removed right here.
+    Returns the number of backups removed.
+    """
+    logger = logger or _null_logger
+    boundary = _get_expiration_boundary(today, catalog.dir_format,
+                                        removal_threshold, hourly)
+    if boundary is None:
+        logger.warning('Unable to determine which backups are old'
+                       ' with dir-format "{}"'.format(catalog.dir_format))
+        return 0
+    return _remove_backups(catalog.not_newer_than(boundary), catalog,
+                           trash_dir=trash_dir, jobs=jobs, logger=logger)
+
+
+def _select_backups_to_keep(today, catalog, keep_hourly=0, keep_daily=0,
+                            keep_weekly=0, keep_monthly=0):
+    """\
+    Returns names of backups kept by a tiered policy: all backups of the
+    last keep_hourly hours, then the newest backup of each of the last
+    keep_daily days, keep_weekly (ISO) weeks and keep_monthly months.
+    The newest backup is always kept.
+    """
+    snapshots = list(catalog)
+    keep = set(s.name for s in snapshots[:1])
+    if keep_hourly:
+        since = today - timedelta(hours=keep_hourly)
+        keep.update(s.name for s in snapshots if s.timestamp > since)
+    tiers = [
+        (lambda t: t.date(),
+         [today - timedelta(days=i) for i in range(keep_daily)]),
+        (lambda t: t.isocalendar()[:2],
+         [today - timedelta(weeks=i) for i in range(keep_weekly)]),
+        (lambda t: (t.year, t.month),
+         [today - dateutil.relativedelta.relativedelta(months=i)
+          for i in range(keep_monthly)])]
+    for get_period, days in tiers:
+        periods = set(get_period(x) for x in days)
+        # Newest first
+        for snapshot in snapshots:
+            period = get_period(snapshot.timestamp)
+            if period in periods:
+                keep.add(snapshot.name)
+                periods.discard(period)
+    return keep
+
+
+def _remove_backups(snapshots, catalog, trash_dir=None, jobs=1, logger=None):
+    """\
+    Removes snapshots with their change manifests from the catalog.
+    See _remove_old_backups_if_exist() about trash_dir.
+    Returns the number of backups removed.
+    """
+    logger = logger or _null_logger
+    for snapshot in snapshots:
+        catalog.discard(snapshot)
+        manifest_path = _get_change_manifest_path(snapshot.path)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        if trash_dir:
+            trash_path = _move_to_trash(snapshot.path, trash_dir,
+                                        logger=logger)
+            if trash_path:
+                logger.info('Moved old backup "{}" to "{}"'
+                            .format(snapshot.path, trash_path))
+                continue
+        logger.info('Removing old backup "{}"'.format(snapshot.path))
+        _remove_tree(snapshot.path, jobs, logger=logger)
+        logger.debug('Finished removing "{}"'.format(snapshot.path))
+    return len(snapshots)
+
+
+def _parse_size(value):
+    """\
+    Returns bytes in a value such as "1024", "500M" or "2G",
+    or raises ValueError.
+    """
+    m = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)$', value.strip().upper())
+    if not m:
+        raise ValueError(value)
+    factor = 1024 ** ' KMGT'.index(m.group(2) or ' ')
+    return int(float(m.group(1)) * factor)
+
+
+def _get_free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def _get_transferred_bytes(summary):
+    """\
+    Returns bytes written by a run from the summary of ChangeStream,
+    or None when unknown.
+    """
+    stats = summary.get('stats', {})
+    if 'total_transferred_file_size' in stats:
+        return stats['total_transferred_file_size']
+    num_bytes = summary.get('bytes', {})
+    if 'new' in num_bytes or 'changed' in num_bytes:
+        return num_bytes.get('new', 0) + num_bytes.get('changed', 0)
+    return None
+
+
+def _load_space_history(base_dir, catalog, logger=None):
+    """\
+    Returns bytes written by recent runs, oldest first.
+    Without history recorded by _save_space_history(), change manifests
+    of existing backups are used.
+    """
+    logger = logger or _null_logger
+    path = os.path.join(base_dir, _SPACE_HISTORY_NAME)
+    try:
+        with open(path) as f:
+            return json.load(f)['transferred']
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug('No size history available from "{}" ({})'
+                     .format(path, e))
+    history = []
+    for snapshot in list(catalog)[:_SPACE_HISTORY_LENGTH]:
+        summary = _read_change_summary(snapshot.path)
+        num_bytes = _get_transferred_bytes(summary) if summary else None
+        if num_bytes is not None:
+            history.insert(0, num_bytes)
+    return history
+
+
+def _save_space_history(base_dir, history, logger=None):
+    logger = logger or _null_logger
+    path = os.path.join(base_dir, _SPACE_HISTORY_NAME)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'transferred': history[-_SPACE_HISTORY_LENGTH:]}, f)
+        os.rename(tmp_path, path)
+    except OSError as e:
+        logger.warning('Unable to write size history "{}" ({})'
+                       .format(path, e))
+
+
+def _predict_run_size(history):
+    """\
+    Returns bytes the next run is expected to write: the largest of recent
+    runs with a margin, since a run writing more than the usual is exactly
+    the one that would fill the disk.
+    """
+    if not history:
+        return 0
+    return int(max(history) * _SPACE_PREDICTION_FACTOR)
+
+
+def _prune_for_space(base_dir, catalog, needed, trash_dir, jobs,
+                     min_backups, archived=None, logger=None):
+    """\
+    Removes the oldest backups until base_dir has needed bytes free,
+    emptying trash_dir first. archived (see _find_archived_snapshots())
+    are older than any backup in catalog and go first, if they are on
+    the filesystem of base_dir.
+    Fewer than min_backups (archived ones included) are never left,
+    nor the newest backup.
+    Removal is done right here, since space freed later would not help
+    a transfer already running.
+    Returns (the number of backups removed, True when space is enough).
+    """
+    logger = logger or _null_logger
+    free = _get_free_space(base_dir)
+    if free >= needed:
+        logger.debug('{} bytes free while {} bytes needed'
+                     .format(free, needed))
+        return 0, True
+    if os.path.isdir(trash_dir):
+        logger.info('Emptying "{}" to make space'.format(trash_dir))
+        _empty_trash(trash_dir, jobs, logger=logger)
+    dev = os.stat(base_dir).st_dev
+    archived = [x for x in archived or [] if os.stat(x.path).st_dev == dev]
+    num_removed = 0
+    while _get_free_space(base_dir) < needed:
+        snapshots = list(catalog)
+        if (len(snapshots) + len(archived) <= min_backups
+                or (len(snapshots) < 2 and not archived)):
+            logger.error('Only {} bytes will be free while {} bytes are'
+                         ' expected to be written, and {} backups are'
+                         ' left'.format(_get_free_space(base_dir), needed,
+                                        len(snapshots) + len(archived)))
+            return num_removed, False
+        if archived:
+            oldest = archived.pop()
+            logger.info('Removing "{}" to make space'.format(oldest.path))
+            _remove_archive(oldest, logger=logger)
+        else:
+            oldest = snapshots[-1]
+            logger.info('Removing "{}" to make space'.format(oldest.path))
+            _remove_backups([oldest], catalog, jobs=jobs, logger=logger)
+        num_removed += 1
+    return num_removed, True
+
+
+def _find_link_dir(today, catalog, logger=None):
+    """\
+    Finds the directory that will be used with --link-dest option.
+    """
+    logger = logger or _null_logger
+    pattern = _get_dir_name_pattern(catalog.dir_format)
+    current = _parse_backup_dir_name(today.strftime(pattern), pattern)
+    candidates = catalog.older_than(current or today)
+    if candidates:
+        return candidates[0].path
+    return None
+
+
+def _find_link_dirs(today, catalog, newest=1, weekly=0, logger=None):
+    """\
+    Finds directories that will be used with --link-dest options:
+    the newest "newest" backups, followed by the newest backup of each of
+    "weekly" preceding weeks not covered yet.
+    The first one is always the one _find_link_dir() returns.
+    """
+    logger = logger or _null_logger
+    pattern = _get_dir_name_pattern(catalog.dir_format)
+    current = _parse_backup_dir_name(today.strftime(pattern), pattern)
+    candidates = catalog.older_than(current or today)
+    chosen = candidates[:newest]
+    weeks = set(s.timestamp.isocalendar()[:2] for s in chosen)
+    num_anchors = 0
+    for snapshot in candidates[newest:]:
+        if num_anchors >= weekly:
+            break
+        week = snapshot.timestamp.isocalendar()[:2]
+        if week not in weeks:
+            weeks.add(week)
+            chosen.append(snapshot)
+            num_anchors += 1
+    if len(chosen) > _MAX_LINK_DEST:
+        logger.warning('rsync accepts at most {} --link-dest options.'
+                       ' Ignoring older ones.'.format(_MAX_LINK_DEST))
+    return [s.path for s in chosen[:_MAX_LINK_DEST]]
+
+
+def _walk_files(top):
+    """\
+    Yields DirEntry objects of all non-directory entries under top.
+    """
+    stack = [top]
+    while stack:
+        try:
+            entries = _list_dir_entries(stack.pop())
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            else:
+                yield entry
+
+
+def _count_link_dest_savings(dest_dir_path, link_dir_paths):
+    """\
+    Returns (files, bytes) hardlinked from any --link-dest directory other
+    than the first one, i.e. what would have been copied if only the first
+    one was given to rsync.
+    """
+    num_files = 0
+    num_bytes = 0
+    if len(link_dir_paths) < 2:
+        return num_files, num_bytes
+    for entry in _walk_files(dest_dir_path):
+        st = entry.stat(follow_symlinks=False)
+        if st.st_nlink < 2 or not stat.S_ISREG(st.st_mode):
+            continue
+        rel_path = os.path.relpath(entry.path, dest_dir_path)
+        inodes = []
+        for link_dir_path in link_dir_paths:
+            try:
+                link_st = os.lstat(os.path.join(link_dir_path, rel_path))
+            except OSError:
+                inodes.append(None)
+                continue
+            inodes.append((link_st.st_dev, link_st.st_ino))
+        inode = (st.st_dev, st.st_ino)
+        if inodes[0] != inode and inode in inodes[1:]:
+            num_files += 1
+            num_bytes += st.st_size
+    return num_files, num_bytes
+
+
+def _get_change_manifest_path(backup_dir_path):
+    return backup_dir_path.rstrip('/') + _CHANGE_MANIFEST_SUFFIX
+
+
+class ChangeStream:
+    """\
+    Parses rsync output produced with --out-format=_CHANGE_OUT_FORMAT
+    and --stats line by line, counting new, changed, deleted and
+    hardlinked files with their bytes.
+
+    When "records" (a text file object) is given, each file change is
+    written there as "<kind>\\t<size>\\t<path>" where kind is one of
+    N (new), C (changed), D (deleted) and H (hardlinked within the backup).
+
+    With items False, only the summary of --stats is parsed and rsync is
+    run without --out-format, which is all --metrics-file and
+    --prune-for-space need.
+
+    Lines may be fed from several threads (e.g. one per shard).
+    """
+
+    KINDS = ['new', 'changed', 'deleted', 'hardlinked']
+
+    _ITEM_RE = re.compile(r'^([<>ch.*].{10}) (\d+) (.*)$')
+    _STATS_RE = re.compile(r'^([A-Z][A-Za-z ]+): ([\d,.]+)')
+    _REG_FILES_RE = re.compile(r'reg: ([\d,]+)')
+
+    def __init__(self, records=None, items=True):
+        self.records = records
+        self.items = items
+        self.counts = dict((kind, 0) for kind in self.KINDS)
+        self.bytes = dict((kind, 0) for kind in self.KINDS)
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def feed(self, line):
+        m = self.items and self._ITEM_RE.match(line)
+        with self._lock:
+            if m:
+                self._feed_item(m.group(1), int(m.group(2)), m.group(3))
+            else:
+                self._feed_stats(line)
+
+    def _feed_item(self, item, size, path):
+        if item.startswith('*deleting'):
+            # Directories are deleted as "dir/".
+            if path.endswith('/'):
+                return
+            kind = 'deleted'
+        elif item[1] != 'f':
+            return
+        elif item[0] == 'h':
+            kind = 'hardlinked'
+        elif item[0] in '<>c':
+            if item[2:].strip('+'):
+                kind = 'changed'
+            else:
+                kind = 'new'
+        else:
+            return
+        self.counts[kind] += 1
+        self.bytes[kind] += size
+        if self.records:
+            self.records.write('{}\t{}\t{}\n'
+                               .format(kind[0].upper(), size, path))
+
+    def _feed_stats(self, line):
+        m = self._STATS_RE.match(line)
+        if not m:
+            return
+        key = m.group(1).strip().lower().replace(' ', '_')
+        try:
+            value = float(m.group(2).replace(',', ''))
+        except ValueError:
+            return
+        if value.is_integer():
+            value = int(value)
+        # Several runs of rsync (shards) add up.
+        self.stats[key] = self.stats.get(key, 0) + value
+        if key == 'number_of_files':
+            m = self._REG_FILES_RE.search(line)
+            if m:
+                self.stats['number_of_regular_files'] = (
+                    self.stats.get('number_of_regular_files', 0)
+                    + int(m.group(1).replace(',', '')))
+
+    def summary(self):
+        """\
+        Returns a dict of counters. "unchanged" files are regular files
+        which rsync did not need to transfer, i.e. the ones hardlinked from
+        --link-dest directories. They are known only from --stats.
+        """
+        summary = {'counts': dict(self.counts),
+                   'bytes': dict(self.bytes),
+                   'stats': dict(self.stats)}
+        if ('number_of_regular_files' in self.stats
+                and 'number_of_regular_files_transferred' in self.stats):
+            summary['counts']['unchanged'] = max(
+                0, self.stats['number_of_regular_files']
+                - self.stats['number_of_regular_files_transferred']
+                - self.counts['hardlinked'])
+        if ('total_file_size' in self.stats
+                and 'total_transferred_file_size' in self.stats):
+            summary['bytes']['unchanged'] = max(
+                0, self.stats['total_file_size']
+                - self.stats['total_transferred_file_size']
+                - self.bytes['hardlinked'])
+        return summary
+
+
+def _open_change_records(dest_dir_path):
+    tmp_path = '{}.{}.tmp'.format(_get_change_manifest_path(dest_dir_path),
+                                  os.getpid())
+    return gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1)
+
+
+def _finish_change_manifest(dest_dir_path, change_stream, logger=None):
+    """\
+    Writes the manifest as two concatenated gzip members:
+    a JSON summary line followed by the records of change_stream.
+    So "zcat | head -1" answers how much changed without reading the rest.
+    """
+    logger = logger or _null_logger
+    records = change_stream.records
+    records.close()
+    manifest_path = _get_change_manifest_path(dest_dir_path)
+    header = dict(change_stream.summary(),
+                  backup=os.path.basename(dest_dir_path.rstrip('/')))
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(gzip.compress((json.dumps(header) + '\n').encode('utf-8')))
+        with open(records.name, 'rb') as records_in:
+            shutil.copyfileobj(records_in, f)
+    os.remove(records.name)
+    os.rename(tmp_path, manifest_path)
+    logger.debug('Wrote change manifest "{}"'.format(manifest_path))
+    return manifest_path
+
+
+def _discard_change_records(change_stream):
+    """\
+    Removes the records of change_stream unless _finish_change_manifest()
+    has already moved them into the manifest.
+    """
+    change_stream.records.close()
+    _remove_quietly(change_stream.records.name)
+
+
+def _read_change_summary(backup_dir_path):
+    """\
+    Returns the summary of the change manifest of a backup, or None.
+    """
+    try:
+        with gzip.open(_get_change_manifest_path(backup_dir_path),
+                       'rt', encoding='utf-8') as f:
+            return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def _get_remote_host(src):
+    """\
+    Returns "[USER@]HOST" of a SRC reached via a remote shell,
+    or None (a local path or an rsync daemon).
+    """
+    if src.startswith('rsync://') or '::' in src or not _is_remote_src(src):
+        return None
+    return src[:src.find(':')]
+
+
+def _get_link_option(values, host):
+    """\
+    Returns the value applied to host among values of an option given as
+    "VALUE" or "HOST=VALUE" (host-specific ones win, then later ones).
+    """
+    host_name = host.split('@')[-1] if host else None
+    generic = None
+    specific = None
+    for value in values or []:
+        key, sep, rest = value.partition('=')
+        if not sep:
+            generic = value
+        elif key in (host, host_name):
+            specific = rest
+    return specific or generic
+
+
+class SshTransport:
+    """\
+    Builds the remote shell command rsync runs for each host.
+
+    With --ssh-control-dir, connections are multiplexed through a control
+    socket per host (ControlMaster=auto), and the master connection is
+    kept for --ssh-control-persist seconds after the last use, so that
+    following jobs and runs skip the handshake. Cipher and compression
+    can be chosen for each host with --ssh-cipher and --ssh-compression.
+    """
+
+    def __init__(self, args):
+        self.rsh = args.rsh
+        self.identity_file = args.identity_file
+        self.control_dir = args.ssh_control_dir
+        self.control_persist = args.ssh_control_persist
+        self.ciphers = args.ssh_cipher
+        self.compressions = args.ssh_compression
+
+    def get_compression(self, host):
+        return _get_link_option(self.compressions, host) or 'rsync'
+
+    def get_command(self, host, cipher=None, compression=None,
+                    multiplex=True):
+        """\
+        Returns the remote shell command for host as a list.
+        cipher and compression override the ones given by options.
+        """
+        if self.identity_file and not os.path.exists(self.identity_file):
+            err_msg = ('Identity file "{}" does not exist.'
+                       .format(self.identity_file))
+            raise AppException(err_msg)
+        command = shlex.split(self.rsh)
+        if self.identity_file:
+            command.extend(['-i', self.identity_file])
+        cipher = cipher or _get_link_option(self.ciphers, host)
+        if cipher:
+            command.extend(['-c', cipher])
+        compression = compression or self.get_compression(host)
+        if compression == 'ssh':
+            command.append('-C')
+        if self.control_dir and multiplex:
+            command.extend(['-o', 'ControlMaster=auto',
+                            '-o', 'ControlPath={}'.format(
+                                os.path.join(self.control_dir, '%C')),
+                            '-o', 'ControlPersist={}'.format(
+                                self.control_persist)])
+        return command
+
+    def get_rsync_opts(self, host, compress=True):
+        """\
+        Returns rsync options for transfers from host.
+        compress is False when rsync runs without a remote shell.
+        """
+        rsync_opts = []
+        command = self.get_command(host)
+        if command != ['ssh']:
+            rsync_opts.append('-e {}'.format(shlex.quote(
+                ' '.join(shlex.quote(x) for x in command))))
+        if compress and self.get_compression(host) == 'rsync':
+            rsync_opts.append('-z')
+        return rsync_opts
+
+
+def _make_benchmark_data(size):
+    """\
+    Returns sample data for --ssh-benchmark, half of which compresses well
+    (like text) and the other half not (like media files).
+    """
+    text = b''.join(b'line %d of some log file\n' % i for i in range(4096))
+    half = size // 2
+    compressible = (text * (half // len(text) + 1))[:half]
+    return compressible + os.urandom(size - half)
+
+
+def _time_command(command, data=None):
+    """\
+    Returns seconds command took, or None when it failed.
+    """
+    start_time = time.time()
+    p = subprocess.Popen(command, stdin=subprocess.PIPE,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    p.communicate(data)
+    if p.returncode != 0:
+        return None
+    return time.time() - start_time
+
+
+def _benchmark_ssh(args, logger=None):
+    """\
+    Measures the handshake time and throughput to each remote SRC for each
+    cipher and compression (ssh -C or none) over ssh, and also the time
+    a multiplexed connection takes with --ssh-control-dir.
+    Returns a list of dicts, one for each measurement, sorted by host and
+    throughput.
+    """
+    logger = logger or _null_logger
+    transport = SshTransport(args)
+    data = _make_benchmark_data(_SSH_BENCHMARK_SIZE)
+    hosts = []
+    for src in args.src:
+        host = _get_remote_host(src)
+        if host and host not in hosts:
+            hosts.append(host)
+    results = []
+    for host in hosts:
+        configured = _get_link_option(transport.ciphers, host)
+        ciphers = [configured] if configured else _SSH_BENCHMARK_CIPHERS
+        host_results = []
+        for cipher in ciphers:
+            for compression in ['none', 'ssh']:
+                command = transport.get_command(host, cipher=cipher,
+                                                compression=compression,
+                                                multiplex=False)
+                handshake = _time_command(command + [host, 'true'])
+                if handshake is None:
+                    logger.warning('{}: cipher {} is not available'
+                                   .format(host, cipher))
+                    break
+                elapsed = _time_command(command + [host, 'cat > /dev/null'],
+                                        data=data)
+                if elapsed is None:
+                    logger.warning('{}: failed sending data with cipher {}'
+                                   .format(host, cipher))
+                    continue
+                # The handshake is paid by the transfer as well.
+                transfer = max(elapsed - handshake, 1e-6)
+                host_results.append({
+                    'host': host,
+                    'cipher': cipher,
+                    'compression': compression,
+                    'handshake_seconds': handshake,
+                    'throughput_bytes_per_second': len(data) / transfer})
+        host_results.sort(key=lambda x: -x['throughput_bytes_per_second'])
+        if transport.control_dir:
+            command = transport.get_command(host)
+            # The first one may start the master connection.
+            _time_command(command + [host, 'true'])
+            multiplexed = _time_command(command + [host, 'true'])
+            for result in host_results:
+                result['multiplexed_handshake_seconds'] = multiplexed
+        for result in host_results:
+            logger.info('{host}: cipher {cipher}, compression {compression}:'
+                        ' handshake {handshake_seconds:.3f} sec,'
+                        ' {throughput_bytes_per_second:.0f} bytes/sec'
+                        .format(**result))
+        results.extend(host_results)
+    return results
+
+
+def _construct_rsync_opts(args, link_dir_paths, included_dirs, excluded_dirs,
+                          shard_filters=None, change_stream=None,
+                          files_from=None, bwlimit=None, host=None,
+                          logger=None):
+    """\
+    shard_filters is a pair of rsync filter options which are put before
+    and after the filters specified by the user (see _get_shard_filters()).
+    files_from is a file listing paths (separated by NUL) to transfer
+    instead of the whole SRC.
+    bwlimit (KB/s) overrides --rsync-bwlimit.
+    host is "[USER@]HOST" of SRC for per-host ssh options.
+    """
+    logger = logger or _null_logger
+    if args.src_type == 'ssh':
+        # Note: do not rely on archive mode (-a)
+        # -z depends on --ssh-compression (see SshTransport).
+        rsync_opts = ['-irtl', '--delete', '--no-specials', '--no-devices']
+    elif args.src_type == 'rough':
+        # "Rough" backup, meaning you just want to preserve file content, while
+        # you don't care much about permission, storage usage, etc.
+        rsync_opts = ['-irtL', '--no-specials', '--no-devices']
+    else:
+        rsync_opts = ['-iaAHXLu', '--delete', '--no-specials', '--no-devices']
+    rsync_opts.append('--partial-dir={}'.format(_PARTIAL_DIR_NAME))
+    if files_from:
+        # Only changed files are listed, and with --dirs (implied by
+        # --files-from) --delete would remove unchanged ones of each
+        # directory listed.
+        if '--delete' in rsync_opts:
+            rsync_opts.remove('--delete')
+        rsync_opts.append('--from0')
+        rsync_opts.append('--files-from={}'.format(shlex.quote(files_from)))
+    if args.verbose_rsync:
+        rsync_opts.append('--verbose')
+    if change_stream:
+        if change_stream.items:
+            rsync_opts.append("--out-format='{}'"
+                              .format(_CHANGE_OUT_FORMAT))
+        rsync_opts.append('--stats')
+    for link_dir_path in link_dir_paths or []:
+        # rsync resolves relative paths from the destination directory.
+        rsync_opts.append('--link-dest={}'
+                          .format(os.path.abspath(link_dir_path)))
+    if shard_filters:
+        rsync_opts.extend(shard_filters[0])
+    rsync_opts.extend(map(lambda x: '--include ' + x, included_dirs))
+    rsync_opts.extend(map(lambda x: '--exclude ' + x, excluded_dirs))
+    if args.exclude_from:
+        rsync_opts.append('--exclude-from "{}"'.format(args.exclude_from))
+    if shard_filters:
+        rsync_opts.extend(shard_filters[1])
+    rsync_opts.extend(SshTransport(args).get_rsync_opts(
+        host, compress=(args.src_type == 'ssh')))
+    if bwlimit:
+        rsync_opts.append('--bwlimit "{}"'.format(bwlimit))
+    elif args.rsync_bwlimit:
+        rsync_opts.append('--bwlimit "{}"'.format(args.rsync_bwlimit))
+    return rsync_opts
+
+
+def _parse_bwlimit(value):
+    """\
+    Returns the rate (KB/s) in a value of --bwlimit such as "1024" or "5M",
+    or raises ValueError.
+    """
+    m = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)$', value.strip().upper())
+    if not m:
+        raise ValueError(value)
+    factor = {'': 1, 'K': 1, 'M': 1024, 'G': 1024 * 1024}[m.group(2)]
+    return int(float(m.group(1)) * factor)
+
+
+def _get_block_device_name(path):
+    """\
+    Returns the name in /proc/diskstats of the device holding path,
+    or None (e.g. tmpfs, NFS).
+    """
+    st_dev = os.stat(path).st_dev
+    major, minor = os.major(st_dev), os.minor(st_dev)
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                if (int(fields[0]), int(fields[1])) == (major, minor):
+                    return fields[2]
+    except OSError:
+        pass
+    return None
+
+
+def _read_diskstats(device):
+    """\
+    Returns (I/Os completed, msec spent on them, sectors written)
+    of device, or None.
+    """
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 10 and fields[2] == device:
+                    return (int(fields[3]) + int(fields[7]),
+                            int(fields[6]) + int(fields[10]),
+                            int(fields[9]))
+    except OSError:
+        pass
+    return None
+
+
+def _read_net_received():
+    """\
+    Returns bytes received so far over all interfaces but loopback
+    (from /proc/net/dev), or None.
+    """
+    total = 0
+    try:
+        with open('/proc/net/dev') as f:
+            # Two header lines, then "name: rx_bytes rx_packets ..."
+            for line in f.readlines()[2:]:
+                name, _, fields = line.partition(':')
+                if name.strip() != 'lo':
+                    total += int(fields.split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return total
+
+
+def _read_load_per_cpu():
+    try:
+        with open('/proc/loadavg') as f:
+            return float(f.read().split()[0]) / (os.cpu_count() or 1)
+    except (OSError, ValueError):
+        return None
+
+
+class AdaptiveThrottle:
+    """\
+    Adjusts the transfer rate while a backup is running, so that
+    it goes as fast as the host can afford.
+
+    Every _THROTTLE_INTERVAL seconds, the average I/O latency of the
+    device holding base_dir (from /proc/diskstats) and the load average
+    per CPU are checked. With max_net_kbps (for a remote SRC), so is the
+    rate this host receives at (from /proc/net/dev), which is also what
+    the transfer is observed to run at, since little may be written when
+    most files are unchanged. When any of them exceeds its target, the
+    rate is multiplied by _THROTTLE_DECREASE (starting from the observed
+    rate when not limited yet); otherwise it is raised step by step
+    up to max_kbps (None: unlimited).
+
+    The native engine consumes the rate with consume().
+    rsync cannot change --bwlimit while running, so _do_actual_backup()
+    restarts it when should_restart() says the rate changed enough.
+    """
+
+    def __init__(self, base_dir, max_latency_ms, max_load, min_kbps,
+                 max_kbps=None, max_net_kbps=None, logger=None):
+        self.max_latency_ms = max_latency_ms
+        self.max_load = max_load
+        self.max_net_kbps = max_net_kbps
+        self.min_kbps = min_kbps
+        self.max_kbps = max_kbps
+        self.kbps = max_kbps
+        self.logger = logger or _null_logger
+        self.device = _get_block_device_name(base_dir)
+        if not self.device:
+            self.logger.warning('I/O latency of "{}" is not available.'
+                                ' Only load average is watched.'
+                                .format(base_dir))
+        self._last_diskstats = None
+        self._last_received = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        # For consume()
+        self._allowance = 0.0
+        self._last_consumed = time.time()
+
+    def start(self):
+        if self.device:
+            self._last_diskstats = _read_diskstats(self.device)
+        if self.max_net_kbps:
+            self._last_received = _read_net_received()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(_THROTTLE_INTERVAL):
+            self.update()
+
+    def update(self):
+        latency_ms = None
+        written_kbps = None
+        if self.device:
+            diskstats = _read_diskstats(self.device)
+            if diskstats and self._last_diskstats:
+                ios = diskstats[0] - self._last_diskstats[0]
+                if ios > 0:
+                    latency_ms = ((diskstats[1] - self._last_diskstats[1])
+                                  / ios)
+                written_kbps = ((diskstats[2] - self._last_diskstats[2])
+                                * 512 / 1024 / _THROTTLE_INTERVAL)
+            self._last_diskstats = diskstats
+        received_kbps = None
+        if self.max_net_kbps:
+            received = _read_net_received()
+            if received is not None and self._last_received is not None:
+                received_kbps = ((received - self._last_received)
+                                 / 1024 / _THROTTLE_INTERVAL)
+            self._last_received = received
+        load = _read_load_per_cpu()
+        congested = ((latency_ms is not None
+                      and latency_ms > self.max_latency_ms)
+                     or (load is not None and load > self.max_load)
+                     or (received_kbps is not None
+                         and received_kbps > self.max_net_kbps))
+        observed_kbps = (received_kbps if received_kbps is not None
+                         else written_kbps)
+        with self._lock:
+            old_kbps = self.kbps
+            if congested:
+                base = self.kbps or observed_kbps or self.min_kbps
+                self.kbps = max(self.min_kbps,
+                                int(base * _THROTTLE_DECREASE))
+            elif self.kbps is not None:
+                self.kbps = int(self.kbps * _THROTTLE_INCREASE)
+                if self.max_kbps and self.kbps >= self.max_kbps:
+                    self.kbps = self.max_kbps
+                elif (not self.max_kbps and observed_kbps is not None
+                      and self.kbps > observed_kbps * 2):
+                    # The limit no longer matters.
+                    self.kbps = None
+            new_kbps = self.kbps
+        if new_kbps != old_kbps:
+            self.logger.debug('Transfer rate: {} -> {} KB/s (latency: {},'
+                              ' load per CPU: {}, received: {} KB/s)'
+                              .format(old_kbps or 'unlimited',
+                                      new_kbps or 'unlimited',
+                                      latency_ms, load, received_kbps))
+
+    def get_bwlimit(self, share=1):
+        """\
+        Returns the rate (KB/s) for one of "share" concurrent transfers,
+        or None for no limit.
+        """
+        with self._lock:
+            if self.kbps is None:
+                return None
+            return max(1, self.kbps // share)
+
+    def should_restart(self, bwlimit, share=1):
+        """\
+        Returns True when a transfer started with bwlimit is worth
+        restarting with the current rate.
+        """
+        current = self.get_bwlimit(share)
+        if current == bwlimit:
+            return False
+        if current is None or bwlimit is None:
+            return True
+        return abs(current - bwlimit) > bwlimit * _THROTTLE_RESTART_RATIO
+
+    def consume(self, num_bytes):
+        """\
+        Blocks until num_bytes may be transferred under the current rate.
+        """
+        while True:
+            with self._lock:
+                if self.kbps is None:
+                    return
+                now = time.time()
+                rate = self.kbps * 1024.0
+                # Do not let a long idle period turn into a burst.
+                self._allowance = min(
+                    self._allowance + (now - self._last_consumed) * rate,
+                    rate)
+                self._last_consumed = now
+                if self._allowance >= num_bytes or self._allowance >= rate:
+                    self._allowance -= num_bytes
+                    return
+                wait = (num_bytes - self._allowance) / rate
+            time.sleep(min(wait, 1.0))
+
+
+def _make_line_handler(logger, prefix, change_stream=None, tail=None):
+    """\
+    Returns a function handling one line (bytes) of rsync output,
+    or None when nobody consumes the output, so that lines are
+    not even split nor decoded.
+    """
+    consumes_log = logger is not _null_logger
+    if not (consumes_log or change_stream or tail is not None):
+        return None
+    # Only the summary of --stats is wanted, whose lines start with
+    # a capital letter (e.g. "Number of files: ...").
+    stats_only = (not (consumes_log or tail is not None)
+                  and not change_stream.items)
+
+    def _handle_line(line):
+        if stats_only and not line[:1].isupper():
+            return
+        uni_line = str(line, encoding='utf-8', errors='replace')
+        if consumes_log:
+            logger.debug(prefix + uni_line.rstrip())
+        if change_stream:
+            change_stream.feed(uni_line)
+        if tail is not None:
+            tail.append(uni_line.rstrip())
+    return _handle_line
+
+
+def _pump_output(streams, raw_out=None, poll=None, process=None):
+    """\
+    Reads all of the given pipes in large chunks from a single thread
+    until each of them reaches EOF.
+
+    streams is a dict mapping each pipe to a line handler
+    (see _make_line_handler()) or None.
+    When raw_out is given, everything read is written there as is.
+    poll, when given, is called about every second in between.
+    When process (Popen) is given, reading stops once it has exited and
+    nothing is left in the pipes, even if they are still held open by
+    a process it left behind (e.g. a persistent ssh master).
+    """
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    for stream in streams:
+        selector.register(stream, selectors.EVENT_READ)
+        buffers[stream] = b''
+    timeout = 1.0 if poll or process else None
+    try:
+        while selector.get_map():
+            if poll:
+                poll()
+            exited = process is not None and process.poll() is not None
+            events = selector.select(0 if exited else timeout)
+            if exited and not events:
+                for stream, rest in buffers.items():
+                    if streams[stream] and rest:
+                        streams[stream](rest)
+                break
+            for key, _ in events:
+                stream = key.fileobj
+                handler = streams[stream]
+                data = os.read(key.fd, _PUMP_CHUNK_SIZE)
+                if not data:
+                    selector.unregister(stream)
+                    rest = buffers.pop(stream)
+                    if handler and rest:
+                        handler(rest)
+                    continue
+                if raw_out:
+                    raw_out.write(data)
+                if handler:
+                    lines = (buffers[stream] + data).split(b'\n')
+                    buffers[stream] = lines.pop()
+                    for line in lines:
+                        handler(line)
+    finally:
+        selector.close()
+
+
+def _open_rsync_output_log(args, dest_dir_path, label):
+    """\
+    Returns a gzip file storing raw rsync output of this run,
+    or None when --rsync-log-dir is not specified.
+    """
+    if not args.rsync_log_dir:
+        return None
+    rel_path = os.path.relpath(dest_dir_path, args.base_dir)
+    name = '{}{}-{}.log.gz'.format(rel_path.replace(os.sep, '_'), label,
+                                   time.strftime('%Y%m%d%H%M%S'))
+    return gzip.open(os.path.join(args.rsync_log_dir, name), 'wb',
+                     compresslevel=1)
+
+
+def _do_actual_backup(src_list, dest_dir_path, link_dir_paths,
+                      included_dirs, excluded_dirs, logger, args,
+                      shard_filters=None, change_stream=None, label='',
+                      files_from=None, throttle=None, share=1):
+    '''
+    Returns exit status code of rsync command.
+
+    With throttle (AdaptiveThrottle), rsync is restarted with a new
+    --bwlimit when the rate changes enough. share is the number of rsync
+    processes running at the same time under the throttle.
+    '''
+    if args.log_rsync_output:
+        t_logger = logger
+    else:
+        t_logger = _null_logger
+    # Last lines of stderr are kept to explain a failure.
+    stderr_tail = collections.deque(maxlen=_STDERR_TAIL_LINES)
+    raw_out = _open_rsync_output_log(args, dest_dir_path, label)
+    bwlimit = throttle.get_bwlimit(share) if throttle else None
+    host = _get_remote_host(src_list[0]) if src_list else None
+    try:
+        while True:
+            rsync_opts = _construct_rsync_opts(args, link_dir_paths,
+                                               included_dirs, excluded_dirs,
+                                               shard_filters=shard_filters,
+                                               change_stream=change_stream,
+                                               files_from=files_from,
+                                               bwlimit=bwlimit,
+                                               host=host, logger=logger)
+            cmd = '{} {} {} {}'.format(args.rsync_command,
+                                       ' '.join(rsync_opts),
+                                       ' '.join(src_list), dest_dir_path)
+            logger.debug('Running: {}'.format(cmd))
+            exec_args = shlex.split(cmd)
+            stderr_tail.clear()
+            stdout_handler = _make_line_handler(
+                t_logger, '{}(stdout): '.format(exec_args[0]), change_stream)
+            stderr_handler = _make_line_handler(
+                t_logger, '{}(stderr): '.format(exec_args[0]),
+                tail=stderr_tail)
+            if stdout_handler or raw_out:
+                stdout = subprocess.PIPE
+            else:
+                stdout = subprocess.DEVNULL
+            p = subprocess.Popen(exec_args, stdout=stdout,
+                                 stderr=subprocess.PIPE)
+            streams = {p.stderr: stderr_handler}
+            if p.stdout:
+                streams[p.stdout] = stdout_handler
+            started = time.time()
+            restarting = []
+
+            def _poll():
+                if (not restarting and p.poll() is None
+                        and (time.time() - started
+                             >= _THROTTLE_RESTART_INTERVAL)
+                        and throttle.should_restart(bwlimit, share)):
+                    restarting.append(True)
+                    p.terminate()
+
+            _pump_output(streams, raw_out=raw_out,
+                         poll=_poll if throttle else None, process=p)
+            p.wait()
+            # rsync exits with 20 on SIGTERM
+            if not (restarting and p.returncode in (20, -signal.SIGTERM)):
+                break
+            new_bwlimit = throttle.get_bwlimit(share)
+            logger.info('Restarting rsync with --bwlimit {} (was {})'
+                        .format(new_bwlimit or 'unlimited',
+                                bwlimit or 'unlimited'))
+            bwlimit = new_bwlimit
+    finally:
+        if raw_out:
+            raw_out.close()
+    if not _is_acceptable_exit_code(p.returncode):
+        for line in stderr_tail:
+            logger.error('{}(stderr): {}'.format(exec_args[0], line))
+    # Note: rsync itself mostly exist with non-0 status code,
+    # so the caller won't need to check this code anyway.
+    return p.returncode
+
+
+def _is_remote_src(src):
+    # Same rule as rsync(1): a colon before any slash means a remote host.
+    if src.startswith('rsync://'):
+        return True
+    colon = src.find(':')
+    return colon >= 0 and '/' not in src[:colon]
+
+
+def _list_shard_entries(src):
+    """\
+    Returns (prefix, names) where names are the top-level entries of
+    the transfer of src, and prefix is the path under which rsync places
+    them relative to the transfer root.
+    As in rsync(1), "/path/dir/" transfers the contents of "dir" while
+    "/path/dir" transfers "dir" itself.
+    """
+    if src.endswith('/'):
+        prefix = ''
+    else:
+        prefix = os.path.basename(src)
+    names = sorted(entry.name for entry in os.scandir(src))
+    return prefix, names
+
+
+def _load_shard_costs(state_path, src, logger=None):
+    """\
+    Returns {name: estimated cost} for top-level entries of src,
+    recorded by _save_shard_costs() in the previous run.
+    """
+    logger = logger or _null_logger
+    try:
+        with open(state_path) as f:
+            return json.load(f).get(src, {})
+    except (OSError, ValueError, AttributeError) as e:
+        logger.debug('No shard timings available from "{}" ({})'
+                     .format(state_path, e))
+        return {}
+
+
+def _save_shard_costs(state_path, src, costs, logger=None):
+    logger = logger or _null_logger
+    state = {}
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        pass
+    state[src] = costs
+    tmp_path = '{}.{}.tmp'.format(state_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, state_path)
+    except OSError as e:
+        logger.warning('Unable to write shard timings to "{}" ({})'
+                       .format(state_path, e))
+
+
+def _plan_shards(names, costs, num_shards):
+    """\
+    Distributes names into at most num_shards lists with similar total
+    costs (longest processing time first).
+    Entries unknown to costs are assumed to take the average time.
+    """
+    known = [costs[name] for name in names if name in costs]
+    default_cost = (sum(known) / len(known)) if known else 1.0
+    shards = [[] for _ in range(min(num_shards, len(names)))]
+    totals = [0.0] * len(shards)
+    for name in sorted(names, key=lambda x: costs.get(x, default_cost),
+                       reverse=True):
+        i = totals.index(min(totals))
+        shards[i].append(name)
+        totals[i] += costs.get(name, default_cost)
+    return shards
+
+
+def _escape_rsync_pattern(name):
+    return re.sub(r'([*?\[\\])', r'\\\1', name)
+
+
+def _get_shard_filters(shards, index, prefix):
+    """\
+    Returns filters which restrict a run of rsync to shards[index]
+    without changing how user filters apply to that shard.
+
+    Entries of the other shards are excluded before any user filter,
+    so they never match this shard. Then, after all the user filters,
+    entries of this shard are included (which is the default anyway) and
+    everything else is excluded, so that an entry which appeared after
+    the shards were planned is transferred only by the first shard.
+    """
+    def _pattern(name, escape=True):
+        if escape:
+            name = _escape_rsync_pattern(name)
+        if prefix:
+            name = _escape_rsync_pattern(prefix) + '/' + name
+        return shlex.quote('/' + name)
+    pre_filters = []
+    for i, names in enumerate(shards):
+        if i != index:
+            pre_filters.extend('--exclude ' + _pattern(x) for x in names)
+    post_filters = []
+    if index != 0:
+        post_filters.extend('--include ' + _pattern(x)
+                            for x in shards[index])
+        post_filters.append('--exclude ' + _pattern('*', escape=False))
+    return pre_filters, post_filters
+
+
+def _merge_exit_codes(exit_codes):
+    """\
+    Returns the exit code representing several runs of rsync.
+    """
+    unacceptable = [x for x in exit_codes if not _is_acceptable_exit_code(x)]
+    if unacceptable:
+        return unacceptable[0]
+    return max(exit_codes)
+
+
+def _can_shard(src_list, logger):
+    if len(src_list) != 1:
+        logger.warning('Sharding needs exactly one SRC (use --jobs for'
+                       ' several SRC). Running without shards.')
+        return False
+    if _is_remote_src(src_list[0]) or not os.path.isdir(src_list[0]):
+        logger.warning('Sharding is available only for a local directory.'
+                       ' Running without shards.')
+        return False
+    return True
+
+
+def _do_sharded_backup(src, dest_dir_path, link_dir_paths, included_dirs,
+                       excluded_dirs, state_path, logger, args,
+                       change_stream=None, throttle=None):
+    """\
+    Runs one rsync per shard of the top-level entries of src in parallel.
+    Returns the exit status code merged by _merge_exit_codes().
+    """
+    prefix, names = _list_shard_entries(src)
+    if not names:
+        return _do_actual_backup([src], dest_dir_path, link_dir_paths,
+                                 included_dirs, excluded_dirs, logger, args,
+                                 change_stream=change_stream,
+                                 throttle=throttle)
+    costs = _load_shard_costs(state_path, src, logger=logger)
+    shards = _plan_shards(names, costs, args.shards)
+    # rsync may fail when several processes create the same directory
+    # at the same time.
+    shared_dir = os.path.join(dest_dir_path, prefix)
+    if not os.path.isdir(shared_dir):
+        os.makedirs(shared_dir)
+
+    def _run_shard(index):
+        shard_logger = _JobLoggerAdapter(logger,
+                                         {'job': 'shard{}'.format(index)})
+        shard_logger.debug('Entries: {}'.format(', '.join(shards[index])))
+        start_time = time.time()
+        exit_code = _do_actual_backup(
+            [src], dest_dir_path, link_dir_paths, included_dirs,
+            excluded_dirs, shard_logger, args,
+            shard_filters=_get_shard_filters(shards, index, prefix),
+            change_stream=change_stream, label='.shard{}'.format(index),
+            throttle=throttle, share=len(shards))
+        elapsed = time.time() - start_time
+        shard_logger.debug('Exited with {} in {:.3f} sec'
+                           .format(exit_code, elapsed))
+        return exit_code, elapsed
+
+    logger.debug('Running {} shards of "{}"'.format(len(shards), src))
+    if args.src_type == 'local' and len(shards) > 1:
+        logger.debug('Hardlinks between entries of different shards'
+                     ' are not preserved')
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(shards)) as executor:
+        results = list(executor.map(_run_shard, range(len(shards))))
+
+    # Split elapsed time of each shard among its entries in proportion
+    # to their previous estimates, so that the next run is better balanced.
+    default_cost = 1.0
+    new_costs = {}
+    for names_in_shard, (_, elapsed) in zip(shards, results):
+        estimates = [costs.get(x, default_cost) for x in names_in_shard]
+        total = sum(estimates) or 1.0
+        for name, estimate in zip(names_in_shard, estimates):
+            new_costs[name] = elapsed * estimate / total
+    _save_shard_costs(state_path, src, new_costs, logger=logger)
+    return _merge_exit_codes([exit_code for exit_code, _ in results])
+
+
+def _rsync_pattern_to_regex(pattern):
+    """\
+    Translates wildcards of an rsync(1) filter pattern into a regex.
+    "*" does not match "/" while "**" does.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end < 0:
+                regex.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                regex.append('[' + body.replace('\\', '\\\\') + ']')
+                i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return ''.join(regex)
+
+
+class RsyncFilter:
+    """\
+    Include/exclude rules evaluated the same way as rsync(1) does,
+    so that the native engine honors --include, --exclude,
+    --exclude-from and _DEFAULT_EXCLUDED_DIR.
+
+    Paths given to is_excluded() are relative to the transfer root and
+    start with "/", as anchored patterns expect.
+    The first matching rule wins. Nothing matched means included.
+    """
+
+    def __init__(self, rules):
+        """\
+        rules is a list of (is_include, pattern) in the order of priority.
+        """
+        self._rules = []
+        for is_include, pattern in rules:
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if pattern.startswith('/'):
+                regex = '^' + _rsync_pattern_to_regex(pattern) + '$'
+                match_full = True
+            elif '/' in pattern or '**' in pattern:
+                regex = '(^|/)' + _rsync_pattern_to_regex(pattern) + '$'
+                match_full = True
+            else:
+                regex = '^' + _rsync_pattern_to_regex(pattern) + '$'
+                match_full = False
+            self._rules.append((is_include, dir_only, match_full,
+                                re.compile(regex)))
+
+    @classmethod
+    def from_lists(cls, included_dirs, excluded_dirs, exclude_from=None):
+        rules = [(True, x) for x in included_dirs]
+        rules.extend((False, x) for x in excluded_dirs)
+        if exclude_from:
+            with open(exclude_from) as f:
+                for line in f:
+                    line = line.rstrip('\r\n')
+                    if not line or line[0] in ';#':
+                        continue
+                    if line.startswith('+ '):
+                        rules.append((True, line[2:]))
+                    elif line.startswith('- '):
+                        rules.append((False, line[2:]))
+                    else:
+                        rules.append((False, line))
+        return cls(rules)
+
+    def is_excluded(self, path, is_dir):
+        name = path.rsplit('/', 1)[-1]
+        for is_include, dir_only, match_full, regex in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(path if match_full else name):
+                return not is_include
+        return False
+
+
+def _copy_file_data(src_path, dest_path, throttle=None):
+    """\
+    Copies file content in the kernel where possible
+    (copy_file_range(2), then sendfile(2)).
+    With throttle (AdaptiveThrottle), the content is copied in chunks
+    each of which waits for its turn.
+    """
+    with open(src_path, 'rb') as fsrc, open(dest_path, 'wb') as fdst:
+        in_fd = fsrc.fileno()
+        out_fd = fdst.fileno()
+        size = os.fstat(in_fd).st_size
+        copy_range = getattr(os, 'copy_file_range', None)
+        step = _NATIVE_COPY_CHUNK_SIZE if throttle else size
+        offset = 0
+        while copy_range and offset < size:
+            count = min(step, size - offset)
+            if throttle:
+                throttle.consume(count)
+            try:
+                copied = copy_range(in_fd, out_fd, count)
+            except OSError:
+                # e.g. EXDEV on old kernels. Fall back to sendfile().
+                break
+            if not copied:
+                break
+            offset += copied
+        while offset < size:
+            count = min(step, size - offset)
+            if throttle:
+                throttle.consume(count)
+            try:
+                copied = os.sendfile(out_fd, in_fd, offset, count)
+            except OSError:
+                break
+            if not copied:
+                break
+            offset += copied
+        if offset < size:
+            fsrc.seek(offset)
+            fdst.seek(offset)
+            if not throttle:
+                shutil.copyfileobj(fsrc, fdst, _NATIVE_COPY_CHUNK_SIZE)
+                return
+            while True:
+                buf = fsrc.read(_NATIVE_COPY_CHUNK_SIZE)
+                if not buf:
+                    break
+                throttle.consume(len(buf))
+                fdst.write(buf)
+
+
+def _clone_file(base_path, dest_path):
+    """\
+    Creates dest_path sharing all the blocks of base_path (FICLONE),
+    or raises OSError when the filesystem does not support it.
+    """
+    with open(base_path, 'rb') as fbase, open(dest_path, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fbase.fileno())
+
+
+def _probe_reflink(dir_path):
+    """\
+    Returns True when files in dir_path can be cloned with _clone_file().
+    """
+    fd, base_path = tempfile.mkstemp(prefix='.do_backup_reflink.',
+                                     dir=dir_path)
+    dest_path = base_path + '.clone'
+    try:
+        os.write(fd, b'\0')
+        os.close(fd)
+        _clone_file(base_path, dest_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        for path in [base_path, dest_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _rewrite_changed_blocks(src_path, dest_path, throttle=None):
+    """\
+    Makes dest_path (a clone of an older version of src_path) identical
+    to src_path, writing only blocks whose content differs, so that the
+    others stay shared with the clone source.
+    Returns the number of bytes written.
+    """
+    written = 0
+    with open(src_path, 'rb') as fsrc, open(dest_path, 'r+b') as fdst:
+        out_fd = fdst.fileno()
+        offset = 0
+        while True:
+            buf = fsrc.read(_REFLINK_BLOCK_SIZE)
+            if not buf:
+                break
+            if os.pread(out_fd, len(buf), offset) != buf:
+                if throttle:
+                    throttle.consume(len(buf))
+                os.pwrite(out_fd, buf, offset)
+                written += len(buf)
+            offset += len(buf)
+        fdst.truncate(offset)
+    return written
+
+
+def _copy_xattrs(src_path, dest_path):
+    """\
+    Copies extended attributes, which include POSIX ACLs
+    (system.posix_acl_*) on Linux.
+    """
+    if not hasattr(os, 'listxattr'):
+        return
+    try:
+        names = os.listxattr(src_path)
+    except OSError:
+        return
+    for name in names:
+        try:
+            os.setxattr(dest_path, name, os.getxattr(src_path, name))
+        except OSError:
+            pass
+
+
+def _copy_metadata(st, src_path, dest_path):
+    """\
+    Applies owner, permission, xattrs and times of st (the stat of
+    src_path) to dest_path, as "rsync -aAX" does.
+    """
+    if os.geteuid() == 0:
+        os.chown(dest_path, st.st_uid, st.st_gid)
+    os.chmod(dest_path, stat.S_IMODE(st.st_mode))
+    _copy_xattrs(src_path, dest_path)
+    os.utime(dest_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _get_native_temp_path(dest_path):
+    """\
+    Returns where NativeBackup writes dest_path before renaming it,
+    as rsync does with ".NAME.XXXXXX".
+    """
+    dir_path, name = os.path.split(dest_path)
+    return os.path.join(dir_path, '.{}.{}.tmp'.format(name[:200],
+                                                      os.getpid()))
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _copy_symlink(st, src_path, dest_path):
+    """\
+    Recreates the symlink src_path at dest_path with the owner and times
+    of st, as "rsync -al" does.
+    """
+    os.symlink(os.readlink(src_path), dest_path)
+    if os.geteuid() == 0:
+        os.lchown(dest_path, st.st_uid, st.st_gid)
+    if os.utime in os.supports_follow_symlinks:
+        os.utime(dest_path, ns=(st.st_atime_ns, st.st_mtime_ns),
+                 follow_symlinks=False)
+
+
+def _is_same_file_in_link_dest(st, link_st):
+    """\
+    Returns True when a file of a --link-dest directory can be hardlinked
+    instead of being copied, with the rules rsync uses (size, mtime and
+    attributes being preserved must be identical).
+    """
+    if not stat.S_ISREG(link_st.st_mode):
+        return False
+    if (st.st_size != link_st.st_size
+            or st.st_mtime_ns != link_st.st_mtime_ns
+            or stat.S_IMODE(st.st_mode) != stat.S_IMODE(link_st.st_mode)):
+        return False
+    if os.geteuid() == 0 and (st.st_uid, st.st_gid) != (link_st.st_uid,
+                                                         link_st.st_gid):
+        return False
+    return True
+
+
+class NativeBackup:
+    """\
+    Local-to-local backup without rsync, equivalent to
+    "rsync -aAHXL --no-specials --no-devices --link-dest=..." into
+    an empty destination.
+
+    The source is walked with os.scandir(). A file identical to the one at
+    the same path in a link-dest directory is hardlinked. The other files
+    are copied by a pool of threads, so that I/O on several disks
+    proceeds in parallel. Each file is written to a temporary name and
+    renamed, so an existing inode is never modified.
+
+    At most jobs * _NATIVE_PENDING_PER_JOB copies are queued at a time.
+    Directory times and hardlinks inside the source wait only for the
+    copies submitted before them (see _defer()), so they are done while
+    the walk goes on.
+
+    Without follow_symlinks, symlinks are copied as symlinks ("-l"
+    instead of "-L"), which --restore uses.
+
+    With reflink, a changed file is cloned from its version in the first
+    link-dest directory having it and only differing blocks are written
+    (see _rewrite_changed_blocks()). Unchanged files are still hardlinked.
+    """
+
+    def __init__(self, dest_dir_path, link_dir_paths, rsync_filter, jobs,
+                 change_stream=None, throttle=None, follow_symlinks=True,
+                 reflink=False, logger=None):
+        self.dest_dir_path = dest_dir_path
+        self.link_dir_paths = link_dir_paths
+        self.rsync_filter = rsync_filter
+        self.jobs = jobs
+        self.change_stream = change_stream
+        self.throttle = throttle
+        self.follow_symlinks = follow_symlinks
+        self.reflink = reflink
+        self.logger = logger or _null_logger
+        self.num_errors = 0
+        self.num_files = 0
+        self.num_dirs = 0
+        self.num_regular_files = 0
+        self.num_transferred = 0
+        self.total_size = 0
+        self.transferred_size = 0
+        self.num_reflinked = 0
+        self.rewritten_size = 0
+        # (dev, ino) of the source -> (destination path, sequence number
+        # of the copy writing it), for -H
+        self._hardlinks = {}
+        # Numbers of copies submitted and waited for, in order.
+        self._num_submitted = 0
+        self._num_done = 0
+        # (sequence number, function, args) run after that many copies
+        self._deferred = collections.deque()
+        self._lock = threading.Lock()
+
+    def run(self, src_list):
+        """\
+        Returns an exit code compatible with the one of rsync.
+        """
+        if not os.path.isdir(self.dest_dir_path):
+            os.makedirs(self.dest_dir_path)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs) as executor:
+            futures = collections.deque()
+            for src in src_list:
+                self._walk(src, executor, futures)
+            self._wait_all(futures)
+        self._feed_stats()
+        if self.num_errors:
+            return 23
+        return 0
+
+    def _error(self, operation, e):
+        self.logger.error('{}: {}'.format(operation, e))
+        with self._lock:
+            self.num_errors += 1
+
+    def _try(self, function, *args):
+        try:
+            function(*args)
+            return True
+        except OSError as e:
+            self._error(function.__name__, e)
+            return False
+
+    def _submit(self, executor, futures, function, *args):
+        """\
+        Queues a copy, waiting for the oldest ones when too many are
+        queued. Returns the sequence number of the copy for _defer().
+        """
+        futures.append(executor.submit(function, *args))
+        self._num_submitted += 1
+        while len(futures) > self.jobs * _NATIVE_PENDING_PER_JOB:
+            self._wait_oldest(futures)
+        return self._num_submitted
+
+    def _wait_oldest(self, futures):
+        futures.popleft().result()
+        self._num_done += 1
+        self._run_deferred()
+
+    def _wait_all(self, futures):
+        while futures:
+            self._wait_oldest(futures)
+        self._run_deferred()
+
+    def _defer(self, seq, function, *args):
+        """\
+        Runs function once the copies up to sequence number seq are done.
+        """
+        self._deferred.append((seq, function, args))
+        self._run_deferred()
+
+    def _run_deferred(self):
+        # In order, so that a directory time is set after everything
+        # deferred inside it.
+        while self._deferred and self._deferred[0][0] <= self._num_done:
+            _, function, args = self._deferred.popleft()
+            self._try(function, *args)
+
+    def _walk(self, src, executor, futures):
+        # As in rsync(1), "dir/" transfers the contents of "dir"
+        # while "dir" transfers "dir" itself.
+        if src.endswith('/'):
+            prefix = ''
+        else:
+            prefix = '/' + os.path.basename(src)
+        src_dir = src.rstrip('/') or '/'
+        try:
+            st = os.stat(src_dir)
+        except OSError as e:
+            # rsync goes on with the other sources and exits with 23.
+            self._error('stat', e)
+            return
+        if not self._make_dir(self.dest_dir_path + prefix):
+            return
+        # (src path, path relative to transfer root, ancestors' inodes,
+        #  stat, dest path). rel_dir None means the subtree is done.
+        stack = [(src_dir, prefix, frozenset([(st.st_dev, st.st_ino)]),
+                  st, self.dest_dir_path + prefix)]
+        while stack:
+            dir_path, rel_dir, ancestors, dir_st, dest_dir = stack.pop()
+            if rel_dir is None:
+                # Writing into a directory updates its mtime, so its
+                # times are restored after copies into its subtree.
+                self._defer(self._num_submitted, _copy_metadata, dir_st,
+                            dir_path, dest_dir)
+                continue
+            stack.append((dir_path, None, None, dir_st, dest_dir))
+            try:
+                entries = _list_dir_entries(dir_path)
+            except OSError as e:
+                self._error('scandir', e)
+                continue
+            for entry in entries:
+                rel_path = rel_dir + '/' + entry.name
+                try:
+                    # -L: symlinks are replaced with what they point to
+                    st = entry.stat(follow_symlinks=self.follow_symlinks)
+                except OSError as e:
+                    self._error('stat', e)
+                    continue
+                is_dir = stat.S_ISDIR(st.st_mode)
+                if self.rsync_filter.is_excluded(rel_path, is_dir):
+                    continue
+                dest_path = self.dest_dir_path + rel_path
+                if is_dir:
+                    inode = (st.st_dev, st.st_ino)
+                    if inode in ancestors:
+                        self.logger.warning('Skipping directory loop at "{}"'
+                                            .format(entry.path))
+                        continue
+                    if self._make_dir(dest_path):
+                        stack.append((entry.path, rel_path,
+                                      ancestors | frozenset([inode]),
+                                      st, dest_path))
+                elif stat.S_ISREG(st.st_mode):
+                    self._handle_file(st, entry.path, rel_path, dest_path,
+                                      executor, futures)
+                elif stat.S_ISLNK(st.st_mode):
+                    self.num_files += 1
+                    self._try(_copy_symlink, st, entry.path, dest_path)
+                # --no-specials --no-devices: others are ignored.
+
+    def _make_dir(self, dest_path):
+        self.num_files += 1
+        self.num_dirs += 1
+        if not os.path.isdir(dest_path):
+            if not self._try(os.mkdir, dest_path):
+                return False
+        return True
+
+    def _handle_file(self, st, src_path, rel_path, dest_path, executor,
+                     futures):
+        self.num_files += 1
+        self.num_regular_files += 1
+        self.total_size += st.st_size
+        inode = (st.st_dev, st.st_ino)
+        if st.st_nlink > 1:
+            first = self._hardlinks.get(inode)
+            if first:
+                # Linked once the first path has been written.
+                first_path, seq = first
+                self._defer(seq, os.link, first_path, dest_path)
+                self._record('hf', st.st_size, rel_path)
+                return
+            self._hardlinks[inode] = (dest_path, 0)
+        changed = False
+        base_path = None
+        for link_dir_path in self.link_dir_paths:
+            link_path = link_dir_path + rel_path
+            try:
+                link_st = os.lstat(link_path)
+            except OSError:
+                continue
+            if _is_same_file_in_link_dest(st, link_st):
+                self._try(os.link, link_path, dest_path)
+                return
+            changed = True
+            if base_path is None and stat.S_ISREG(link_st.st_mode):
+                base_path = link_path
+        self.num_transferred += 1
+        self.transferred_size += st.st_size
+        self._record('>f.st......' if changed else '>f+++++++++',
+                     st.st_size, rel_path)
+        if self.reflink and base_path:
+            seq = self._submit(executor, futures, self._reflink_file, st,
+                               src_path, base_path, dest_path)
+        else:
+            seq = self._submit(executor, futures, self._copy_file, st,
+                               src_path, dest_path)
+        if st.st_nlink > 1:
+            self._hardlinks[inode] = (dest_path, seq)
+
+    def copy_paths(self, src_dir, rel_paths):
+        """\
+        Copies only rel_paths (relative to src_dir) into dest_dir_path,
+        where their parent directories must exist already.
+        With reflink, files are cloned from the same paths in
+        link_dir_paths when there.
+        Returns an exit code compatible with the one of rsync.
+        """
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs) as executor:
+            futures = collections.deque()
+            for rel_path in rel_paths:
+                src_path = os.path.join(src_dir, rel_path)
+                try:
+                    st = os.stat(src_path,
+                                 follow_symlinks=self.follow_symlinks)
+                except OSError as e:
+                    self._error('stat', e)
+                    continue
+                self.num_files += 1
+                dest_path = os.path.join(self.dest_dir_path, rel_path)
+                if stat.S_ISLNK(st.st_mode):
+                    self._try(_copy_symlink, st, src_path, dest_path)
+                    continue
+                base_path = self._find_clone_base(rel_path)
+                if base_path:
+                    self._submit(executor, futures, self._reflink_file, st,
+                                 src_path, base_path, dest_path)
+                else:
+                    self._submit(executor, futures, self._copy_file, st,
+                                 src_path, dest_path)
+            self._wait_all(futures)
+        if self.num_errors:
+            return 23
+        return 0
+
+    def _find_clone_base(self, rel_path):
+        if not self.reflink:
+            return None
+        for link_dir_path in self.link_dir_paths:
+            base_path = os.path.join(link_dir_path, rel_path)
+            try:
+                if stat.S_ISREG(os.lstat(base_path).st_mode):
+                    return base_path
+            except OSError:
+                pass
+        return None
+
+    def _copy_file(self, st, src_path, dest_path):
+        tmp_path = _get_native_temp_path(dest_path)
+        if self._try(_copy_file_data, src_path, tmp_path, self.throttle):
+            self._finish_file(st, src_path, tmp_path, dest_path)
+        else:
+            _remove_quietly(tmp_path)
+
+    def _reflink_file(self, st, src_path, base_path, dest_path):
+        tmp_path = _get_native_temp_path(dest_path)
+        try:
+            _clone_file(base_path, tmp_path)
+            written = _rewrite_changed_blocks(src_path, tmp_path,
+                                              self.throttle)
+        except OSError as e:
+            self.logger.debug('Unable to clone "{}" ({}). Copying instead.'
+                              .format(base_path, e))
+            _remove_quietly(tmp_path)
+            self._copy_file(st, src_path, dest_path)
+            return
+        with self._lock:
+            self.num_reflinked += 1
+            self.rewritten_size += written
+        self._finish_file(st, src_path, tmp_path, dest_path)
+
+    def _finish_file(self, st, src_path, tmp_path, dest_path):
+        self._try(_copy_metadata, st, src_path, tmp_path)
+        if not self._try(os.rename, tmp_path, dest_path):
+            _remove_quietly(tmp_path)
+
+    def _record(self, item, size, rel_path):
+        if self.change_stream and self.change_stream.items:
+            self.change_stream.feed('{:<11} {} {}'.format(
+                item, size, rel_path.lstrip('/')))
+
+    def _feed_stats(self):
+        if not self.change_stream:
+            return
+        for line in ['Number of files: {} (reg: {}, dir: {})'
+                     .format(self.num_files, self.num_regular_files,
+                             self.num_dirs),
+                     'Number of regular files transferred: {}'
+                     .format(self.num_transferred),
+                     'Total file size: {} bytes'.format(self.total_size),
+                     'Total transferred file size: {} bytes'
+                     .format(self.transferred_size)]:
+            self.change_stream.feed(line)
+
+
+def _check_reflink(base_dir, logger):
+    """\
+    Returns True when --reflink can clone files in base_dir.
+    """
+    if _probe_reflink(base_dir):
+        return True
+    logger.info('"{}" does not support reflinks.'
+                ' Changed files are copied as a whole.'.format(base_dir))
+    return False
+
+
+def _do_native_backup(src_list, dest_dir_path, link_dir_paths,
+                      included_dirs, excluded_dirs, logger, args,
+                      change_stream=None, throttle=None):
+    '''
+    Same as _do_actual_backup() but with NativeBackup instead of rsync.
+    Returns an exit status code compatible with the one of rsync.
+    '''
+    rsync_filter = RsyncFilter.from_lists(included_dirs, excluded_dirs,
+                                          exclude_from=args.exclude_from)
+    logger.debug('Running native engine with {} threads'
+                 .format(args.native_jobs))
+    reflink = False
+    if args.reflink and link_dir_paths:
+        reflink = _check_reflink(os.path.dirname(dest_dir_path.rstrip('/')),
+                                 logger)
+    backup = NativeBackup(dest_dir_path, link_dir_paths, rsync_filter,
+                          args.native_jobs, change_stream=change_stream,
+                          throttle=throttle, reflink=reflink, logger=logger)
+    exit_code = backup.run(src_list)
+    if reflink:
+        logger.debug('Cloned {} changed files, rewriting {} of {} bytes'
+                     .format(backup.num_reflinked, backup.rewritten_size,
+                             backup.transferred_size))
+    return exit_code
+
+
+def _get_source_manifest_path(base_dir, src):
+    return os.path.join(base_dir, '{}{}{}'.format(
+        _SOURCE_MANIFEST_PREFIX, _get_job_name(src), _SOURCE_MANIFEST_SUFFIX))
+
+
+def _load_source_manifest(path, logger=None):
+    logger = logger or _null_logger
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug('No source manifest available from "{}" ({})'
+                     .format(path, e))
+        return None
+    if manifest.get('version') != _SOURCE_MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _save_source_manifest(path, manifest, logger=None):
+    logger = logger or _null_logger
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8',
+                       compresslevel=1) as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+    except OSError as e:
+        logger.warning('Unable to write source manifest "{}" ({})'
+                       .format(path, e))
+
+
+def _get_filter_digest(included_dirs, excluded_dirs, exclude_from):
+    """\
+    Digest of filter rules. A manifest recorded with other rules
+    does not describe the same set of files.
+    """
+    digest = hashlib.sha1()
+    for x in included_dirs + ['\0'] + excluded_dirs:
+        digest.update(x.encode('utf-8') + b'\0')
+    if exclude_from:
+        with open(exclude_from, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _get_manifest_record(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode,
+            st.st_uid, st.st_gid]
+
+
+class SourceScan:
+    """\
+    Result of _scan_source(): "manifest" describes the source now, and
+    the other lists are paths (relative to the transfer root, without
+    the leading "/") that differ from the previous manifest.
+    """
+
+    def __init__(self):
+        self.dirs = {}
+        self.changed = []
+        self.added = []
+        self.deleted = []
+        self.num_listed_dirs = 0
+        self.num_reused_dirs = 0
+
+
+def _scan_source(src, rsync_filter, old_dirs=None, logger=None):
+    """\
+    Walks src the way rsync -L would see it and compares it with
+    old_dirs, the "dirs" of the previous manifest
+    ({rel_dir: [dir mtime, {name: record}]}).
+
+    A directory whose mtime did not change has the same entries as
+    before, so it is not listed again; only its entries are stat()ed.
+    Without old_dirs, every directory is listed (a verifying walk).
+    """
+    logger = logger or _null_logger
+    old_dirs = old_dirs or {}
+    scan = SourceScan()
+    if src.endswith('/'):
+        prefix = ''
+    else:
+        prefix = '/' + os.path.basename(src)
+    src_dir = src.rstrip('/') or '/'
+    stack = [(src_dir, prefix)]
+    while stack:
+        dir_path, rel_dir = stack.pop()
+        try:
+            dir_st = os.stat(dir_path)
+        except OSError as e:
+            logger.debug('Skipping "{}" ({})'.format(dir_path, e))
+            continue
+        old_mtime, old_entries = old_dirs.get(rel_dir, (None, {}))
+        if old_mtime == dir_st.st_mtime_ns:
+            names = list(old_entries)
+            scan.num_reused_dirs += 1
+        else:
+            try:
+                names = [entry.name for entry in _list_dir_entries(dir_path)]
+            except OSError as e:
+                logger.error('scandir: {}'.format(e))
+                names = []
+            scan.num_listed_dirs += 1
+        entries = {}
+        for name in names:
+            path = os.path.join(dir_path, name)
+            rel_path = rel_dir + '/' + name
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Removed after listing, or a dangling symlink.
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if not is_dir and not stat.S_ISREG(st.st_mode):
+                continue
+            if rsync_filter.is_excluded(rel_path, is_dir):
+                continue
+            record = _get_manifest_record(st)
+            entries[name] = record
+            if is_dir:
+                stack.append((path, rel_path))
+                continue
+            old_record = old_entries.get(name)
+            if old_record is None:
+                scan.added.append(rel_path.lstrip('/'))
+            elif old_record != record:
+                scan.changed.append(rel_path.lstrip('/'))
+        for name, old_record in old_entries.items():
+            if name not in entries:
+                scan.deleted.append((rel_dir + '/' + name).lstrip('/'))
+        scan.dirs[rel_dir] = [dir_st.st_mtime_ns, entries]
+    return scan
+
+
+def _clone_snapshot(prev_dir_path, dest_dir_path, scan, jobs, logger=None):
+    """\
+    Makes dest_dir_path a hardlink copy of prev_dir_path, restricted to
+    directories and unchanged files of scan.dirs.
+    Changed and new files are left for the transfer.
+    Returns the number of errors.
+    """
+    logger = logger or _null_logger
+    modified = set(scan.changed)
+    modified.update(scan.added)
+    errors = []
+
+    def _clone_dir(rel_dir):
+        dest_dir = dest_dir_path + rel_dir
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        for name, record in scan.dirs[rel_dir][1].items():
+            rel_path = rel_dir + '/' + name
+            if stat.S_ISDIR(record[3]) or rel_path.lstrip('/') in modified:
+                continue
+            try:
+                os.link(prev_dir_path + rel_path, dest_dir_path + rel_path)
+            except OSError as e:
+                # e.g. removed from the previous backup by hand.
+                # Transfer it again.
+                logger.debug('Unable to link "{}" ({})'.format(rel_path, e))
+                errors.append(rel_path.lstrip('/'))
+
+    # Parents must exist before their children are made.
+    rel_dirs = sorted(scan.dirs, key=lambda x: x.count('/'))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        depth = None
+        futures = []
+        for rel_dir in rel_dirs:
+            if depth != rel_dir.count('/'):
+                for future in futures:
+                    future.result()
+                futures = []
+                depth = rel_dir.count('/')
+            futures.append(executor.submit(_clone_dir, rel_dir))
+        for future in futures:
+            future.result()
+    return errors
+
+
+def _restore_dir_metadata(src, dest_dir_path, scan):
+    src_dir = src.rstrip('/') or '/'
+    if src.endswith('/'):
+        prefix = ''
+    else:
+        prefix = '/' + os.path.basename(src)
+    for rel_dir in sorted(scan.dirs, key=lambda x: x.count('/'),
+                          reverse=True):
+        src_path = src_dir + rel_dir[len(prefix):]
+        try:
+            _copy_metadata(os.stat(src_path), src_path,
+                           dest_dir_path + rel_dir)
+        except OSError:
+            pass
+
+
+def _feed_scan(change_stream, scan):
+    """\
+    Feeds changes found by _scan_source() into change_stream
+    as if rsync reported them.
+    """
+    num_files = 0
+    num_dirs = 0
+    num_regular_files = 0
+    total_size = 0
+    records = {}
+    for rel_dir, (_, entries) in scan.dirs.items():
+        num_files += 1
+        num_dirs += 1
+        for name, record in entries.items():
+            if stat.S_ISDIR(record[3]):
+                continue
+            num_files += 1
+            num_regular_files += 1
+            total_size += record[0]
+            records[(rel_dir + '/' + name).lstrip('/')] = record
+    transferred_size = 0
+    for item, rel_paths in [('>f+++++++++', scan.added),
+                            ('>f.st......', scan.changed)]:
+        for rel_path in rel_paths:
+            size = records[rel_path][0]
+            transferred_size += size
+            if change_stream.items:
+                change_stream.feed('{} {} {}'.format(item, size, rel_path))
+    if change_stream.items:
+        for rel_path in scan.deleted:
+            change_stream.feed('*deleting   0 {}'.format(rel_path))
+    for line in ['Number of files: {} (reg: {}, dir: {})'
+                 .format(num_files, num_regular_files, num_dirs),
+                 'Number of regular files transferred: {}'
+                 .format(len(scan.added) + len(scan.changed)),
+                 'Total file size: {} bytes'.format(total_size),
+                 'Total transferred file size: {} bytes'
+                 .format(transferred_size)]:
+        change_stream.feed(line)
+
+
+def _do_incremental_transfer(src, dest_dir_path, rel_paths, logger, args,
+                             throttle=None, prev_dir_path=None):
+    """\
+    Copies only rel_paths (relative to the transfer root of src)
+    into dest_dir_path, with rsync --files-from or the native engine.
+    With --reflink, the native engine clones files of prev_dir_path
+    (the previous backup) and rewrites only changed blocks.
+    """
+    src_dir = src.rstrip('/') or '/'
+    if src.endswith('/'):
+        prefix = ''
+    else:
+        prefix = os.path.basename(src) + '/'
+    rel_paths = [x[len(prefix):] for x in rel_paths]
+    if not rel_paths:
+        return 0
+    if args.engine == 'native':
+        reflink = False
+        link_dir_paths = []
+        if args.reflink and prev_dir_path:
+            reflink = _check_reflink(
+                os.path.dirname(dest_dir_path.rstrip('/')), logger)
+            link_dir_paths = [os.path.join(prev_dir_path, prefix)]
+        backup = NativeBackup(os.path.join(dest_dir_path, prefix),
+                              link_dir_paths, None, args.native_jobs,
+                              throttle=throttle, reflink=reflink,
+                              logger=logger)
+        exit_code = backup.copy_paths(src_dir, rel_paths)
+        if reflink:
+            logger.debug('Cloned {} changed files, rewriting {} bytes'
+                         .format(backup.num_reflinked,
+                                 backup.rewritten_size))
+        return exit_code
+    list_fd, list_path = tempfile.mkstemp(prefix='do_backup_files_from.')
+    try:
+        with os.fdopen(list_fd, 'wb') as f:
+            for rel_path in rel_paths:
+                f.write(rel_path.encode('utf-8', 'surrogateescape') + b'\0')
+        return _do_actual_backup(
+            [src_dir + '/'], os.path.join(dest_dir_path, prefix), [],
+            [], [], logger, args, files_from=list_path, throttle=throttle)
+    finally:
+        os.remove(list_path)
+
+
+def _do_incremental_backup(job, dest_dir_path, link_dir_paths,
+                           included_dirs, excluded_dirs, logger, args,
+                           change_stream=None, throttle=None):
+    """\
+    Backs up each SRC of job, cloning the previous backup and transferring
+    only what changed since the manifest recorded by the previous run.
+    A full (verifying) run is done instead when the manifest is not
+    usable or after --full-walk-interval incremental runs.
+    Returns an exit status code merged by _merge_exit_codes().
+    """
+    rsync_filter = RsyncFilter.from_lists(included_dirs, excluded_dirs,
+                                          exclude_from=args.exclude_from)
+    filter_digest = _get_filter_digest(included_dirs, excluded_dirs,
+                                       args.exclude_from)
+    # Name of the backup once published
+    dest_name = os.path.basename(dest_dir_path.rstrip('/'))
+    if dest_name.endswith(_INPROGRESS_SUFFIX):
+        dest_name = dest_name[:-len(_INPROGRESS_SUFFIX)]
+    exit_codes = []
+    for src in job.src_list:
+        manifest_path = _get_source_manifest_path(job.base_dir, src)
+        manifest = _load_source_manifest(manifest_path, logger=logger)
+        reason = None
+        if args.force_full_backup:
+            reason = '--force-full-backup is specified'
+        elif manifest is None:
+            reason = 'no manifest is available'
+        elif (manifest.get('src') != src
+              or manifest.get('filter') != filter_digest):
+            reason = 'SRC or filters changed'
+        elif manifest.get('backup') == dest_name:
+            reason = 'the backup is taken again'
+        elif not os.path.isdir(os.path.join(job.base_dir,
+                                            manifest.get('backup'))):
+            reason = 'the previous backup does not exist'
+        elif manifest.get('runs_since_full', 0) >= args.full_walk_interval:
+            reason = 'it is the time for a periodical full run'
+        if reason:
+            logger.info('Full run for "{}" since {}'.format(src, reason))
+            scan = _scan_source(src, rsync_filter, logger=logger)
+            if args.engine == 'native':
+                exit_code = _do_native_backup(
+                    [src], dest_dir_path, link_dir_paths, included_dirs,
+                    excluded_dirs, logger, args, change_stream=change_stream,
+                    throttle=throttle)
+            else:
+                exit_code = _do_actual_backup(
+                    [src], dest_dir_path, link_dir_paths, included_dirs,
+                    excluded_dirs, logger, args, change_stream=change_stream,
+                    throttle=throttle)
+            runs_since_full = 0
+        else:
+            scan = _scan_source(src, rsync_filter, old_dirs=manifest['dirs'],
+                                logger=logger)
+            logger.info('Incremental run for "{}": {} new, {} changed,'
+                        ' {} deleted ({} of {} directories listed)'
+                        .format(src, len(scan.added), len(scan.changed),
+                                len(scan.deleted), scan.num_listed_dirs,
+                                scan.num_listed_dirs + scan.num_reused_dirs))
+            prev_dir_path = os.path.join(job.base_dir, manifest['backup'])
+            unlinked = _clone_snapshot(prev_dir_path, dest_dir_path, scan,
+                                       args.native_jobs, logger=logger)
+            if change_stream:
+                _feed_scan(change_stream, scan)
+            exit_code = _do_incremental_transfer(
+                src, dest_dir_path, scan.added + scan.changed + unlinked,
+                logger, args, throttle=throttle, prev_dir_path=prev_dir_path)
+            _restore_dir_metadata(src, dest_dir_path, scan)
+            runs_since_full = manifest.get('runs_since_full', 0) + 1
+        exit_codes.append(exit_code)
+        if _is_acceptable_exit_code(exit_code):
+            _save_source_manifest(manifest_path, {
+                'version': _SOURCE_MANIFEST_VERSION,
+                'src': src,
+                'filter': filter_digest,
+                'backup': dest_name,
+                'runs_since_full': runs_since_full,
+                'dirs': scan.dirs}, logger=logger)
+    return _merge_exit_codes(exit_codes)
+
+
+def _get_snapshot_id(path):
+    """\
+    Returns a value that changes whenever the snapshot at path is replaced
+    or updated in place (see _prepare_inprogress_dir()), since rename(2)
+    and setting times of the directory both update its ctime.
+    """
+    st = os.lstat(path)
+    return '{}:{}'.format(st.st_ino, st.st_ctime_ns)
+
+
+def _hash_file(path):
+    """\
+    Returns SHA-256 of the content of path in hex, or None when it cannot
+    be read. Runs in worker processes.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(_HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def _hash_files(paths, jobs):
+    """\
+    Returns SHA-256 of each of paths (see _hash_file()), computed by a pool
+    of jobs processes.
+    """
+    if jobs < 2 or len(paths) < 2:
+        return [_hash_file(x) for x in paths]
+    # Started fresh instead of forked, since threads (e.g. TrashPruner or
+    # jobs of --daemon) may hold locks at the time of fork(2).
+    with multiprocessing.get_context('spawn').Pool(jobs) as pool:
+        return pool.map(_hash_file, paths, chunksize=16)
+
+
+def _get_xattr_digest(path):
+    """\
+    Returns SHA-256 of the extended attributes of path, including POSIX
+    ACLs (stored as "system.posix_acl_*"), '' when it has none, or None
+    when they cannot be read.
+    """
+    if not hasattr(os, 'listxattr'):
+        return ''
+    digest = hashlib.sha256()
+    try:
+        names = sorted(os.listxattr(path, follow_symlinks=False))
+        for name in names:
+            value = os.getxattr(path, name, follow_symlinks=False)
+            digest.update('{}\0{}\0'.format(name, len(value))
+                          .encode('utf-8'))
+            digest.update(value)
+    except OSError as e:
+        if e.errno == errno.ENOTSUP:
+            return ''
+        return None
+    return digest.hexdigest() if names else ''
+
+
+def _get_inode_key(st):
+    return '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_mtime_ns,
+                                st.st_size)
+
+
+def _load_dedup_index(path, logger=None):
+    logger = logger or _null_logger
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug('No dedup index available from "{}" ({})'
+                     .format(path, e))
+        index = None
+    if not index or index.get('version') != _DEDUP_INDEX_VERSION:
+        index = {'version': _DEDUP_INDEX_VERSION, 'snapshots': {},
+                 'files': {}}
+    return index
+
+
+def _save_dedup_index(path, index, logger=None):
+    logger = logger or _null_logger
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8',
+                       compresslevel=1) as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+    except OSError as e:
+        logger.warning('Unable to write dedup index "{}" ({})'
+                       .format(path, e))
+
+
+def _replace_with_link(target_path, path):
+    """\
+    Atomically replaces path with a hardlink to target_path.
+    """
+    tmp_path = '{}.{}.dedup'.format(path, os.getpid())
+    os.link(target_path, tmp_path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+def _dedup_snapshots(base_dir, snapshots, jobs, min_size, logger=None):
+    """\
+    Hardlinks identical files across snapshots, wherever they are.
+    Files are identical when their size, SHA-256, mode, owner, mtime and
+    extended attributes (with ACLs, which -AX preserved) match, so that no
+    snapshot sees different metadata afterwards.
+
+    Only snapshots not scanned by previous runs are walked. Each file of
+    min_size bytes or more is recorded into the index in base_dir, keyed
+    by (dev, inode, mtime, size) with one of its paths, and is hashed
+    (by a pool of jobs processes) only when another file of the same size
+    exists. An inode is relinked only when all of its links were found in
+    the walked snapshots, since otherwise no space would be freed.
+    Returns (files relinked, bytes freed).
+    """
+    logger = logger or _null_logger
+    index_path = os.path.join(base_dir, _DEDUP_INDEX_NAME)
+    index = _load_dedup_index(index_path, logger=logger)
+    snapshot_ids = {}
+    for snapshot in snapshots:
+        try:
+            snapshot_ids[snapshot.name] = _get_snapshot_id(snapshot.path)
+        except OSError:
+            pass
+    scanned = dict((name, snapshot_id)
+                   for name, snapshot_id in index['snapshots'].items()
+                   if snapshot_ids.get(name) == snapshot_id)
+    # key -> [digest, path relative to base_dir, mode, uid, gid,
+    #         digest of xattrs]
+    known = dict((key, value) for key, value in index['files'].items()
+                 if value[1].split('/', 1)[0] in scanned)
+
+    # key -> [stat of the inode, paths]
+    found = {}
+    for snapshot in snapshots:
+        if snapshot.name in scanned or snapshot.name not in snapshot_ids:
+            continue
+        logger.debug('Scanning "{}" for duplicates'.format(snapshot.path))
+        for entry in _walk_files(snapshot.path):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+                continue
+            key = _get_inode_key(st)
+            if key in known:
+                continue
+            if key in found:
+                found[key][1].append(entry.path)
+            else:
+                found[key] = [st, [entry.path]]
+        scanned[snapshot.name] = None
+
+    # Only files sharing their size (and device) with another one
+    # need to be hashed.
+    def _get_bucket(key):
+        dev, _, _, size = key.split(':')
+        return dev, size
+    buckets = collections.Counter(_get_bucket(x) for x in known)
+    buckets.update(_get_bucket(x) for x in found)
+    to_hash = [x for x in list(known) + list(found)
+               if buckets[_get_bucket(x)] > 1
+               and (x in found or known[x][0] is None)]
+    paths = [found[x][1][0] if x in found
+             else os.path.join(base_dir, known[x][1]) for x in to_hash]
+    logger.debug('Hashing {} files with {} processes'
+                 .format(len(paths), jobs))
+    digests = dict(zip(to_hash, _hash_files(paths, jobs)))
+    xattrs = dict((key, _get_xattr_digest(path))
+                  for key, path in zip(to_hash, paths))
+    for key, value in known.items():
+        if key in digests:
+            value[0] = digests[key]
+            value[5] = xattrs[key]
+
+    def _get_identity(key, digest, mode, uid, gid, xattr):
+        dev, _, mtime_ns, size = key.split(':')
+        return dev, size, digest, mode, uid, gid, mtime_ns, xattr
+    # identity -> (key, path) of the inode others are linked to
+    canonical = {}
+    for key, (digest, rel_path, mode, uid, gid, xattr) in known.items():
+        # xattr is None when unreadable, so that nothing is linked.
+        if digest and xattr is not None:
+            canonical.setdefault(
+                _get_identity(key, digest, mode, uid, gid, xattr),
+                (key, os.path.join(base_dir, rel_path)))
+
+    num_files = 0
+    num_bytes = 0
+    # Parent directories whose times are restored after relinking
+    dir_stats = {}
+    # Names of snapshots where files were relinked
+    touched = set()
+    for key in sorted(found):
+        st, inode_paths = found[key]
+        digest = digests.get(key)
+        xattr = xattrs.get(key)
+        identity = _get_identity(key, digest, st.st_mode, st.st_uid,
+                                 st.st_gid, xattr)
+        target_key, target_path = canonical.get(identity, (None, None))
+        if (digest and xattr is not None and target_key and target_key != key
+                and len(inode_paths) == st.st_nlink):
+            try:
+                target_st = os.lstat(target_path)
+            except OSError:
+                target_st = None
+            if target_st and _get_inode_key(target_st) == target_key:
+                while inode_paths:
+                    path = inode_paths[0]
+                    parent = os.path.dirname(path)
+                    try:
+                        if parent not in dir_stats:
+                            dir_stats[parent] = os.lstat(parent)
+                        _replace_with_link(target_path, path)
+                        touched.add(os.path.relpath(path, base_dir)
+                                    .split(os.sep, 1)[0])
+                    except OSError as e:
+                        # e.g. EMLINK
+                        logger.debug('Unable to link "{}" to "{}" ({})'
+                                     .format(path, target_path, e))
+                        break
+                    inode_paths.pop(0)
+                    num_files += 1
+                if not inode_paths:
+                    num_bytes += st.st_size
+                    continue
+        if digest and xattr is not None:
+            canonical.setdefault(identity, (key, inode_paths[0]))
+        known[key] = [digest, os.path.relpath(inode_paths[0], base_dir),
+                      st.st_mode, st.st_uid, st.st_gid, xattr]
+    for parent, st in dir_stats.items():
+        try:
+            os.utime(parent, ns=(st.st_atime_ns, st.st_mtime_ns))
+        except OSError:
+            pass
+    _discard_report_caches(base_dir, touched)
+    # Restoring times of directories changes ids of snapshots.
+    paths = dict((s.name, s.path) for s in snapshots)
+    for name in scanned:
+        if scanned[name] is None or name in touched:
+            scanned[name] = _get_snapshot_id(paths[name])
+    _save_dedup_index(index_path, {'version': _DEDUP_INDEX_VERSION,
+                                   'snapshots': scanned,
+                                   'files': known}, logger=logger)
+    return num_files, num_bytes
+
+
+def _load_verify_db(path, logger=None):
+    logger = logger or _null_logger
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            db = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug('No checksum database available from "{}" ({})'
+                     .format(path, e))
+        db = None
+    if not db or db.get('version') != _VERIFY_DB_VERSION:
+        db = {'version': _VERIFY_DB_VERSION, 'snapshots': {}, 'inodes': {}}
+    return db
+
+
+def _save_verify_db(path, db, logger=None):
+    logger = logger or _null_logger
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8',
+                       compresslevel=1) as f:
+            json.dump(db, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+    except OSError as e:
+        logger.warning('Unable to write checksum database "{}" ({})'
+                       .format(path, e))
+
+
+def _verify_snapshots(base_dir, snapshots, db_path, jobs, interval, now,
+                      logger=None):
+    """\
+    Checks that files in snapshots still have the content they had when
+    this was run for the first time after they appeared.
+
+    The database at db_path has a SHA-256 for each inode ("dev:ino"),
+    together with its mtime, size, when it was verified last, and a path
+    (in the newest snapshot where it was found).
+    Since unchanged files are hardlinks shared by snapshots, each inode is
+    hashed once for all of them. Only snapshots not walked by previous runs
+    are walked, to find new inodes. Known inodes are verified again
+    when interval (sec) passed since the last verification; the first
+    verification of each inode is put back by a part of interval derived
+    from its checksum, so that re-verification is spread over runs.
+    Hashing is done by a pool of jobs processes.
+    Returns (number of verified inodes, list of corrupted or unreadable
+    paths).
+    """
+    logger = logger or _null_logger
+    db = _load_verify_db(db_path, logger=logger)
+    snapshot_ids = {}
+    for snapshot in snapshots:
+        try:
+            snapshot_ids[snapshot.name] = _get_snapshot_id(snapshot.path)
+        except OSError:
+            pass
+    walked = dict((name, snapshot_id)
+                  for name, snapshot_id in db['snapshots'].items()
+                  if snapshot_ids.get(name) == snapshot_id)
+    # "dev:ino" -> [mtime_ns, size, digest, verified_at, path from base_dir]
+    inodes = dict((key, value) for key, value in db['inodes'].items()
+                  if value[4].split('/', 1)[0] in walked)
+
+    new_inodes = {}
+    moved = set()
+    # Newest first, so that each path lives as long as possible.
+    for snapshot in snapshots:
+        if snapshot.name in walked or snapshot.name not in snapshot_ids:
+            continue
+        logger.debug('Listing files in "{}"'.format(snapshot.path))
+        for entry in _walk_files(snapshot.path):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            key = '{}:{}'.format(st.st_dev, st.st_ino)
+            record = inodes.get(key)
+            if record and record[:2] == [st.st_mtime_ns, st.st_size]:
+                if key not in moved:
+                    record[4] = os.path.relpath(entry.path, base_dir)
+                    moved.add(key)
+                continue
+            if key not in new_inodes:
+                # Also the case of an inode number reused for another file
+                new_inodes[key] = [st.st_mtime_ns, st.st_size, None, None,
+                                   os.path.relpath(entry.path, base_dir)]
+        walked[snapshot.name] = snapshot_ids[snapshot.name]
+
+    due = []
+    bad_paths = []
+    for key, record in list(inodes.items()):
+        if key in new_inodes or record[3] > now - interval:
+            continue
+        try:
+            st = os.lstat(os.path.join(base_dir, record[4]))
+        except OSError:
+            st = None
+        if not st or '{}:{}'.format(st.st_dev, st.st_ino) != key:
+            # e.g. replaced by --dedup
+            logger.debug('"{}" is not the file verified before'
+                         .format(record[4]))
+            del inodes[key]
+        elif [st.st_mtime_ns, st.st_size] != record[:2]:
+            bad_paths.append(record[4])
+            logger.error('"{}" was modified in place'.format(record[4]))
+        else:
+            due.append(key)
+    keys = list(new_inodes) + due
+    logger.info('Verifying {} new and {} known files with {} processes'
+                .format(len(new_inodes), len(due), jobs))
+    digests = _hash_files([os.path.join(base_dir, (new_inodes.get(x)
+                                                   or inodes[x])[4])
+                           for x in keys], jobs)
+    for key, digest in zip(keys, digests):
+        if key in new_inodes:
+            record = new_inodes[key]
+            if digest is None:
+                bad_paths.append(record[4])
+                logger.error('Unable to read "{}"'.format(record[4]))
+                continue
+            record[2] = digest
+            record[3] = now - int(digest[:8], 16) % max(1, int(interval))
+            inodes[key] = record
+            continue
+        record = inodes[key]
+        if digest == record[2]:
+            record[3] = now
+            continue
+        bad_paths.append(record[4])
+        if digest is None:
+            logger.error('Unable to read "{}"'.format(record[4]))
+        else:
+            # The checksum recorded is kept, so that this is reported
+            # again until the file is repaired.
+            logger.error('"{}" is corrupted (SHA-256 {} while {} expected)'
+                         .format(record[4], digest, record[2]))
+    _save_verify_db(db_path, {'version': _VERIFY_DB_VERSION,
+                              'snapshots': walked,
+                              'inodes': inodes}, logger=logger)
+    return len(keys), bad_paths
+
+
+def _get_report_cache_path(base_dir, name):
+    return os.path.join(base_dir, _REPORT_CACHE_DIR_NAME,
+                        name + _REPORT_CACHE_SUFFIX)
+
+
+def _scan_inodes(top, jobs):
+    """\
+    Returns {"dev:ino": bytes on disk} of everything under top (including
+    top itself), listing directories in a pool of jobs threads.
+    """
+    def _list(dir_path):
+        sub_dirs = []
+        inodes = {}
+        try:
+            entries = _list_dir_entries(dir_path)
+        except OSError:
+            return sub_dirs, inodes
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            inodes['{}:{}'.format(st.st_dev, st.st_ino)] = st.st_blocks * 512
+            if stat.S_ISDIR(st.st_mode):
+                sub_dirs.append(entry.path)
+        return sub_dirs, inodes
+
+    st = os.lstat(top)
+    found = {'{}:{}'.format(st.st_dev, st.st_ino): st.st_blocks * 512}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = set([executor.submit(_list, top)])
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                sub_dirs, inodes = future.result()
+                found.update(inodes)
+                pending.update(executor.submit(_list, x) for x in sub_dirs)
+    return found
+
+
+def _load_snapshot_inodes(snapshot, jobs, logger=None):
+    """\
+    Returns inodes of snapshot (see _scan_inodes()), from its cache
+    when the snapshot has been neither replaced nor updated in place
+    since then (see _get_snapshot_id()).
+    """
+    logger = logger or _null_logger
+    base_dir = os.path.dirname(snapshot.path)
+    cache_path = _get_report_cache_path(base_dir, snapshot.name)
+    snapshot_id = _get_snapshot_id(snapshot.path)
+    try:
+        with gzip.open(cache_path, 'rt', encoding='utf-8') as f:
+            cache = json.load(f)
+        if (cache.get('version') == _REPORT_CACHE_VERSION
+                and cache.get('id') == snapshot_id):
+            return cache['inodes']
+    except (OSError, ValueError):
+        pass
+    logger.debug('Scanning "{}"'.format(snapshot.path))
+    inodes = _scan_inodes(snapshot.path, jobs)
+    cache_dir = os.path.dirname(cache_path)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        if not os.path.isdir(cache_dir):
+            os.mkdir(cache_dir)
+        with gzip.open(tmp_path, 'wt', encoding='utf-8',
+                       compresslevel=1) as f:
+            json.dump({'version': _REPORT_CACHE_VERSION,
+                       'id': snapshot_id,
+                       'inodes': inodes}, f, separators=(',', ':'))
+        os.rename(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning('Unable to write report cache "{}" ({})'
+                       .format(cache_path, e))
+    return inodes
+
+
+def _discard_report_caches(base_dir, names):
+    for name in names:
+        try:
+            os.unlink(_get_report_cache_path(base_dir, name))
+        except OSError:
+            pass
+
+
+def _report_space(base_dir, snapshots, jobs, logger=None):
+    """\
+    Attributes disk usage of each inode to the snapshots referencing it.
+    Returns a list of (snapshot, unique bytes, shared bytes), where unique
+    bytes are the ones freed by removing the snapshot alone.
+    Only snapshots without a valid cache in base_dir are scanned.
+    """
+    logger = logger or _null_logger
+    snapshot_inodes = []
+    for snapshot in snapshots:
+        snapshot_inodes.append(_load_snapshot_inodes(snapshot, jobs,
+                                                     logger=logger))
+    cache_dir = os.path.join(base_dir, _REPORT_CACHE_DIR_NAME)
+    if os.path.isdir(cache_dir):
+        names = set(s.name + _REPORT_CACHE_SUFFIX for s in snapshots)
+        for entry in _list_dir_entries(cache_dir):
+            if entry.name not in names:
+                logger.debug('Removing stale cache "{}"'.format(entry.path))
+                os.unlink(entry.path)
+    references = collections.Counter()
+    for inodes in snapshot_inodes:
+        references.update(inodes.keys())
+    results = []
+    for snapshot, inodes in zip(snapshots, snapshot_inodes):
+        unique = 0
+        shared = 0
+        for key, num_bytes in inodes.items():
+            if references[key] > 1:
+                shared += num_bytes
+            else:
+                unique += num_bytes
+        results.append((snapshot, unique, shared))
+    return results
+
+
+class ChunkedGzipWriter:
+    """\
+    Write-only file object compressing data into gzip members of
+    chunk_size (uncompressed) bytes each, in a pool of jobs threads
+    (zlib releases the GIL). The result is an ordinary gzip file.
+
+    "chunks" lists (uncompressed offset, compressed offset) of each member,
+    from which decompression can start without reading what precedes it.
+    """
+
+    def __init__(self, fileobj, jobs, chunk_size=_ARCHIVE_CHUNK_SIZE,
+                 level=_DEFAULT_ARCHIVE_LEVEL):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.level = level
+        self.chunks = []
+        self._buffer = []
+        self._buffered = 0
+        self._offset = 0
+        self._compressed_offset = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs)
+        self._max_pending = jobs * 2
+        self._pending = collections.deque()
+
+    def tell(self):
+        return self._offset + self._buffered
+
+    def write(self, data):
+        self._buffer.append(bytes(data))
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if not data:
+            return
+        self._pending.append((self._offset, self._executor.submit(
+            gzip.compress, data, self.level, mtime=0)))
+        self._offset += len(data)
+        while len(self._pending) > self._max_pending:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        offset, future = self._pending.popleft()
+        compressed = future.result()
+        self.chunks.append((offset, self._compressed_offset))
+        self.fileobj.write(compressed)
+        self._compressed_offset += len(compressed)
+
+    def close(self):
+        self._submit()
+        while self._pending:
+            self._write_oldest()
+        self._executor.shutdown()
+
+
+class _ChunkedGzipReader:
+    """\
+    Read-only file object decompressing a file written by ChunkedGzipWriter
+    from the gzip member at compressed_offset on.
+    """
+
+    def __init__(self, fileobj, compressed_offset):
+        self.fileobj = fileobj
+        self.fileobj.seek(compressed_offset)
+        self._decompressor = zlib.decompressobj(31)
+        self._data = b''
+
+    def _fill(self):
+        raw = self.fileobj.read(_PUMP_CHUNK_SIZE)
+        while raw:
+            self._data += self._decompressor.decompress(raw)
+            if not self._decompressor.eof:
+                return True
+            # The next gzip member starts in the rest.
+            raw = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(31)
+        return False
+
+    def read(self, size=-1):
+        while size < 0 or len(self._data) < size:
+            if not self._fill():
+                break
+        if size < 0:
+            size = len(self._data)
+        data, self._data = self._data[:size], self._data[size:]
+        return data
+
+
+def _get_archive_paths(archive_dir, name):
+    """\
+    Returns paths of the archive of a backup and its member index.
+    """
+    path = os.path.join(archive_dir, name + _ARCHIVE_SUFFIX)
+    return path, path + _ARCHIVE_INDEX_SUFFIX
+
+
+def _get_xattr_pax_headers(path):
+    if not hasattr(os, 'listxattr'):
+        return {}
+    headers = {}
+    try:
+        for name in os.listxattr(path, follow_symlinks=False):
+            value = os.getxattr(path, name, follow_symlinks=False)
+            # tarfile marks the header binary when this is not UTF-8.
+            headers['SCHILY.xattr.' + name] = value.decode(
+                'utf-8', 'surrogateescape')
+    except OSError:
+        pass
+    return headers
+
+
+def _archive_snapshot(snapshot, archive_dir, jobs, level, logger=None):
+    """\
+    Streams snapshot into a gzipped tar in archive_dir, compressed on
+    jobs threads. Hardlinks inside the snapshot stay hardlinks (tar
+    LNKTYPE members), and xattrs (including ACLs) are stored as
+    SCHILY.xattr PAX headers.
+
+    Also writes the member index: offsets of each member in the tar
+    stream and of each gzip member in the archive, so that a single file
+    can be extracted by decompressing a chunk or two
+    (see _open_archive_member()).
+    Returns the path of the archive.
+    """
+    logger = logger or _null_logger
+    archive_path, index_path = _get_archive_paths(archive_dir, snapshot.name)
+    tmp_path = '{}.{}.tmp'.format(archive_path, os.getpid())
+    index_tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    try:
+        num_members = _write_archive(snapshot, tmp_path, index_tmp_path,
+                                     jobs, level)
+        os.rename(index_tmp_path, index_path)
+        os.rename(tmp_path, archive_path)
+    except BaseException:
+        for path in [tmp_path, index_tmp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    logger.debug('Archived {} members of "{}" into "{}"'
+                 .format(num_members, snapshot.path, archive_path))
+    return archive_path
+
+
+def _write_archive(snapshot, tmp_path, index_tmp_path, jobs, level):
+    """\
+    Writes the archive and the member index of _archive_snapshot() into
+    temporary paths. Returns the number of members.
+    """
+    members = []
+    with open(tmp_path, 'wb') as f:
+        writer = ChunkedGzipWriter(f, jobs, level=level)
+        tar = tarfile.open(fileobj=writer, mode='w',
+                           format=tarfile.PAX_FORMAT)
+        stack = [(snapshot.path, snapshot.name)]
+        while stack:
+            path, arcname = stack.pop()
+            tarinfo = tar.gettarinfo(path, arcname)
+            if tarinfo is None:
+                # Sockets and such, which rsync does not copy anyway.
+                continue
+            tarinfo.pax_headers = _get_xattr_pax_headers(path)
+            offset = tar.offset
+            if tarinfo.isreg():
+                with open(path, 'rb') as member_f:
+                    tar.addfile(tarinfo, member_f)
+            else:
+                tar.addfile(tarinfo)
+            # Hardlinks have no data in tar but are listed with the size
+            # of the file, as --restore shows it.
+            size = os.lstat(path).st_size if tarinfo.islnk() else tarinfo.size
+            members.append([tarinfo.name, offset, size,
+                            tarinfo.type.decode('ascii'), tarinfo.mtime])
+            if tarinfo.isdir():
+                entries = sorted(_list_dir_entries(path),
+                                 key=lambda x: x.name, reverse=True)
+                stack.extend((x.path, arcname + '/' + x.name)
+                             for x in entries)
+        tar.close()
+        writer.close()
+        f.flush()
+        os.fsync(f.fileno())
+    with gzip.open(index_tmp_path, 'wt', encoding='utf-8',
+                   compresslevel=1) as f:
+        json.dump({'version': _ARCHIVE_INDEX_VERSION,
+                   'chunks': writer.chunks,
+                   'members': members}, f, separators=(',', ':'))
+    return len(members)
+
+
+def _load_archive_index(index_path):
+    """\
+    Returns the member index of an archive as
+    (chunks, {name: (offset, size, type, mtime)}), or raises AppException.
+    """
+    try:
+        with gzip.open(index_path, 'rt', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError) as e:
+        raise AppException('Unable to read archive index "{}" ({})'
+                           .format(index_path, e))
+    if index.get('version') != _ARCHIVE_INDEX_VERSION:
+        raise AppException('Unknown archive index "{}"'.format(index_path))
+    return index['chunks'], dict((x[0], x[1:]) for x in index['members'])
+
+
+@contextlib.contextmanager
+def _open_archive_member(archive_path, chunks, offset):
+    """\
+    Yields (tar, tarinfo) of the member whose header starts at offset
+    of the tar stream, decompressing only from the chunk containing it.
+    """
+    position = bisect.bisect_right([x[0] for x in chunks], offset) - 1
+    chunk_offset, compressed_offset = chunks[max(position, 0)]
+    with open(archive_path, 'rb') as f:
+        reader = _ChunkedGzipReader(f, compressed_offset)
+        skip = offset - chunk_offset
+        while skip > 0:
+            skipped = len(reader.read(min(skip, _PUMP_CHUNK_SIZE)))
+            if not skipped:
+                break
+            skip -= skipped
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        try:
+            yield tar, tar.next()
+        finally:
+            tar.close()
+
+
+def _archive_old_backups(today, catalog, archive_after, archive_dir, jobs,
+                         level, hourly, logger=None):
+    """\
+    Archives backups older than archive_after (days, or hours when
+    hourly) into archive_dir, then removes them from base_dir and the
+    catalog. Change manifests are moved next to the archives.
+    The newest backup is never archived, as it is the base of --link-dest.
+    A failure (ENOSPC and such) is logged, leaving the backup as is and
+    the rest for the next run.
+    Returns the number of backups archived.
+    """
+    logger = logger or _null_logger
+    boundary = _get_expiration_boundary(today, catalog.dir_format,
+                                        archive_after, hourly)
+    if boundary is None:
+        logger.warning('Unable to determine which backups are old'
+                       ' with dir-format "{}"'.format(catalog.dir_format))
+        return 0
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    snapshots = list(catalog)[1:]
+    num_archived = 0
+    for snapshot in reversed(catalog.not_newer_than(boundary)):
+        if snapshot not in snapshots:
+            continue
+        logger.info('Archiving "{}"'.format(snapshot.path))
+        try:
+            _archive_snapshot(snapshot, archive_dir, jobs, level,
+                              logger=logger)
+        except (OSError, tarfile.TarError) as e:
+            logger.error('Failed to archive "{}" ({})'
+                         .format(snapshot.path, e))
+            break
+        manifest_path = _get_change_manifest_path(snapshot.path)
+        if os.path.exists(manifest_path):
+            os.rename(manifest_path, os.path.join(
+                archive_dir, os.path.basename(manifest_path)))
+        _remove_backups([snapshot], catalog, jobs=jobs, logger=logger)
+        num_archived += 1
+    return num_archived
+
+
+def _remove_archives(snapshots, logger=None):
+    """\
+    Removes archived backups (see _find_archived_snapshots()).
+    Returns the number of them.
+    """
+    logger = logger or _null_logger
+    for snapshot in snapshots:
+        logger.info('Removing archive "{}"'.format(snapshot.path))
+        _remove_archive(snapshot, logger=logger)
+    return len(snapshots)
+
+
+def _remove_archive(snapshot, logger=None):
+    """\
+    Removes an archived backup (see _find_archived_snapshots()) with its
+    member index and change manifest.
+    """
+    logger = logger or _null_logger
+    archive_dir = os.path.dirname(snapshot.path)
+    paths = list(_get_archive_paths(archive_dir, snapshot.name))
+    paths.append(_get_change_manifest_path(
+        os.path.join(archive_dir, snapshot.name)))
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning('Failed to remove "{}" ({})'.format(path, e))
+
+
+def _find_archived_snapshots(archive_dir, dir_format):
+    """\
+    Returns backups archived in archive_dir as Snapshot, whose path is
+    the one of the archive, sorted from the newest to the oldest.
+    """
+    pattern = _get_dir_name_pattern(dir_format)
+    snapshots = []
+    try:
+        entries = _list_dir_entries(archive_dir)
+    except OSError:
+        return []
+    for entry in entries:
+        if not entry.name.endswith(_ARCHIVE_SUFFIX):
+            continue
+        name = entry.name[:-len(_ARCHIVE_SUFFIX)]
+        thatday = _parse_backup_dir_name(name, pattern)
+        if thatday is not None:
+            snapshots.append(Snapshot(name, entry.path, thatday))
+    return sorted(snapshots, key=lambda x: x.timestamp, reverse=True)
+
+
+def _get_file_kind(mode):
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    if stat.S_ISREG(mode):
+        return 'file'
+    if stat.S_ISLNK(mode):
+        return 'symlink'
+    return 'other'
+
+
+def _find_versions(snapshots, archived, rel_path, logger=None):
+    """\
+    Returns FileVersion of rel_path in each of snapshots and archived
+    (backups in archive_dir, see _find_archived_snapshots()) having it,
+    from the newest to the oldest.
+
+    The catalog already is an index of backups, and each backup is an
+    index of paths, so this costs an lstat() per backup and the member
+    index of each archive, without reading any directory.
+    """
+    logger = logger or _null_logger
+    versions = []
+    for snapshot in snapshots:
+        try:
+            st = os.lstat(os.path.join(snapshot.path, rel_path))
+        except OSError:
+            continue
+        versions.append(FileVersion(snapshot, (st.st_dev, st.st_ino),
+                                    st.st_mtime, st.st_size,
+                                    _get_file_kind(st.st_mode), False))
+    for snapshot in archived:
+        _, index_path = _get_archive_paths(os.path.dirname(snapshot.path),
+                                           snapshot.name)
+        try:
+            _, members = _load_archive_index(index_path)
+        except AppException as e:
+            logger.warning(str(e))
+            continue
+        member = members.get(snapshot.name + '/' + rel_path)
+        if member is None:
+            continue
+        _, size, member_type = member[:3]
+        mtime = member[3] if len(member) > 3 else None
+        versions.append(FileVersion(snapshot, None, mtime, size,
+                                    _TAR_FILE_KINDS.get(member_type, 'other'),
+                                    True))
+    return sorted(versions, key=lambda x: x.snapshot.timestamp, reverse=True)
+
+
+def _get_distinct_versions(versions):
+    """\
+    Collapses consecutive versions with the same kind, size and mtime,
+    which rsync would have hardlinked.
+    Returns [(oldest FileVersion, number of backups)], oldest first.
+    """
+    results = []
+    for version in reversed(versions):
+        key = (version.kind, version.size,
+               None if version.mtime is None else int(version.mtime))
+        if results:
+            last, count = results[-1]
+            if key == (last.kind, last.size,
+                       None if last.mtime is None else int(last.mtime)):
+                results[-1] = (last, count + 1)
+                continue
+        results.append((version, 1))
+    return results
+
+
+def _select_version(versions, name=None, before=None):
+    """\
+    Returns the version in the backup named name, or the newest one
+    taken before the datetime before, or the newest one.
+    None when nothing matches.
+    """
+    for version in versions:
+        if name is not None and version.snapshot.name != name:
+            continue
+        if before is not None and version.snapshot.timestamp >= before:
+            continue
+        return version
+    return None
+
+
+def _apply_tar_metadata(tarinfo, path):
+    """\
+    Same as _copy_metadata() for a member extracted from an archive.
+    """
+    if os.geteuid() == 0:
+        os.lchown(path, tarinfo.uid, tarinfo.gid)
+    if tarinfo.issym():
+        return
+    os.chmod(path, tarinfo.mode)
+    for key, value in tarinfo.pax_headers.items():
+        if key.startswith('SCHILY.xattr.') and hasattr(os, 'setxattr'):
+            try:
+                os.setxattr(path, key[len('SCHILY.xattr.'):],
+                            value.encode('utf-8', 'surrogateescape'))
+            except OSError:
+                pass
+    os.utime(path, (tarinfo.mtime, tarinfo.mtime))
+
+
+def _restore_from_archive(snapshot, rel_path, dest_path, logger=None):
+    """\
+    Extracts rel_path of an archived backup (and everything under it)
+    to dest_path. Members of a subtree are contiguous in the archive,
+    so decompression starts at the chunk containing rel_path and stops
+    right after the subtree.
+    Hardlinks to files outside the subtree are extracted from where the
+    file is stored. Returns the number of errors.
+    """
+    logger = logger or _null_logger
+    archive_path, index_path = _get_archive_paths(
+        os.path.dirname(snapshot.path), snapshot.name)
+    chunks, members = _load_archive_index(index_path)
+    name = snapshot.name + '/' + rel_path
+    if name not in members:
+        raise AppException('"{}" is not in "{}"'.format(rel_path,
+                                                        archive_path))
+    num_errors = 0
+    dirs = []
+    # link name of a file outside the subtree -> path extracted first
+    outside = {}
+
+    def _get_dest_path(member_name):
+        if member_name == name or member_name.startswith(name + '/'):
+            return dest_path + member_name[len(name):]
+        return None
+
+    def _extract(tar, tarinfo, path):
+        if tarinfo.isdir():
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            dirs.append((tarinfo, path))
+            return
+        if tarinfo.issym():
+            os.symlink(tarinfo.linkname, path)
+        elif tarinfo.islnk():
+            link_path = (_get_dest_path(tarinfo.linkname)
+                         or outside.get(tarinfo.linkname))
+            if link_path:
+                os.link(link_path, path)
+                return
+            offset = members[tarinfo.linkname][0]
+            with _open_archive_member(archive_path, chunks,
+                                      offset) as (link_tar, link_info):
+                _extract(link_tar, link_info, path)
+            outside[tarinfo.linkname] = path
+            return
+        elif tarinfo.isreg():
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(tarinfo), f,
+                                   _NATIVE_COPY_CHUNK_SIZE)
         else:
-            logger.debug('Did not found a precedent backup.'
-                         ' Will do full-backup')
-    included_dirs = _DEFAULT_INCLUDED_DIR
-    if args.include:
-        included_dirs.extend(args.include)
-    excluded_dirs = _DEFAULT_EXCLUDED_DIR
-    if args.exclude:
-        excluded_dirs.extend(args.exclude)
-    logger.debug('included files: {}'.format(', '.join(included_dirs)))
-    logger.debug('excluded files: {}'.format(', '.join(excluded_dirs)))
-    exit_code = _do_actual_backup(args.src, dest_dir_path, link_dir_path,
-                                  included_dirs, excluded_dirs, logger, args)
+            return
+        _apply_tar_metadata(tarinfo, path)
+
+    num_files = 0
+    with _open_archive_member(archive_path, chunks,
+                              members[name][0]) as (tar, tarinfo):
+        while tarinfo is not None:
+            path = _get_dest_path(tarinfo.name)
+            if path is None:
+                break
+            num_files += 1
+            try:
+                _extract(tar, tarinfo, path)
+            except (OSError, KeyError) as e:
+                logger.error('Failed to extract "{}" ({})'
+                             .format(tarinfo.name, e))
+                num_errors += 1
+            tarinfo = tar.next()
+    for tarinfo, path in reversed(dirs):
+        try:
+            _apply_tar_metadata(tarinfo, path)
+        except OSError as e:
+            logger.error('Failed to restore "{}" ({})'.format(path, e))
+            num_errors += 1
+    logger.debug('Extracted {} members from "{}"'
+                 .format(num_files, archive_path))
+    return num_errors
+
+
+def _restore_version(version, rel_path, dest_path, jobs, logger=None):
+    """\
+    Copies rel_path of the backup of version to dest_path, keeping
+    hardlinks inside it, permissions, ACLs and xattrs as "rsync -aAHX"
+    does. Files are copied by jobs threads.
+    Returns True when everything was restored.
+    """
+    logger = logger or _null_logger
+    dest_dir_path = os.path.dirname(dest_path)
+    if not os.path.isdir(dest_dir_path):
+        os.makedirs(dest_dir_path)
+    if version.archived:
+        return not _restore_from_archive(version.snapshot, rel_path,
+                                         dest_path, logger=logger)
+    src_path = os.path.join(version.snapshot.path, rel_path)
+    backup = NativeBackup(dest_dir_path, [], RsyncFilter([]), jobs,
+                          follow_symlinks=False, logger=logger)
+    if version.kind == 'dir':
+        exit_code = backup.run([src_path])
+    else:
+        exit_code = backup.copy_paths(os.path.dirname(src_path),
+                                      [os.path.basename(src_path)])
+    logger.debug('Copied {} files from "{}"'
+                 .format(backup.num_files, src_path))
+    return exit_code == 0
+
+
+class RunMetrics:
+    """\
+    Wall time of each phase and other figures of a run, which are
+    exported by --metrics-file. Each entry is scoped by the base_dir
+    of the job it belongs to.
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.values = collections.OrderedDict()
+        self.rsync_stats = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, scope, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            with self._lock:
+                self.phases[(scope, name)] = (
+                    self.phases.get((scope, name), 0.0) + elapsed)
+
+    def set(self, scope, name, value):
+        with self._lock:
+            self.values[(scope, name)] = value
+
+    def set_rsync_stats(self, scope, stats):
+        with self._lock:
+            for key, value in stats.items():
+                self.rsync_stats[(scope, key)] = value
+
+
+def _escape_prometheus_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_prometheus_metrics(metrics, successful, start_time, elapsed):
+    lines = []
+
+    def _add(name, help_text, samples):
+        lines.append('# HELP do_backup_{} {}'.format(name, help_text))
+        lines.append('# TYPE do_backup_{} gauge'.format(name))
+        for labels, value in samples:
+            label_str = ','.join('{}="{}"'.format(
+                k, _escape_prometheus_label(str(v))) for k, v in labels)
+            lines.append('do_backup_{}{} {}'.format(
+                name, '{' + label_str + '}' if label_str else '', value))
+
+    _add('last_run_timestamp_seconds', 'Time the last run started.',
+         [((), start_time)])
+    _add('last_run_duration_seconds', 'Wall time of the last run.',
+         [((), elapsed)])
+    _add('last_run_success', 'Whether the last run succeeded.',
+         [((), int(bool(successful)))])
+    _add('phase_seconds', 'Wall time of each phase of the last run.',
+         [((('base_dir', scope), ('phase', name)), value)
+          for (scope, name), value in metrics.phases.items()])
+    names = []
+    for _, name in metrics.values:
+        if name not in names:
+            names.append(name)
+    for name in names:
+        _add(name, name.replace('_', ' ').capitalize() + '.',
+             [((('base_dir', scope),), value)
+              for (scope, n), value in metrics.values.items() if n == name])
+    _add('rsync_stat', 'Figures reported by rsync --stats.',
+         [((('base_dir', scope), ('stat', name)), value)
+          for (scope, name), value in metrics.rsync_stats.items()])
+    return '\n'.join(lines) + '\n'
+
+
+def _format_json_metrics(metrics, successful, start_time, elapsed):
+    jobs = collections.OrderedDict()
+    for attr in ['phases', 'values', 'rsync_stats']:
+        for (scope, name), value in getattr(metrics, attr).items():
+            job = jobs.setdefault(scope, collections.OrderedDict(
+                [('phases', {}), ('values', {}), ('rsync_stats', {})]))
+            job[attr][name] = value
+    return json.dumps(collections.OrderedDict(
+        [('start_time', start_time),
+         ('elapsed', elapsed),
+         ('successful', bool(successful)),
+         ('version', Version),
+         ('jobs', jobs)]), indent=2) + '\n'
+
+
+def _write_metrics_file(path, metrics, successful, start_time, elapsed):
+    """\
+    Writes metrics atomically, in the Prometheus text format when path
+    ends with ".prom" (for node_exporter's textfile collector)
+    or in JSON otherwise.
+    """
+    if path.endswith('.prom'):
+        content = _format_prometheus_metrics(metrics, successful,
+                                             start_time, elapsed)
+    else:
+        content = _format_json_metrics(metrics, successful,
+                                       start_time, elapsed)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+
+def _is_acceptable_exit_code(exit_code):
     # On most cases, "ret" will never be 0 (Success), since rsync reports
     # failure when even a single file copy fails.
     # Here, we want to know if the rsync connection is established
@@ -458,7 +4769,559 @@ def _main_inter(args, logger):
     # Ok values (see also rsync(1))
     # 0 ... Success
     # 23 ... Partial transfer due to error
-    if exit_code not in [0, 23]:
+    return exit_code in [0, 23]
+
+
+def _get_job_name(src):
+    """\
+    Returns a name usable as a directory name for the job backing up src.
+    e.g. "example.com:/opt" -> "example.com_opt", "/" -> "root"
+    """
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', src).strip('_') or 'root'
+
+
+def _prepare_jobs(args):
+    """\
+    Without --jobs, all SRC are backed up by a single job into base_dir.
+    With --jobs, each SRC becomes a job with its own directory
+    under base_dir. Modes not needing SRC (--prune-only and such) run
+    on every job directory found under base_dir instead.
+    """
+    if not args.jobs:
+        return [Job(None, args.src, args.base_dir)]
+    if not args.src:
+        return _find_job_dirs(args.base_dir, args.dir_format)
+    jobs = []
+    used_names = set()
+    for src in args.src:
+        name = _get_job_name(src)
+        if name in used_names:
+            name = '{}_{}'.format(name, len(jobs))
+        used_names.add(name)
+        jobs.append(Job(name, [src], os.path.join(args.base_dir, name)))
+    return jobs
+
+
+def _find_job_dirs(base_dir, dir_format):
+    """\
+    Returns jobs (without SRC) of directories under base_dir other than
+    backups and files of this script, which start with ".".
+    """
+    pattern = _get_dir_name_pattern(dir_format)
+    jobs = []
+    for entry in _list_dir_entries(base_dir):
+        name = entry.name
+        if (name.startswith('.') or not entry.is_dir(follow_symlinks=False)
+                or _parse_backup_dir_name(name, pattern) is not None
+                or name.endswith(_INPROGRESS_SUFFIX)):
+            continue
+        jobs.append(Job(name, [], entry.path))
+    return sorted(jobs, key=lambda x: x.name)
+
+
+class _JobLoggerAdapter(LoggerAdapter):
+    def process(self, msg, kwargs):
+        return '[{}] {}'.format(self.extra['job'], msg), kwargs
+
+
+def _prepare_base_dir(base_dir, logger):
+    """\
+    Checks base_dir is a writable directory, creating it if needed.
+    """
+    org_base_dir = base_dir
+    norm_base_dir = os.path.normpath(base_dir)
+    logger.debug('Normalized base_dir: "{}"'.format(norm_base_dir))
+
+    if base_dir == "/":
+        logger.error("base-dir looks root to me ({})"
+                     .format(base_dir))
+        return False
+
+    if os.path.exists(norm_base_dir):
+        # If base_dir exists, check if it is a writable directory.
+        if not os.path.isdir(norm_base_dir):
+            logger.error('Path "{}" is not a directory'
+                         .format(org_base_dir))
+            return False
+        if not os.access(norm_base_dir, os.W_OK):
+            logger.error('Directory "{}" is not writable'
+                         .format(org_base_dir))
+        logger.debug('Directory "{}" exists and writable.'
+                     .format(org_base_dir))
+    else:
+        logger.info('Directory "{}" does not exist. Creating it.'
+                    .format(org_base_dir))
+        # If base_dir does not exists, check parent's dir.
+        # If parent's dir exists, try creating base_dir.
+        parent_dir = os.path.dirname(norm_base_dir)
+        if (not os.path.exists(parent_dir)
+            or not os.path.isdir(parent_dir)):
+            logger.error('Parent dir "{}" is not accessible'
+                         .format(parent_dir))
+            return False
+        os.mkdir(base_dir)
+    return True
+
+
+def _main_inter(args, logger, metrics=None):
+    metrics = metrics or RunMetrics()
+    if args.hourly:
+        if args.dir_format == _DEFAULT_DIR_FORMAT:
+            logger.debug('Automatically switch to "hourly" dir_format ("{}")'
+                         .format(_DEFAULT_DIR_FORMAT_HOURLY))
+            args.dir_format = _DEFAULT_DIR_FORMAT_HOURLY
+        else:
+            # If the user changes the format, check if the new version
+            # contains "%H"
+            if '%H' not in args.dir_format:
+                logger.warning('dir_format does not contain %H while --hourly'
+                               ' option is specified')
+
+    with metrics.phase(args.base_dir, 'validate_base_dir'):
+        if not _prepare_base_dir(args.base_dir, logger):
+            return False
+
+    lock = BaseDirLock(args.base_dir)
+    if not lock.acquire():
+        raise BaseDirLocked('Another run is using "{}". Skipping.'
+                            .format(args.base_dir))
+    try:
+        return _main_locked(args, logger, metrics)
+    finally:
+        lock.release()
+
+
+def _main_locked(args, logger, metrics):
+    today = datetime.today()
+    included_dirs = list(_DEFAULT_INCLUDED_DIR)
+    if args.include:
+        included_dirs.extend(args.include)
+    excluded_dirs = list(_DEFAULT_EXCLUDED_DIR)
+    if args.exclude:
+        excluded_dirs.extend(args.exclude)
+    logger.debug('included files: {}'.format(', '.join(included_dirs)))
+    logger.debug('excluded files: {}'.format(', '.join(excluded_dirs)))
+
+    jobs = _prepare_jobs(args)
+    if not args.jobs:
+        return _run_job(args, jobs[0], today, included_dirs, excluded_dirs,
+                        logger, metrics)
+    return _run_jobs(args, jobs, today, included_dirs, excluded_dirs, logger,
+                     metrics)
+
+
+def _run_jobs(args, jobs, today, included_dirs, excluded_dirs, logger,
+              metrics):
+    """\
+    Runs jobs on a pool of args.jobs threads and logs a summary.
+    Returns True only when all the jobs succeeded.
+    """
+    def _timed_run(job):
+        job_logger = _JobLoggerAdapter(logger, {'job': job.name})
+        start_time = time.time()
+        try:
+            successful = _run_job(args, job, today, included_dirs,
+                                  excluded_dirs, job_logger, metrics)
+        except Exception:
+            job_logger.error(traceback.format_exc())
+            successful = False
+        return JobResult(job.name, successful, time.time() - start_time)
+
+    logger.debug('Running {} jobs with {} workers'
+                 .format(len(jobs), args.jobs))
+    if not jobs:
+        logger.warning('No job directory is found in "{}"'
+                       .format(args.base_dir))
+        return True
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.jobs) as executor:
+        results = list(executor.map(_timed_run, jobs))
+    name_width = max(len(result.name) for result in results)
+    logger.info('Job summary:')
+    for result in results:
+        logger.info('  {}  {}  {:.3f} sec'
+                    .format(result.name.ljust(name_width),
+                            'OK    ' if result.successful else 'FAILED',
+                            result.elapsed))
+    num_failed = len([r for r in results if not r.successful])
+    if num_failed:
+        logger.error('{} of {} jobs failed'.format(num_failed, len(results)))
+        return False
+    return True
+
+
+def _run_job(args, job, today, included_dirs, excluded_dirs, logger,
+             metrics):
+    scope = job.base_dir
+    successful = False
+    try:
+        successful = _run_job_inter(args, job, today, included_dirs,
+                                    excluded_dirs, logger, metrics)
+    finally:
+        metrics.set(scope, 'success', int(bool(successful)))
+    return successful
+
+
+def _run_job_inter(args, job, today, included_dirs, excluded_dirs, logger,
+                   metrics):
+    scope = job.base_dir
+    if job.base_dir != args.base_dir:
+        with metrics.phase(scope, 'validate_base_dir'):
+            if not _prepare_base_dir(job.base_dir, logger):
+                return False
+
+    src_str = ', '.join(map(lambda x: '"{}"'.format(x), job.src_list))
+    dest_dir_path = _get_backup_dir_path(today, job.base_dir, args.dir_format)
+    logger.debug('Backup {} to "{}"'.format(src_str, dest_dir_path))
+
+    index_path = args.catalog_index
+    if index_path and job.name:
+        index_path = '{}.{}'.format(index_path, job.name)
+    with metrics.phase(scope, 'catalog'):
+        catalog = _build_snapshot_catalog(job.base_dir, args.dir_format,
+                                          index_path=index_path,
+                                          logger=logger)
+    if args.verify:
+        return _run_verify(args, job, catalog, logger, metrics)
+    if args.report:
+        return _run_report(args, job, catalog, logger, metrics)
+    if args.restore:
+        return _run_restore(args, job, catalog, logger, metrics)
+    trash_dir = os.path.join(job.base_dir, _TRASH_DIR_NAME)
+    num_pruned = 0
+    # Archived backups are older than any in the catalog, and retention
+    # applies to them as well.
+    archived = _find_archived_snapshots(_get_archive_dir(args, job),
+                                        args.dir_format)
+    tiers = dict((x, getattr(args, 'keep_' + x))
+                 for x in ['hourly', 'daily', 'weekly', 'monthly'])
+    if any(tiers.values()):
+        logger.debug('Remove backups not kept by tiers ({})'.format(
+            ', '.join('{}: {}'.format(k, v) for k, v in sorted(tiers.items())
+                      if v)))
+        with metrics.phase(scope, 'prune'):
+            keep = _select_backups_to_keep(
+                today, list(catalog) + archived, keep_hourly=tiers['hourly'],
+                keep_daily=tiers['daily'], keep_weekly=tiers['weekly'],
+                keep_monthly=tiers['monthly'])
+            num_pruned = _remove_backups(
+                [s for s in catalog if s.name not in keep], catalog,
+                trash_dir=trash_dir, jobs=args.prune_jobs, logger=logger)
+            num_pruned += _remove_archives(
+                [s for s in archived if s.name not in keep], logger=logger)
+    elif args.removal_threshold > 0:
+        logger.debug('Remove old backups if exist (threshold: {})'
+                     .format(args.removal_threshold))
+        with metrics.phase(scope, 'prune'):
+            num_pruned = _remove_old_backups_if_exist(
+                today, catalog, args.removal_threshold, args.hourly,
+                trash_dir=trash_dir, jobs=args.prune_jobs, logger=logger)
+            boundary = _get_expiration_boundary(
+                today, args.dir_format, args.removal_threshold, args.hourly)
+            if boundary is not None:
+                num_pruned += _remove_archives(
+                    [s for s in archived if s.timestamp <= boundary],
+                    logger=logger)
+    metrics.set(scope, 'pruned_backups', num_pruned)
+    metrics.set(scope, 'catalog_backups', len(catalog))
+    if args.prune_only:
+        _archive_with_metrics(args, job, today, catalog, logger, metrics)
+        with metrics.phase(scope, 'empty_trash'):
+            _empty_trash(trash_dir, args.prune_jobs, logger=logger)
+        return True
+    # The native engine and --incremental expect an empty destination.
+    resumable = args.engine != 'native' and not args.incremental
+    inprogress_path = _prepare_inprogress_dir(dest_dir_path, catalog,
+                                              resumable, trash_dir,
+                                              logger=logger)
+    if args.prune_for_space:
+        with metrics.phase(scope, 'prune_for_space'):
+            history = _load_space_history(job.base_dir, catalog,
+                                          logger=logger)
+            needed = _predict_run_size(history) + args.min_free_space
+            logger.debug('Expecting {} bytes to be written (history: {})'
+                         .format(needed - args.min_free_space, history))
+            archived = _find_archived_snapshots(_get_archive_dir(args, job),
+                                                args.dir_format)
+            num_removed, enough = _prune_for_space(
+                job.base_dir, catalog, needed, trash_dir, args.prune_jobs,
+                args.min_backups, archived=archived, logger=logger)
+            num_pruned += num_removed
+        metrics.set(scope, 'pruned_backups', num_pruned)
+        if not enough:
+            return False
+    change_stream = None
+    if args.change_manifest:
+        change_stream = ChangeStream(_open_change_records(dest_dir_path))
+    elif args.metrics_file or args.prune_for_space:
+        # Just for figures of --stats
+        change_stream = ChangeStream(items=False)
+    pruner = None
+    if not args.defer_prune:
+        pruner = TrashPruner(trash_dir, args.prune_jobs, logger=logger).start()
+    try:
+        try:
+            successful = _backup_with_catalog(args, job, today, catalog,
+                                              dest_dir_path, inprogress_path,
+                                              included_dirs, excluded_dirs,
+                                              change_stream, logger, metrics)
+        finally:
+            if pruner:
+                logger.debug('Waiting for removal of old backups.')
+                with metrics.phase(scope, 'prune_join'):
+                    pruner.join()
+        if successful:
+            _publish_backup_dir(inprogress_path, dest_dir_path, trash_dir,
+                                logger=logger)
+            # Written only now, so that it sits next to the backup it
+            # describes and never next to a failed run.
+            if args.change_manifest:
+                _finish_change_manifest(dest_dir_path, change_stream,
+                                        logger=logger)
+    finally:
+        if args.change_manifest:
+            _discard_change_records(change_stream)
+    if not successful and os.path.isdir(inprogress_path):
+        logger.info('Leaving "{}" for the next run to resume'
+                    .format(inprogress_path))
+    # It may have been updated in place.
+    _discard_report_caches(job.base_dir, [os.path.basename(dest_dir_path)])
+    if successful and args.dedup:
+        with metrics.phase(scope, 'dedup'):
+            # The catalog does not know the backup just published.
+            catalog = _build_snapshot_catalog(job.base_dir, args.dir_format,
+                                              logger=logger)
+            num_files, num_bytes = _dedup_snapshots(
+                job.base_dir, list(catalog), args.dedup_jobs,
+                args.dedup_min_size, logger=logger)
+        logger.info('Deduplication freed {} bytes ({} files relinked)'
+                    .format(num_bytes, num_files))
+        metrics.set(scope, 'dedup_relinked_files', num_files)
+        metrics.set(scope, 'dedup_freed_bytes', num_bytes)
+    if successful:
+        _archive_with_metrics(args, job, today, catalog, logger, metrics)
+    if index_path:
+        _refresh_catalog_index(index_path, catalog, dest_dir_path,
+                               logger=logger)
+    return successful
+
+
+def _get_archive_dir(args, job):
+    archive_dir = args.archive_dir
+    if archive_dir and job.name:
+        archive_dir = os.path.join(archive_dir, job.name)
+    return archive_dir or os.path.join(job.base_dir, _ARCHIVE_DIR_NAME)
+
+
+def _archive_with_metrics(args, job, today, catalog, logger, metrics):
+    if args.archive_after is None:
+        return
+    scope = job.base_dir
+    archive_dir = _get_archive_dir(args, job)
+    with metrics.phase(scope, 'archive'):
+        num_archived = _archive_old_backups(
+            today, catalog, args.archive_after, archive_dir,
+            args.archive_jobs, args.archive_level, args.hourly,
+            logger=logger)
+    metrics.set(scope, 'archived_backups', num_archived)
+
+
+def _run_verify(args, job, catalog, logger, metrics):
+    scope = job.base_dir
+    db_path = args.verify_db
+    if db_path and job.name:
+        db_path = '{}.{}'.format(db_path, job.name)
+    db_path = db_path or os.path.join(job.base_dir, _VERIFY_DB_NAME)
+    with metrics.phase(scope, 'verify'):
+        num_verified, bad_paths = _verify_snapshots(
+            job.base_dir, list(catalog), db_path, args.verify_jobs,
+            args.verify_interval * 24 * 60 * 60, time.time(), logger=logger)
+    metrics.set(scope, 'verified_files', num_verified)
+    metrics.set(scope, 'corrupted_files', len(bad_paths))
+    if bad_paths:
+        logger.error('{} of {} files verified failed'
+                     .format(len(bad_paths), num_verified))
+        return False
+    logger.info('{} files verified'.format(num_verified))
+    return True
+
+
+def _run_report(args, job, catalog, logger, metrics):
+    scope = job.base_dir
+    with metrics.phase(scope, 'report'):
+        results = _report_space(job.base_dir, list(catalog), args.report_jobs,
+                                logger=logger)
+    if not results:
+        logger.info('No backup found in "{}"'.format(job.base_dir))
+        return True
+    name_width = max(len(snapshot.name) for snapshot, _, _ in results)
+    logger.info('{}  {:>16}  {:>16}'.format('Backup'.ljust(name_width),
+                                            'Unique bytes', 'Shared bytes'))
+    for snapshot, unique, shared in results:
+        logger.info('{}  {:>16}  {:>16}'
+                    .format(snapshot.name.ljust(name_width), unique, shared))
+    metrics.set(scope, 'unique_bytes', sum(x[1] for x in results))
+    return True
+
+
+def _run_restore(args, job, catalog, logger, metrics):
+    scope = job.base_dir
+    rel_path = args.restore
+    with metrics.phase(scope, 'restore_index'):
+        archived = _find_archived_snapshots(_get_archive_dir(args, job),
+                                            args.dir_format)
+        versions = _find_versions(list(catalog), archived, rel_path,
+                                  logger=logger)
+    if not versions:
+        logger.error('"{}" is not found in any backup in "{}"'
+                     .format(rel_path, job.base_dir))
+        return False
+    if not args.restore_to:
+        distinct = _get_distinct_versions(versions)
+        name_width = max(len(version.snapshot.name)
+                         for version, _ in distinct)
+        logger.info('{} versions of "{}" in {} backups'
+                    .format(len(distinct), rel_path, len(versions)))
+        logger.info('{}  {:<7}  {:>19}  {:>16}  {:>20}  {}'
+                    .format('Backup'.ljust(name_width), 'Kind',
+                            'Modified', 'Size', 'Inode', 'Backups'))
+        for version, count in distinct:
+            if version.mtime is None:
+                modified = '-'
+            else:
+                modified = datetime.fromtimestamp(version.mtime).strftime(
+                    '%Y-%m-%d %H:%M:%S')
+            inode = ('{}:{}'.format(*version.inode) if version.inode
+                     else '(archived)')
+            logger.info('{}  {:<7}  {:>19}  {:>16}  {:>20}  {}'
+                        .format(version.snapshot.name.ljust(name_width),
+                                version.kind, modified, version.size, inode,
+                                count))
+        return True
+    version = _select_version(versions, name=args.restore_from,
+                              before=args.restore_before)
+    if not version:
+        logger.error('No backup matching the condition has "{}"'
+                     .format(rel_path))
+        return False
+    restore_to = args.restore_to
+    if job.name:
+        restore_to = os.path.join(restore_to, job.name)
+    dest_path = os.path.join(restore_to, os.path.basename(rel_path))
+    if os.path.lexists(dest_path):
+        logger.error('"{}" already exists'.format(dest_path))
+        return False
+    logger.info('Restoring "{}" from "{}" to "{}"'
+                .format(rel_path, version.snapshot.path, dest_path))
+    with metrics.phase(scope, 'restore'):
+        try:
+            return _restore_version(version, rel_path, dest_path,
+                                    args.restore_jobs, logger=logger)
+        except AppException as e:
+            logger.error(str(e))
+            return False
+
+
+def _do_transfer(args, job, dest_dir_path, link_dir_paths, included_dirs,
+                 excluded_dirs, logger, change_stream, throttle):
+    if args.incremental:
+        return _do_incremental_backup(job, dest_dir_path, link_dir_paths,
+                                      included_dirs, excluded_dirs, logger,
+                                      args, change_stream=change_stream,
+                                      throttle=throttle)
+    elif args.engine == 'native':
+        return _do_native_backup(job.src_list, dest_dir_path, link_dir_paths,
+                                 included_dirs, excluded_dirs, logger, args,
+                                 change_stream=change_stream,
+                                 throttle=throttle)
+    elif args.shards and _can_shard(job.src_list, logger):
+        state_path = os.path.join(job.base_dir, _SHARD_STATE_NAME)
+        return _do_sharded_backup(job.src_list[0], dest_dir_path,
+                                  link_dir_paths, included_dirs,
+                                  excluded_dirs, state_path, logger, args,
+                                  change_stream=change_stream,
+                                  throttle=throttle)
+    else:
+        return _do_actual_backup(job.src_list, dest_dir_path, link_dir_paths,
+                                 included_dirs, excluded_dirs, logger, args,
+                                 change_stream=change_stream,
+                                 throttle=throttle)
+
+
+def _backup_with_catalog(args, job, today, catalog, dest_dir_path,
+                         inprogress_path, included_dirs, excluded_dirs,
+                         change_stream, logger, metrics):
+    """\
+    Transfers SRC into inprogress_path, which becomes dest_dir_path
+    when this returns True. change_stream, when given, is fed with the
+    output of the transfer.
+    """
+    scope = job.base_dir
+    link_dir_paths = []
+    if args.force_full_backup:
+        logger.debug('Force full-backup')
+    else:
+        with metrics.phase(scope, 'link_dest'):
+            link_dir_paths = _find_link_dirs(today, catalog,
+                                             newest=args.link_dest_count,
+                                             weekly=args.link_dest_weekly,
+                                             logger=logger)
+            if os.path.isdir(dest_dir_path):
+                # Taken again in the same period. The backup taken before
+                # stays intact until this one replaces it.
+                link_dir_paths.insert(0, dest_dir_path)
+        if link_dir_paths:
+            logger.debug('Will hardlink to {} with --link-dest'
+                         .format(', '.join('"{}"'.format(x)
+                                           for x in link_dir_paths)))
+        else:
+            logger.debug('Did not found a precedent backup.'
+                         ' Will do full-backup')
+    metrics.set(scope, 'link_dest_dirs', len(link_dir_paths))
+    throttle = None
+    if args.adaptive_throttle:
+        max_kbps = None
+        if args.rsync_bwlimit:
+            max_kbps = _parse_bwlimit(args.rsync_bwlimit)
+        max_net_kbps = None
+        if any(_is_remote_src(x) for x in job.src_list):
+            max_net_kbps = args.max_net_rate
+        throttle = AdaptiveThrottle(job.base_dir, args.max_disk_latency,
+                                    args.max_load, args.min_bwlimit,
+                                    max_kbps=max_kbps,
+                                    max_net_kbps=max_net_kbps,
+                                    logger=logger).start()
+    with metrics.phase(scope, 'transfer'):
+        try:
+            exit_code = _do_transfer(args, job, inprogress_path,
+                                     link_dir_paths, included_dirs,
+                                     excluded_dirs, logger, change_stream,
+                                     throttle)
+        finally:
+            if throttle:
+                throttle.stop()
+    metrics.set(scope, 'rsync_exit_code', exit_code)
+    if args.prune_for_space and _is_acceptable_exit_code(exit_code):
+        num_bytes = _get_transferred_bytes(change_stream.summary())
+        if num_bytes is not None:
+            history = _load_space_history(job.base_dir, catalog,
+                                          logger=logger)
+            _save_space_history(job.base_dir, history + [num_bytes],
+                                logger=logger)
+    if change_stream:
+        metrics.set_rsync_stats(scope, change_stream.stats)
+    if args.change_manifest:
+        summary = change_stream.summary()
+        logger.info('Changes: {}'.format(', '.join(
+            '{} {} files ({} bytes)'.format(kind, summary['counts'][kind],
+                                            summary['bytes'].get(kind, 0))
+            for kind in sorted(summary['counts']))))
+    if args.report_link_savings and os.path.isdir(inprogress_path):
+        num_files, num_bytes = _count_link_dest_savings(inprogress_path,
+                                                        link_dir_paths)
+        logger.info('Extra --link-dest saved {} bytes ({} files) compared'
+                    ' to the newest backup only'.format(num_bytes, num_files))
+    if not _is_acceptable_exit_code(exit_code):
         logger.error('Exit code of rsync is not acceptable (code: {})'
                      .format(exit_code))
         return False
@@ -479,10 +5342,264 @@ def _get_human_readable_time(elapsed):
     return ' '.join(human_readable(rd))
 
 
-def main():
-    args = _parse_args()
+class BaseDirLock:
+    """\
+    Exclusive lock on a base_dir, so that runs from cron and the daemon
+    never back up into the same base_dir at the same time.
+    """
+
+    def __init__(self, base_dir):
+        self.path = os.path.join(base_dir, _LOCK_FILE_NAME)
+        self._file = None
+
+    def acquire(self):
+        """\
+        Returns False without waiting when another run holds the lock.
+        """
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def _apply_priority(args, logger):
+    """\
+    Applies --nice and --ionice-class to this process.
+    rsync and threads started afterwards inherit them.
+    """
+    if args.nice:
+        os.nice(args.nice)
+        logger.debug('Applied nice {}'.format(args.nice))
+    if args.ionice_class:
+        cmd = ['ionice', '-c', str(_IONICE_CLASSES[args.ionice_class]),
+               '-p', str(os.getpid())]
+        if args.ionice_level is not None and args.ionice_class != 'idle':
+            cmd[3:3] = ['-n', str(args.ionice_level)]
+        try:
+            subprocess.check_call(cmd)
+            logger.debug('Applied ionice ({})'.format(' '.join(cmd)))
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning('Unable to apply ionice ({})'.format(e))
+
+
+# One line of a job table for --daemon.
+# "period" is timedelta(hours=1) or timedelta(days=1) and
+# "offset" is the time within the period the job is scheduled at.
+DaemonJob = namedtuple('DaemonJob', ['name', 'period', 'offset', 'argv'])
+
+
+def _parse_schedule(schedule):
+    """\
+    Parses "hourly[:MM]" or "daily[:HH:MM]" into (period, offset).
+    """
+    m = re.match(r'^hourly(?::(\d{1,2}))?$', schedule)
+    if m:
+        minute = int(m.group(1) or 0)
+        if minute < 60:
+            return timedelta(hours=1), timedelta(minutes=minute)
+    m = re.match(r'^daily(?::(\d{1,2}):(\d{1,2}))?$', schedule)
+    if m:
+        hour = int(m.group(1) or 0)
+        minute = int(m.group(2) or 0)
+        if hour < 24 and minute < 60:
+            return timedelta(days=1), timedelta(hours=hour, minutes=minute)
+    raise AppException('Invalid schedule "{}"'.format(schedule))
+
+
+def _load_job_table(path):
+    """\
+    Reads a job table for --daemon. Each line is
+
+        NAME SCHEDULE ARGUMENTS...
+
+    where SCHEDULE is "hourly[:MM]" or "daily[:HH:MM]" and ARGUMENTS are
+    the same as the command line of this script. e.g.
+
+        home  hourly:01   --hourly --base-dir=/mnt/backup_hourly /home/me
+        root  daily:03:00 --exclude=/var/lib/docker /
+    """
+    jobs = []
+    with open(path) as f:
+        for num, line in enumerate(f, 1):
+            tokens = shlex.split(line, comments=True)
+            if not tokens:
+                continue
+            if len(tokens) < 3:
+                raise AppException('{}:{}: NAME, SCHEDULE and arguments'
+                                   ' are needed'.format(path, num))
+            name, schedule, argv = tokens[0], tokens[1], tokens[2:]
+            period, offset = _parse_schedule(schedule)
+            try:
+                args = _parse_args(argv)
+            except SystemExit:
+                raise AppException('{}:{}: invalid arguments for "{}"'
+                                   .format(path, num, name))
+            if args.daemon:
+                raise AppException('{}:{}: --daemon cannot be nested'
+                                   .format(path, num))
+            # Jobs run as threads of the daemon, which has one priority.
+            if args.nice or args.ionice_class:
+                raise AppException('{}:{}: give --nice and --ionice-* to'
+                                   ' --daemon itself, not to "{}"'
+                                   .format(path, num, name))
+            jobs.append(DaemonJob(name, period, offset, argv))
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise AppException('Job names in {} are not unique'.format(path))
+    return jobs
+
+
+def _get_last_slot(job, now):
+    """\
+    Returns the latest time the job is scheduled at, which is not after now.
+    """
+    if job.period == timedelta(days=1):
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start = now.replace(minute=0, second=0, microsecond=0)
+    slot = start + job.offset
+    if slot > now:
+        slot -= job.period
+    return slot
 
-    logger = getLogger(__name__)
+
+class BackupDaemon:
+    """\
+    Runs jobs of a job table (see _load_job_table()) on schedule
+    within one long-running process.
+
+    A job whose scheduled time passed while the daemon was stopped or
+    while its base_dir was locked by another run is run once as soon as
+    possible. Times of the last runs are kept in the state file so that
+    this also works across restarts.
+    """
+
+    def __init__(self, table_path, logger, state_path=None):
+        self.table_path = table_path
+        self.state_path = state_path or table_path + '.state'
+        self.logger = logger
+        self.jobs = _load_job_table(table_path)
+        self.state = self._load_state()
+        self._running = {}
+        self._job_loggers = {}
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return dict((name, datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S'))
+                            for name, ts in json.load(f).items())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        with self._lock:
+            state = dict((name, ts.strftime('%Y-%m-%dT%H:%M:%S'))
+                         for name, ts in self.state.items())
+        tmp_path = '{}.{}.tmp'.format(self.state_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.state_path)
+
+    def _get_job_logger(self, job, args):
+        if job.name not in self._job_loggers:
+            name = '{}.{}'.format(self.logger.name, job.name)
+            logger = _setup_logger(args, name)
+            if logger:
+                logger.propagate = False
+            else:
+                logger = self.logger
+            self._job_loggers[job.name] = logger
+        return self._job_loggers[job.name]
+
+    def _is_due(self, job, now):
+        slot = _get_last_slot(job, now)
+        last_run = self.state.get(job.name)
+        if last_run is None:
+            # Never run. Wait for the next slot instead of running at
+            # startup for the slot that has already passed.
+            self.state[job.name] = slot
+            return False
+        return last_run < slot
+
+    def _run_job(self, job, slot):
+        # Until _run_once() starts, which logs its own errors
+        logger = None
+        try:
+            args = _parse_args(job.argv)
+            logger = self._get_job_logger(job, args)
+            successful = _run_once(args, logger)
+        except SystemExit:
+            # The arguments became invalid after the table was loaded
+            # (argparse has printed why).
+            self.logger.error('Invalid arguments for "{}": {}'
+                              .format(job.name, ' '.join(job.argv)))
+            successful = False
+        except Exception:
+            if logger is None:
+                self.logger.error(traceback.format_exc())
+            # Do not retry until the next slot.
+            successful = False
+        finally:
+            with self._lock:
+                del self._running[job.name]
+        # None means the run did not happen (e.g. base_dir was locked).
+        # It is retried on the next tick.
+        if successful is not None:
+            with self._lock:
+                self.state[job.name] = slot
+            self._save_state()
+
+    def stop(self, *_):
+        self._stop.set()
+
+    def run(self):
+        self.logger.info('Daemon started with {} jobs from "{}"'
+                         .format(len(self.jobs), self.table_path))
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self._stop.is_set():
+            now = datetime.now()
+            for job in self.jobs:
+                with self._lock:
+                    if job.name in self._running or not self._is_due(job,
+                                                                     now):
+                        continue
+                    slot = _get_last_slot(job, now)
+                    thread = threading.Thread(target=self._run_job,
+                                              args=(job, slot))
+                    self._running[job.name] = thread
+                self.logger.debug('Starting "{}" scheduled at {}'
+                                  .format(job.name, slot.isoformat()))
+                thread.start()
+            self._stop.wait(_DAEMON_TICK)
+        self.logger.info('Stopping. Waiting for running jobs.')
+        with self._lock:
+            threads = list(self._running.values())
+        for thread in threads:
+            thread.join()
+        self._save_state()
+
+
+def _setup_logger(args, name=__name__):
+    """\
+    Returns a logger configured with log-level options and
+    --verbose-log-file of args, or None when the log file is not usable.
+    """
+    logger = getLogger(name)
     handler = StreamHandler()
     handler.setLevel(args.log)
     logger.addHandler(handler)
@@ -500,7 +5617,7 @@ def main():
         log_dir = os.path.dirname(log_file)
         if os.path.isdir(log_file):
             logger.error('{} is a directory'.format(log_file))
-            return
+            return None
         # If the user has no appropriate permission, exit.
         if not (os.path.exists(log_dir)
                 and os.path.isdir(log_dir)
@@ -509,7 +5626,7 @@ def main():
                      or os.access(log_file, os.W_OK))):
             logger.error('No permission to write to {}'
                          .format(log_file))
-            return
+            return None
         file_handler = RotatingFileHandler(log_file,
                                            encoding='utf-8',
                                            maxBytes=30*1024*1024,
@@ -519,6 +5636,15 @@ def main():
         logger.setLevel(DEBUG)
         file_handler.setLevel(DEBUG)
         logger.addHandler(file_handler)
+    return logger
+
+
+def _run_once(args, logger):
+    """\
+    Does one backup run as specified by args, logging when it started,
+    how it ended and how long it took.
+    Returns True on success, or None when interrupted.
+    """
     start_time = time.time()
     successful = False
     logger.info("Start running at {} ({} with Python {})"
@@ -527,14 +5653,25 @@ def main():
     logger.debug("Detailed Python version: {}"
                  .format(sys.version.replace('\n', ' ')))
     logger.debug("src-type: {}".format(args.src_type))
+    metrics = RunMetrics()
     try:
-        successful = _main_inter(args, logger)
+        successful = _main_inter(args, logger, metrics)
+    except BaseDirLocked as e:
+        # The run holding the lock writes the metrics.
+        metrics = None
+        logger.warning(str(e))
+        return None
     except KeyboardInterrupt:
         logger.error('Keyboard-interrupted. Exitting.')
-        return
+        return None
     except Exception:
         logger.error(traceback.format_exc())
         raise
+    finally:
+        # Also when _main_inter() raised, reported as failed
+        if args.metrics_file and metrics is not None:
+            _write_metrics_file(args.metrics_file, metrics, successful,
+                                start_time, time.time() - start_time)
     end_time = time.time()
     if successful:
         logger.info('Finished running successfully at {}'
@@ -548,6 +5685,30 @@ def main():
         logger.info('Elapsed: {:.3f} sec ({})'.format(elapsed, human_readable))
     else:
         logger.info('Elapsed: {:.3f} sec'.format(elapsed))
+    for (scope, name), value in metrics.phases.items():
+        logger.debug('Phase "{}" of "{}": {:.3f} sec'
+                     .format(name, scope, value))
+    return successful
+
+
+def main():
+    args = _parse_args()
+    logger = _setup_logger(args)
+    if not logger:
+        return
+    _apply_priority(args, logger)
+    if args.ssh_benchmark:
+        results = _benchmark_ssh(args, logger=logger)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    if args.daemon:
+        try:
+            BackupDaemon(args.daemon, logger).run()
+        except AppException as e:
+            logger.error(str(e))
+            sys.exit(1)
+        return
+    _run_once(args, logger)
 
 
 if __name__ == '__main__':
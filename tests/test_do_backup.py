@@ -0,0 +1,1184 @@
+'''
+Tests of do_backup.py. Run with "python -m pytest tests" or
+"python -m unittest discover tests".
+'''
+
+import errno
+import io
+import json
+import os
+import os.path
+import shlex
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import do_backup  # noqa: E402
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_do_backup.')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class ConstructRsyncOptsTest(TempDirTestCase):
+    def _get_opts(self, argv, **kwargs):
+        args = do_backup._parse_args(argv + ['-b', self.tmp_dir, '/src'])
+        return do_backup._construct_rsync_opts(args, [], [], [], **kwargs)
+
+    def test_files_from_drops_delete(self):
+        for src_type in ['local', 'ssh', 'rough']:
+            opts = self._get_opts(['-t', src_type, '--incremental'],
+                                  files_from='/tmp/list')
+            self.assertNotIn('--delete', opts)
+            self.assertIn('--files-from=/tmp/list', opts)
+
+    def test_delete_without_files_from(self):
+        self.assertIn('--delete', self._get_opts(['-t', 'local']))
+        self.assertNotIn('--delete', self._get_opts(['-t', 'rough']))
+
+    def test_stats_only(self):
+        opts = self._get_opts(['-t', 'local'],
+                              change_stream=do_backup.ChangeStream(
+                                  items=False))
+        self.assertIn('--stats', opts)
+        self.assertFalse([x for x in opts if x.startswith('--out-format')])
+        opts = self._get_opts(['-t', 'local'],
+                              change_stream=do_backup.ChangeStream())
+        self.assertTrue([x for x in opts if x.startswith('--out-format')])
+
+
+class ChangeStreamTest(unittest.TestCase):
+    def test_stats_only_skips_items(self):
+        change_stream = do_backup.ChangeStream(items=False)
+        handler = do_backup._make_line_handler(
+            do_backup._null_logger, '', change_stream)
+        for line in [b'>f+++++++++ 3 new\n',
+                     b'Number of files: 3 (reg: 2, dir: 1)\n',
+                     b'Total transferred file size: 1,024 bytes\n']:
+            handler(line)
+        self.assertEqual(0, change_stream.counts['new'])
+        self.assertEqual(1024, do_backup._get_transferred_bytes(
+            change_stream.summary()))
+        self.assertEqual(2, change_stream.stats['number_of_regular_files'])
+
+
+    def _feed(self, lines):
+        records = io.StringIO()
+        change_stream = do_backup.ChangeStream(records)
+        handler = do_backup._make_line_handler(
+            do_backup._null_logger, '', change_stream)
+        for line in lines:
+            handler(line.encode('utf-8') + b'\n')
+        return change_stream, records.getvalue()
+
+    def test_itemized_lines(self):
+        # As printed by rsync -aH --delete --out-format="%i %l %n"
+        change_stream, records = self._feed([
+            'cd+++++++++ 0 new dir/',
+            '>f+++++++++ 3 new dir/a file',
+            '>f.st...... 5 changed',
+            '>f..t...... 7 touched',
+            '.f...p..... 11 chmod-only',
+            '.f........x 13 xattr-only',
+            '.d..t...... 0 ./',
+            'cL+++++++++ 0 symlink',
+            'hf+++++++++ 3 new dir/hardlink',
+            '*deleting   17 gone',
+            '*deleting   0 gone dir/',
+            'sent 1,234 bytes  received 56 bytes  2,580.00 bytes/sec',
+        ])
+        self.assertEqual({'new': 1, 'changed': 2, 'deleted': 1,
+                          'hardlinked': 1}, change_stream.counts)
+        self.assertEqual({'new': 3, 'changed': 12, 'deleted': 17,
+                          'hardlinked': 3}, change_stream.bytes)
+        self.assertEqual('N\t3\tnew dir/a file\n'
+                         'C\t5\tchanged\n'
+                         'C\t7\ttouched\n'
+                         'H\t3\tnew dir/hardlink\n'
+                         'D\t17\tgone\n', records)
+
+    def test_unchanged_from_stats(self):
+        change_stream, _ = self._feed([
+            '>f+++++++++ 3 new',
+            'hf+++++++++ 3 hardlink',
+            'Number of files: 6 (reg: 5, dir: 1)',
+            'Number of regular files transferred: 1',
+            'Total file size: 1,003 bytes',
+            'Total transferred file size: 3 bytes',
+        ])
+        summary = change_stream.summary()
+        self.assertEqual(3, summary['counts']['unchanged'])
+        self.assertEqual(997, summary['bytes']['unchanged'])
+
+
+class PumpOutputTest(unittest.TestCase):
+    def _pump(self, script, **kwargs):
+        p = subprocess.Popen(['sh', '-c', script], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        self.addCleanup(p.stderr.close)
+        self.addCleanup(p.stdout.close)
+        lines = {'out': [], 'err': []}
+        raw_out = io.BytesIO()
+        do_backup._pump_output({p.stdout: lines['out'].append,
+                                p.stderr: lines['err'].append},
+                               raw_out=raw_out, **kwargs)
+        p.wait()
+        return lines, raw_out.getvalue()
+
+    def test_interleaved_and_partial_lines(self):
+        lines, raw = self._pump(
+            'echo out1; echo err1 >&2; printf "out2\\nout"; sleep 0.1;'
+            ' printf "3\\n" ; printf "err2\\nerr-partial" >&2;'
+            ' printf "out-partial"')
+        self.assertEqual([b'out1', b'out2', b'out3', b'out-partial'],
+                         lines['out'])
+        self.assertEqual([b'err1', b'err2', b'err-partial'], lines['err'])
+        self.assertEqual(sorted(b'out1\nerr1\nout2\nout3\n'
+                                b'err2\nerr-partialout-partial'),
+                         sorted(raw))
+
+    def test_pipes_held_by_grandchild(self):
+        # The background sleep keeps both pipes open after sh exits.
+        p = subprocess.Popen(['sh', '-c', 'sleep 30 & echo $! >&2;'
+                              ' echo done; printf partial'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.addCleanup(p.stderr.close)
+        self.addCleanup(p.stdout.close)
+        lines = {'out': [], 'err': []}
+        started = time.time()
+        do_backup._pump_output({p.stdout: lines['out'].append,
+                                p.stderr: lines['err'].append}, process=p)
+        os.kill(int(lines['err'][0]), signal.SIGTERM)
+        self.assertLess(time.time() - started, 10)
+        self.assertEqual([b'done', b'partial'], lines['out'])
+        self.assertEqual(0, p.wait())
+
+
+class MetricsFileTest(TempDirTestCase):
+    def test_written_on_exception(self):
+        path = os.path.join(self.tmp_dir, 'metrics.json')
+        args = do_backup._parse_args(['--metrics-file', path,
+                                      '-b', self.tmp_dir, '/src'])
+        with mock.patch.object(do_backup, '_main_inter',
+                               side_effect=RuntimeError('crash')):
+            self.assertRaises(RuntimeError, do_backup._run_once, args,
+                              do_backup._null_logger)
+        with open(path) as f:
+            self.assertFalse(json.load(f)['successful'])
+
+
+# Stand-in for ssh given with --rsh. It records its arguments, refuses
+# the cipher "bad" as ssh does an unknown one, and runs the remote
+# command locally.
+_FAKE_SSH = """\
+#!/bin/sh
+echo "$@" >> "$(dirname "$0")/calls"
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -c) [ "$2" = bad ] && exit 255; shift 2 ;;
+        -i|-o) shift 2 ;;
+        -C) shift ;;
+        *) break ;;
+    esac
+done
+shift
+exec sh -c "$*"
+"""
+
+
+class SshTransportTest(TempDirTestCase):
+    def _get_args(self, argv):
+        return do_backup._parse_args(argv + ['-t', 'ssh', '-b', self.tmp_dir,
+                                             'host1:/etc', 'host2:/etc'])
+
+    def test_command_per_host(self):
+        transport = do_backup.SshTransport(self._get_args(
+            ['--ssh-cipher', 'aes128-ctr', '--ssh-cipher', 'host2=chacha',
+             '--ssh-compression', 'user@host2=ssh',
+             '--ssh-control-dir', self.tmp_dir,
+             '--ssh-control-persist', '30']))
+        command = transport.get_command('host1')
+        self.assertEqual(['ssh', '-c', 'aes128-ctr', '-o'], command[:4])
+        self.assertNotIn('-C', command)
+        self.assertIn('ControlPath={}/%C'.format(self.tmp_dir), command)
+        self.assertIn('ControlPersist=30', command)
+        self.assertEqual(['-z'], transport.get_rsync_opts('host1')[1:])
+        command = transport.get_command('user@host2', multiplex=False)
+        self.assertEqual(['ssh', '-c', 'chacha', '-C'], command)
+        self.assertEqual(1, len(transport.get_rsync_opts('user@host2')))
+
+    def test_plain_ssh_adds_no_option(self):
+        transport = do_backup.SshTransport(self._get_args([]))
+        self.assertEqual(['-z'], transport.get_rsync_opts('host1'))
+        self.assertEqual([], transport.get_rsync_opts('host1',
+                                                      compress=False))
+
+    def test_rsh_is_quoted(self):
+        rsh = os.path.join(self.tmp_dir, 'my ssh')
+        args = self._get_args(['--rsh', '{} -p 2222'.format(
+            shlex.quote(rsh))])
+        opts = do_backup._construct_rsync_opts(args, [], [], [],
+                                               host='host1')
+        option = [x for x in opts if x.startswith('-e ')]
+        self.assertEqual(1, len(option))
+        _, value = shlex.split(option[0])
+        self.assertEqual([rsh, '-p', '2222'], shlex.split(value))
+
+    def test_missing_identity_file(self):
+        transport = do_backup.SshTransport(self._get_args(
+            ['-i', os.path.join(self.tmp_dir, 'nonexistent')]))
+        self.assertRaises(do_backup.AppException, transport.get_command,
+                          'host1')
+
+    def test_benchmark_with_stand_in(self):
+        rsh = os.path.join(self.tmp_dir, 'ssh')
+        with open(rsh, 'w') as f:
+            f.write(_FAKE_SSH)
+        os.chmod(rsh, 0o755)
+        args = do_backup._parse_args(['--ssh-benchmark', '--rsh', rsh,
+                                      '--ssh-cipher', 'host2=bad',
+                                      'host1:/etc', 'host2:/etc'])
+        with mock.patch.object(do_backup, '_SSH_BENCHMARK_SIZE', 4096), \
+                mock.patch.object(do_backup, '_SSH_BENCHMARK_CIPHERS',
+                                  ['good', 'bad']):
+            results = do_backup._benchmark_ssh(args)
+        self.assertEqual([('host1', 'good', 'none'), ('host1', 'good', 'ssh')],
+                         sorted((x['host'], x['cipher'], x['compression'])
+                                for x in results))
+        with open(os.path.join(self.tmp_dir, 'calls')) as f:
+            calls = f.read().splitlines()
+        self.assertIn('-c good -C host1 cat > /dev/null', calls)
+        self.assertIn('-c bad host2 true', calls)
+
+
+class JobsWithoutSrcTest(TempDirTestCase):
+    def _run(self, argv):
+        args = do_backup._parse_args(argv + ['--jobs', '2',
+                                             '-b', self.tmp_dir])
+        return do_backup._main_inter(args, do_backup._null_logger)
+
+    def test_no_job_dir(self):
+        self.assertTrue(self._run(['--prune-only']))
+        self.assertTrue(self._run(['--report']))
+
+    def test_job_dirs_are_found(self):
+        for name in ['host1_etc', 'host2_etc', '.do_backup_trash']:
+            os.mkdir(os.path.join(self.tmp_dir, name))
+        args = do_backup._parse_args(['--prune-only', '--jobs', '2',
+                                      '-b', self.tmp_dir])
+        jobs = do_backup._prepare_jobs(args)
+        self.assertEqual(['host1_etc', 'host2_etc'], [x.name for x in jobs])
+        self.assertTrue(self._run(['--prune-only']))
+
+
+def _make_backups(base_dir, count, today=None):
+    """\
+    Creates count empty daily backups before today under base_dir and
+    returns the catalog of them.
+    """
+    today = today or datetime.today()
+    for i in range(1, count + 1):
+        os.mkdir(do_backup._get_backup_dir_path(
+            today - timedelta(days=i), base_dir,
+            do_backup._DEFAULT_DIR_FORMAT))
+    return do_backup._build_snapshot_catalog(base_dir,
+                                             do_backup._DEFAULT_DIR_FORMAT)
+
+
+class SnapshotCatalogTest(TempDirTestCase):
+    # Mid-period, so that neither rounding nor DST moves a boundary
+    today = datetime(2026, 10, 16, 12, 30)
+
+    def _make(self, steps, hourly=False):
+        """\
+        Creates backups the given numbers of days (hours) before today
+        and returns the catalog of base_dir.
+        """
+        dir_format, step = self._get_layout(hourly)
+        for i in steps:
+            os.mkdir(do_backup._get_backup_dir_path(
+                self.today - step * i, self.tmp_dir, dir_format))
+        return do_backup._build_snapshot_catalog(self.tmp_dir, dir_format)
+
+    def _get_layout(self, hourly):
+        if hourly:
+            return do_backup._DEFAULT_DIR_FORMAT_HOURLY, timedelta(hours=1)
+        return do_backup._DEFAULT_DIR_FORMAT, timedelta(days=1)
+
+    def _get_steps(self, catalog, hourly=False):
+        _, step = self._get_layout(hourly)
+        return sorted((self.today - s.timestamp) // step for s in catalog)
+
+    def test_reverse_parse(self):
+        for dir_format, thatday in [
+                (do_backup._DEFAULT_DIR_FORMAT, datetime(2026, 1, 2)),
+                (do_backup._DEFAULT_DIR_FORMAT_HOURLY,
+                 datetime(2026, 1, 2, 3)),
+                ('backup-%Y-%m-%d', datetime(2026, 1, 2))]:
+            pattern = do_backup._get_dir_name_pattern(dir_format)
+            name = thatday.strftime(pattern)
+            self.assertEqual(thatday, do_backup._parse_backup_dir_name(
+                name, pattern))
+            for bad in [name + '.inprogress', name + '.changes.gz',
+                        'x' + name, name.replace('01', '1'), '']:
+                self.assertIsNone(do_backup._parse_backup_dir_name(
+                    bad, pattern), bad)
+
+    def test_foreign_entries_are_skipped(self):
+        catalog = self._make([1, 2])
+        names = [s.name for s in catalog]
+        pattern = do_backup._get_dir_name_pattern(
+            do_backup._DEFAULT_DIR_FORMAT)
+        not_dir = (self.today - timedelta(days=3)).strftime(pattern)
+        for name in [not_dir, names[0] + '.changes.gz']:
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+        for name in [names[0] + '.inprogress', 'lost+found', '.trash',
+                     (self.today - timedelta(days=4)).strftime('%Y%m%d')]:
+            os.mkdir(os.path.join(self.tmp_dir, name))
+        catalog = do_backup._build_snapshot_catalog(
+            self.tmp_dir, do_backup._DEFAULT_DIR_FORMAT)
+        self.assertEqual(names, [s.name for s in catalog])
+        self.assertEqual([1, 2], self._get_steps(catalog))
+
+    def test_threshold_edges(self):
+        for hourly in [False, True]:
+            catalog = self._make(range(8), hourly=hourly)
+            num_removed = do_backup._remove_old_backups_if_exist(
+                self.today, catalog, 3, hourly)
+            self.assertEqual(4, num_removed)
+            self.assertEqual([0, 1, 2, 3], self._get_steps(catalog, hourly))
+            catalog = do_backup._build_snapshot_catalog(
+                self.tmp_dir, self._get_layout(hourly)[0])
+            self.assertEqual([0, 1, 2, 3], self._get_steps(catalog, hourly))
+            shutil.rmtree(self.tmp_dir)
+            os.mkdir(self.tmp_dir)
+
+    def test_beyond_the_old_search_window(self):
+        catalog = self._make([1, 150, 400], hourly=True)
+        do_backup._remove_old_backups_if_exist(self.today, catalog, 31,
+                                               True)
+        self.assertEqual([1], self._get_steps(catalog, True))
+
+    def test_same_as_probing(self):
+        """\
+        Within the 100 days the script used to probe, the catalog removes
+        and links to the same backups as guessing each name did.
+        """
+        steps = [0, 1, 2, 5, 9, 10, 11, 30, 64, 99]
+        threshold = 9
+        catalog = self._make(steps)
+
+        def _probe(i):
+            return os.path.isdir(do_backup._get_backup_dir_path(
+                self.today - timedelta(days=i), self.tmp_dir,
+                do_backup._DEFAULT_DIR_FORMAT))
+        expected_link = min(i for i in range(1, threshold + 1) if _probe(i))
+        expected_kept = [i for i in steps if i <= threshold]
+        link_dir = do_backup._find_link_dir(self.today, catalog)
+        self.assertEqual(do_backup._get_backup_dir_path(
+            self.today - timedelta(days=expected_link), self.tmp_dir,
+            do_backup._DEFAULT_DIR_FORMAT), link_dir)
+        do_backup._remove_old_backups_if_exist(self.today, catalog,
+                                               threshold, False)
+        self.assertEqual(expected_kept, self._get_steps(catalog))
+        self.assertEqual(expected_kept, [i for i in range(100) if _probe(i)])
+
+    def test_index(self):
+        # Outside base_dir, as --catalog-index asks
+        index_dir = tempfile.mkdtemp(prefix='test_do_backup.')
+        self.addCleanup(shutil.rmtree, index_dir)
+        index_path = os.path.join(index_dir, 'index')
+        self._make([1, 2])
+        build = do_backup._build_snapshot_catalog
+        catalog = build(self.tmp_dir, do_backup._DEFAULT_DIR_FORMAT,
+                        index_path=index_path)
+        with mock.patch.object(do_backup, '_scan_snapshot_entries') as scan:
+            cached = build(self.tmp_dir, do_backup._DEFAULT_DIR_FORMAT,
+                           index_path=index_path)
+            self.assertFalse(scan.called)
+        self.assertEqual([(s.name, s.timestamp) for s in catalog],
+                         [(s.name, s.timestamp) for s in cached])
+        # A new backup changes the mtime of base_dir.
+        time.sleep(0.01)
+        self._make([3])
+        catalog = build(self.tmp_dir, do_backup._DEFAULT_DIR_FORMAT,
+                        index_path=index_path)
+        self.assertEqual([1, 2, 3], self._get_steps(catalog))
+
+
+def _deny_writes_to_read_only_dirs():
+    """\
+    Makes os.unlink() and os.rmdir() fail in a directory without
+    the owner's write permission even for root, as they do for others.
+    """
+    real_unlink = os.unlink
+    real_rmdir = os.rmdir
+
+    def _check(path):
+        if not os.stat(os.path.dirname(path)).st_mode & stat.S_IWUSR:
+            raise PermissionError(errno.EACCES, os.strerror(errno.EACCES),
+                                  path)
+
+    def _unlink(path):
+        _check(path)
+        real_unlink(path)
+
+    def _rmdir(path):
+        _check(path)
+        real_rmdir(path)
+    return mock.patch.multiple(os, unlink=_unlink, rmdir=_rmdir)
+
+
+class RemoveTreeTest(TempDirTestCase):
+    def _make_tree(self, top):
+        for sub in ['a/b/c', 'a/d', 'e']:
+            os.makedirs(os.path.join(top, sub))
+            for i in range(3):
+                with open(os.path.join(top, sub, str(i)), 'w') as f:
+                    f.write(str(i))
+        os.symlink('missing', os.path.join(top, 'a', 'link'))
+
+    def test_read_only_subtrees(self):
+        top = os.path.join(self.tmp_dir, 'top')
+        self._make_tree(top)
+        for sub in ['a/b/c', 'a/b', 'e']:
+            os.chmod(os.path.join(top, sub), 0o500)
+        with _deny_writes_to_read_only_dirs():
+            with self.assertRaises(PermissionError):
+                os.unlink(os.path.join(top, 'e', '0'))
+            do_backup._remove_tree(top, 2)
+        self.assertFalse(os.path.lexists(top))
+
+    def test_entries_vanishing_mid_walk(self):
+        top = os.path.join(self.tmp_dir, 'top')
+        self._make_tree(top)
+        real_list_dir_entries = do_backup._list_dir_entries
+
+        def _list_then_remove(path):
+            # Another process removes entries already listed.
+            entries = real_list_dir_entries(path)
+            if path == os.path.join(top, 'a'):
+                os.unlink(os.path.join(path, 'link'))
+                shutil.rmtree(os.path.join(path, 'b'))
+            return entries
+        with mock.patch.object(do_backup, '_list_dir_entries',
+                               side_effect=_list_then_remove):
+            do_backup._remove_tree(top, 1)
+        self.assertFalse(os.path.lexists(top))
+
+    def test_resumed_trash_dir(self):
+        # Left by a run which stopped in the middle of emptying it.
+        trash_dir = os.path.join(self.tmp_dir, 'trash')
+        self._make_tree(os.path.join(trash_dir, 'vm-20261014'))
+        shutil.rmtree(os.path.join(trash_dir, 'vm-20261014', 'a', 'd'))
+        os.chmod(os.path.join(trash_dir, 'vm-20261014', 'a', 'b'), 0o500)
+        with open(os.path.join(trash_dir, 'stray'), 'w') as f:
+            f.write('stray')
+        backup_dir = os.path.join(self.tmp_dir, 'vm-20261014')
+        self._make_tree(backup_dir)
+        self.assertEqual(os.path.join(trash_dir, 'vm-20261014.1'),
+                         do_backup._move_to_trash(backup_dir, trash_dir))
+        with _deny_writes_to_read_only_dirs():
+            pruner = do_backup.TrashPruner(trash_dir, 2).start()
+            self.assertTrue(pruner.join())
+        self.assertFalse(os.path.lexists(trash_dir))
+
+    def test_trash_pruner_failure(self):
+        trash_dir = os.path.join(self.tmp_dir, 'trash')
+        self._make_tree(os.path.join(trash_dir, 'vm-20261014'))
+        with mock.patch.object(do_backup, '_remove_tree',
+                               side_effect=OSError(errno.EIO, 'EIO')):
+            pruner = do_backup.TrashPruner(trash_dir, 1).start()
+            self.assertFalse(pruner.join())
+        self.assertTrue(os.path.isdir(trash_dir))
+
+
+class SelectBackupsToKeepTest(unittest.TestCase):
+    # (today, keep_* options, backups as "YYYY-mm-dd HH:MM", kept ones)
+    cases = [
+        # The newest one only
+        ('2026-10-16 12:30', {},
+         ['2026-10-15 00:00', '2026-10-14 00:00'],
+         ['2026-10-15 00:00']),
+        ('2026-10-16 12:30', {'keep_daily': 3}, [], []),
+        # A backup exactly keep_hourly hours old is out.
+        ('2026-10-16 12:30', {'keep_hourly': 2},
+         ['2026-10-16 12:00', '2026-10-16 10:31', '2026-10-16 10:30',
+          '2026-10-16 09:00'],
+         ['2026-10-16 12:00', '2026-10-16 10:31']),
+        # The newest of each day, from midnight to midnight
+        ('2026-10-16 12:30', {'keep_daily': 3},
+         ['2026-10-16 08:00', '2026-10-16 01:00', '2026-10-15 23:00',
+          '2026-10-14 00:00', '2026-10-13 23:59'],
+         ['2026-10-16 08:00', '2026-10-15 23:00', '2026-10-14 00:00']),
+        # Days without a backup are not made up for with older ones.
+        ('2026-10-16 12:30', {'keep_daily': 3},
+         ['2026-10-16 08:00', '2026-10-10 08:00', '2026-10-09 08:00'],
+         ['2026-10-16 08:00']),
+        # ISO weeks start on Monday.
+        ('2026-10-16 12:30', {'keep_weekly': 2},
+         ['2026-10-16 08:00', '2026-10-12 00:00', '2026-10-11 23:00',
+          '2026-10-05 08:00', '2026-10-04 08:00'],
+         ['2026-10-16 08:00', '2026-10-11 23:00']),
+        # 2026-W53 spans the new year.
+        ('2027-01-02 12:30', {'keep_weekly': 2},
+         ['2027-01-01 08:00', '2026-12-28 08:00', '2026-12-27 08:00',
+          '2026-12-20 08:00'],
+         ['2027-01-01 08:00', '2026-12-27 08:00']),
+        ('2026-10-16 12:30', {'keep_monthly': 3},
+         ['2026-10-01 08:00', '2026-09-30 08:00', '2026-09-01 08:00',
+          '2026-08-15 08:00', '2026-07-31 08:00'],
+         ['2026-10-01 08:00', '2026-09-30 08:00', '2026-08-15 08:00']),
+        # A month back from the 31st is still February.
+        ('2026-03-31 12:30', {'keep_monthly': 2},
+         ['2026-03-01 08:00', '2026-02-28 08:00', '2026-01-31 08:00'],
+         ['2026-03-01 08:00', '2026-02-28 08:00']),
+        # The newest backup counts for every tier at once, which does not
+        # make any tier reach further back.
+        ('2026-10-16 12:30',
+         {'keep_daily': 2, 'keep_weekly': 2, 'keep_monthly': 2},
+         ['2026-10-16 08:00', '2026-10-15 08:00', '2026-10-14 08:00',
+          '2026-10-12 08:00', '2026-10-10 08:00', '2026-10-01 08:00',
+          '2026-09-28 08:00', '2026-09-20 08:00'],
+         ['2026-10-16 08:00', '2026-10-15 08:00', '2026-10-10 08:00',
+          '2026-09-28 08:00']),
+        # Hourly backups overlapping the daily tier
+        ('2026-10-16 12:30', {'keep_hourly': 1, 'keep_daily': 2},
+         ['2026-10-16 12:20', '2026-10-16 12:00', '2026-10-16 11:00',
+          '2026-10-15 10:00', '2026-10-15 09:00'],
+         ['2026-10-16 12:20', '2026-10-16 12:00', '2026-10-15 10:00']),
+    ]
+
+    def test_tiers(self):
+        fmt = '%Y-%m-%d %H:%M'
+        for today, options, backups, expected in self.cases:
+            with self.subTest(today=today, options=options):
+                catalog = do_backup.SnapshotCatalog(
+                    '/backup', '{hostname}-%Y%m%d%H%M',
+                    [do_backup.Snapshot(x, '/backup/' + x,
+                                        datetime.strptime(x, fmt))
+                     for x in backups])
+                self.assertEqual(set(expected),
+                                 do_backup._select_backups_to_keep(
+                                     datetime.strptime(today, fmt),
+                                     catalog, **options))
+
+
+class PruneForSpaceTest(TempDirTestCase):
+    def test_stops_at_min_backups(self):
+        catalog = _make_backups(self.tmp_dir, 10)
+        trash_dir = os.path.join(self.tmp_dir, '.trash')
+        with mock.patch.object(do_backup, '_get_free_space',
+                               return_value=0):
+            num_removed, enough = do_backup._prune_for_space(
+                self.tmp_dir, catalog, 1, trash_dir, 1, 3)
+        self.assertEqual((7, False), (num_removed, enough))
+        self.assertEqual(3, len(catalog))
+
+    def test_archives_go_first(self):
+        catalog = _make_backups(self.tmp_dir, 3)
+        archive_dir = os.path.join(self.tmp_dir, '.archive')
+        os.mkdir(archive_dir)
+        archived = []
+        for snapshot in list(catalog)[1:]:
+            for path in do_backup._get_archive_paths(archive_dir,
+                                                     snapshot.name):
+                open(path, 'w').close()
+            archived.append(do_backup.Snapshot(
+                snapshot.name, do_backup._get_archive_paths(
+                    archive_dir, snapshot.name)[0], snapshot.timestamp))
+        free = iter([0, 0, 0, 1])
+        with mock.patch.object(do_backup, '_get_free_space',
+                               side_effect=lambda _: next(free)):
+            num_removed, enough = do_backup._prune_for_space(
+                self.tmp_dir, catalog, 1, '/nonexistent', 1, 1,
+                archived=archived)
+        self.assertEqual((2, True), (num_removed, enough))
+        self.assertEqual([], os.listdir(archive_dir))
+        self.assertEqual(3, len(catalog))
+
+
+class DedupTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.catalog = _make_backups(self.tmp_dir, 2)
+        self.old, self.new = [s.path for s in reversed(list(self.catalog))]
+        self._write(self.old, 'a', b'x' * 100)
+        self._write(self.new, 'renamed_a', b'x' * 100)
+        # Same size, different content
+        self._write(self.old, 'b', b'y' * 50)
+        self._write(self.new, 'c', b'z' * 50)
+        # A size nothing else has
+        self._write(self.new, 'd', b'd' * 70)
+
+    def _write(self, dir_path, name, data):
+        path = os.path.join(dir_path, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, ns=(1000000000, 1000000000))
+        return path
+
+    def _dedup(self, jobs=1):
+        hashed = []
+
+        def _hash_files(paths, jobs):
+            hashed.extend(os.path.relpath(x, self.tmp_dir) for x in paths)
+            return original(paths, jobs)
+        original = do_backup._hash_files
+        with mock.patch.object(do_backup, '_hash_files', _hash_files):
+            result = do_backup._dedup_snapshots(
+                self.tmp_dir, list(self.catalog), jobs, 1)
+        return result, sorted(os.path.basename(x) for x in hashed)
+
+    def _is_linked(self, name1, name2):
+        return os.path.samefile(os.path.join(self.old, name1),
+                                os.path.join(self.new, name2))
+
+    def test_links_identical_files_only(self):
+        # Two processes, so that the spawned pool hashes them.
+        (num_files, num_bytes), hashed = self._dedup(jobs=2)
+        self.assertEqual((1, 100), (num_files, num_bytes))
+        self.assertTrue(self._is_linked('a', 'renamed_a'))
+        self.assertFalse(self._is_linked('b', 'c'))
+        # "d" has no other file of its size.
+        self.assertEqual(['a', 'b', 'c', 'renamed_a'], hashed)
+
+    def test_index_hashes_only_new_inodes(self):
+        self._dedup()
+        (num_files, _), hashed = self._dedup()
+        self.assertEqual((0, []), (num_files, hashed))
+        newest = do_backup.Snapshot(
+            'newest', os.path.join(self.tmp_dir, 'newest'), datetime.today())
+        os.mkdir(newest.path)
+        self._write(newest.path, 'a_again', b'x' * 100)
+        self.catalog.add(newest)
+        with mock.patch.object(do_backup, '_walk_files',
+                               wraps=do_backup._walk_files) as walk_files:
+            (num_files, _), hashed = self._dedup()
+        self.assertEqual([mock.call(newest.path)], walk_files.call_args_list)
+        self.assertEqual(['a_again'], hashed)
+        self.assertEqual(1, num_files)
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.old, 'a'),
+            os.path.join(newest.path, 'a_again')))
+
+    def test_different_xattrs_are_not_linked(self):
+        path = os.path.join(self.new, 'renamed_a')
+        try:
+            os.setxattr(path, 'user.note', b'only here')
+        except (AttributeError, OSError) as e:
+            self.skipTest('No user xattrs ({})'.format(e))
+        os.utime(path, ns=(1000000000, 1000000000))
+        (num_files, _), _ = self._dedup()
+        self.assertEqual(0, num_files)
+        self.assertFalse(self._is_linked('a', 'renamed_a'))
+        self.assertEqual([b'only here'], [os.getxattr(path, 'user.note')])
+
+
+class ArchiveTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.catalog = _make_backups(self.tmp_dir, 5)
+        for snapshot in self.catalog:
+            with open(os.path.join(snapshot.path, 'file'), 'w') as f:
+                f.write(snapshot.name)
+        self.archive_dir = os.path.join(self.tmp_dir,
+                                        do_backup._ARCHIVE_DIR_NAME)
+
+    def _archive(self):
+        return do_backup._archive_old_backups(
+            datetime.today(), self.catalog, 2, self.archive_dir, 2, 1,
+            False)
+
+    def test_failure_leaves_backups(self):
+        error = OSError(28, 'No space left on device')
+        with mock.patch.object(do_backup.ChunkedGzipWriter, 'write',
+                               side_effect=error):
+            self.assertEqual(0, self._archive())
+        self.assertEqual([], os.listdir(self.archive_dir))
+        self.assertEqual(5, len(self.catalog))
+
+    def test_retention_removes_archives(self):
+        self.assertEqual(3, self._archive())
+        self.assertEqual(3, len(do_backup._find_archived_snapshots(
+            self.archive_dir, do_backup._DEFAULT_DIR_FORMAT)))
+        args = do_backup._parse_args(['--prune-only', '-r', '3',
+                                      '-b', self.tmp_dir])
+        self.assertTrue(do_backup._main_inter(args, do_backup._null_logger))
+        archived = do_backup._find_archived_snapshots(
+            self.archive_dir, do_backup._DEFAULT_DIR_FORMAT)
+        self.assertEqual(1, len(archived))
+        self.assertEqual(2, len(os.listdir(self.archive_dir)))
+
+
+class ReflinkTest(TempDirTestCase):
+    """\
+    Runs on any filesystem with _clone_file() emulated by a copy.
+    Set DO_BACKUP_TEST_REFLINK_DIR to a directory on btrfs or XFS (e.g.
+    a loopback mount, see README.md) to clone for real there.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.reflink_dir = os.environ.get('DO_BACKUP_TEST_REFLINK_DIR')
+        if self.reflink_dir:
+            self.work_dir = tempfile.mkdtemp(prefix='test_do_backup.',
+                                             dir=self.reflink_dir)
+        else:
+            self.work_dir = self.tmp_dir
+        self.block = do_backup._REFLINK_BLOCK_SIZE
+        self.old_path = os.path.join(self.work_dir, 'old')
+        self.new_path = os.path.join(self.work_dir, 'new')
+        with open(self.old_path, 'wb') as f:
+            f.write(os.urandom(self.block * 4 + 100))
+        with open(self.old_path, 'rb') as f:
+            data = bytearray(f.read())
+        data[self.block * 2 + 1] ^= 0xff
+        with open(self.new_path, 'wb') as f:
+            f.write(bytes(data))
+
+    def tearDown(self):
+        if self.work_dir != self.tmp_dir:
+            shutil.rmtree(self.work_dir)
+        super().tearDown()
+
+    def _clone(self):
+        if self.reflink_dir:
+            return mock.patch.object(do_backup, '_clone_file',
+                                     do_backup._clone_file)
+        return mock.patch.object(do_backup, '_clone_file', shutil.copyfile)
+
+    def test_probe(self):
+        supported = do_backup._probe_reflink(self.work_dir)
+        self.assertEqual(['new', 'old'], sorted(os.listdir(self.work_dir)))
+        if self.reflink_dir:
+            self.assertTrue(supported)
+
+    def test_rewrite_changed_blocks(self):
+        dest_path = os.path.join(self.work_dir, 'dest')
+        with self._clone():
+            do_backup._clone_file(self.old_path, dest_path)
+        written = do_backup._rewrite_changed_blocks(self.new_path, dest_path)
+        self.assertEqual(self.block, written)
+        with open(self.new_path, 'rb') as f1, open(dest_path, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_rewrite_truncates(self):
+        with open(self.new_path, 'wb') as f:
+            f.write(b'short')
+        dest_path = os.path.join(self.work_dir, 'dest')
+        shutil.copyfile(self.old_path, dest_path)
+        do_backup._rewrite_changed_blocks(self.new_path, dest_path)
+        with open(dest_path, 'rb') as f:
+            self.assertEqual(b'short', f.read())
+
+    def _copy_paths(self, reflink):
+        src_dir = os.path.join(self.work_dir, 'src')
+        prev_dir = os.path.join(self.work_dir, 'prev')
+        dest_dir = os.path.join(self.work_dir, 'dest')
+        for path in [src_dir, prev_dir, dest_dir]:
+            os.mkdir(path)
+        os.rename(self.new_path, os.path.join(src_dir, 'image'))
+        os.rename(self.old_path, os.path.join(prev_dir, 'image'))
+        backup = do_backup.NativeBackup(dest_dir, [prev_dir], None, 2,
+                                        reflink=reflink)
+        self.assertEqual(0, backup.copy_paths(src_dir, ['image']))
+        with open(os.path.join(src_dir, 'image'), 'rb') as f1, \
+                open(os.path.join(dest_dir, 'image'), 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        return backup
+
+    def test_copy_paths_clones_previous(self):
+        with self._clone():
+            backup = self._copy_paths(True)
+        self.assertEqual(1, backup.num_reflinked)
+        self.assertEqual(self.block, backup.rewritten_size)
+
+    def test_copy_paths_falls_back(self):
+        error = OSError(95, 'Operation not supported')
+        with mock.patch.object(do_backup, '_clone_file', side_effect=error):
+            backup = self._copy_paths(True)
+        self.assertEqual(0, backup.num_reflinked)
+
+
+class NativeBackupTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.dest_dir = os.path.join(self.tmp_dir, 'dest')
+        os.makedirs(os.path.join(self.src_dir, 'a', 'b'))
+        for i in range(20):
+            with open(os.path.join(self.src_dir, 'a', str(i)), 'w') as f:
+                f.write(str(i))
+        with open(os.path.join(self.src_dir, 'a', 'b', 'f'), 'w') as f:
+            f.write('f')
+        os.link(os.path.join(self.src_dir, 'a', 'b', 'f'),
+                os.path.join(self.src_dir, 'g'))
+        for path in ['a/b', 'a']:
+            os.utime(os.path.join(self.src_dir, path), (0, 1000000000))
+
+    def test_bounded_queue(self):
+        backup = do_backup.NativeBackup(self.dest_dir, [],
+                                        do_backup.RsyncFilter([]), 2)
+        with mock.patch.object(do_backup, '_NATIVE_PENDING_PER_JOB', 1):
+            self.assertEqual(0, backup.run([self.src_dir + '/']))
+        for path in ['a/b', 'a']:
+            self.assertEqual(1000000000, os.stat(os.path.join(
+                self.dest_dir, path)).st_mtime)
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.dest_dir, 'a', 'b', 'f'),
+            os.path.join(self.dest_dir, 'g')))
+        self.assertEqual(0, len(backup._deferred))
+        for _, _, file_names in os.walk(self.dest_dir):
+            self.assertEqual([], [x for x in file_names
+                                  if x.endswith('.tmp')])
+
+    def test_existing_inode_is_kept(self):
+        os.mkdir(self.dest_dir)
+        other_path = os.path.join(self.tmp_dir, 'other')
+        with open(other_path, 'w') as f:
+            f.write('other')
+        os.link(other_path, os.path.join(self.dest_dir, 'g'))
+        backup = do_backup.NativeBackup(self.dest_dir, [], None, 1)
+        self.assertEqual(0, backup.copy_paths(self.src_dir, ['g']))
+        with open(other_path) as f:
+            self.assertEqual('other', f.read())
+        with open(os.path.join(self.dest_dir, 'g')) as f:
+            self.assertEqual('f', f.read())
+
+
+    def test_missing_src_is_partial_transfer(self):
+        backup = do_backup.NativeBackup(self.dest_dir, [],
+                                        do_backup.RsyncFilter([]), 1)
+        missing = os.path.join(self.tmp_dir, 'missing')
+        self.assertEqual(23, backup.run([missing, self.src_dir]))
+        self.assertEqual(1, backup.num_errors)
+        with open(os.path.join(self.dest_dir, 'src', 'g')) as f:
+            self.assertEqual('f', f.read())
+        self.assertFalse(os.path.exists(os.path.join(self.dest_dir,
+                                                     'missing')))
+
+
+class RsyncFilterTest(TempDirTestCase):
+    """\
+    Expected results are the ones of rsync 3.2 with the same rules.
+    """
+
+    def assertExcluded(self, rules, path, is_dir=False):
+        self.assertTrue(do_backup.RsyncFilter(rules).is_excluded(path,
+                                                                 is_dir))
+
+    def assertIncluded(self, rules, path, is_dir=False):
+        self.assertFalse(do_backup.RsyncFilter(rules).is_excluded(path,
+                                                                  is_dir))
+
+    def test_name_matches_at_any_depth(self):
+        rules = [(False, 'foo')]
+        self.assertExcluded(rules, '/foo')
+        self.assertExcluded(rules, '/a/b/foo', is_dir=True)
+        self.assertIncluded(rules, '/foobar')
+        self.assertIncluded(rules, '/foo/bar')
+
+    def test_anchored(self):
+        rules = [(False, '/foo')]
+        self.assertExcluded(rules, '/foo')
+        self.assertIncluded(rules, '/a/foo')
+
+    def test_dir_only(self):
+        rules = [(False, 'cache/')]
+        self.assertExcluded(rules, '/a/cache', is_dir=True)
+        self.assertIncluded(rules, '/a/cache')
+
+    def test_pattern_with_slash_matches_trailing_path(self):
+        rules = [(False, 'a/b')]
+        self.assertExcluded(rules, '/a/b')
+        self.assertExcluded(rules, '/x/a/b')
+        self.assertIncluded(rules, '/xa/b')
+        self.assertIncluded(rules, '/a/b/c')
+
+    def test_wildcards(self):
+        self.assertExcluded([(False, '*.log')], '/var/x.log')
+        self.assertExcluded([(False, 'a/*')], '/a/x')
+        # "*" stops at "/" while "**" does not.
+        self.assertIncluded([(False, '/a/*')], '/a/x/y')
+        self.assertExcluded([(False, '/a/**')], '/a/x/y')
+        self.assertExcluded([(False, '**/tmp')], '/x/y/tmp')
+        self.assertExcluded([(False, 'file?')], '/file1')
+        self.assertIncluded([(False, 'file?')], '/file12')
+        self.assertExcluded([(False, 'file[0-9]')], '/file1')
+        self.assertIncluded([(False, 'file[!0-9]')], '/file1')
+
+    def test_first_match_wins(self):
+        rules = [(True, 'keep.log'), (False, '*.log')]
+        self.assertIncluded(rules, '/a/keep.log')
+        self.assertExcluded(rules, '/a/other.log')
+        rules.reverse()
+        self.assertExcluded(rules, '/a/keep.log')
+        self.assertIncluded(rules, '/a/keep.txt')
+
+    def test_exclude_from(self):
+        path = os.path.join(self.tmp_dir, 'exclude')
+        with open(path, 'w') as f:
+            f.write('# comment\n\n+ /keep/\n- /k*\n/tmp\n')
+        rsync_filter = do_backup.RsyncFilter.from_lists([], ['*.bak'],
+                                                        path)
+        self.assertTrue(rsync_filter.is_excluded('/x.bak', False))
+        self.assertFalse(rsync_filter.is_excluded('/keep', True))
+        self.assertTrue(rsync_filter.is_excluded('/kept', True))
+        self.assertTrue(rsync_filter.is_excluded('/tmp', True))
+        self.assertFalse(rsync_filter.is_excluded('/x/tmp', True))
+
+
+class ChangeManifestTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.base_dir = os.path.join(self.tmp_dir, 'base')
+        os.makedirs(os.path.join(self.src_dir, 'sub'))
+        for name, data in [('a', 'aaa'), ('sub/b', 'bb')]:
+            with open(os.path.join(self.src_dir, name), 'w') as f:
+                f.write(data)
+
+    def _run(self):
+        args = do_backup._parse_args(['--engine', 'native',
+                                      '--change-manifest',
+                                      '-b', self.base_dir,
+                                      self.src_dir + '/'])
+        return do_backup._main_inter(args, do_backup._null_logger)
+
+    def _get_leftovers(self):
+        return [x for x in os.listdir(self.base_dir) if x.endswith('.tmp')]
+
+    def test_manifest_of_first_backup(self):
+        self.assertTrue(self._run())
+        catalog = do_backup._build_snapshot_catalog(
+            self.base_dir, do_backup._DEFAULT_DIR_FORMAT)
+        snapshot = list(catalog)[0]
+        summary = do_backup._read_change_summary(snapshot.path)
+        self.assertEqual(snapshot.name, summary['backup'])
+        self.assertEqual(2, summary['counts']['new'])
+        self.assertEqual(5, summary['bytes']['new'])
+        self.assertEqual(0, summary['counts']['changed'])
+        self.assertEqual([], self._get_leftovers())
+
+    def test_no_manifest_nor_records_on_exception(self):
+        with mock.patch.object(do_backup, '_do_transfer',
+                               side_effect=RuntimeError('crash')):
+            self.assertRaises(RuntimeError, self._run)
+        self.assertEqual([], self._get_leftovers())
+        self.assertEqual([], [x for x in os.listdir(self.base_dir)
+                              if x.endswith(
+                                  do_backup._CHANGE_MANIFEST_SUFFIX)])
+
+
+class ReportCacheTest(TempDirTestCase):
+    def test_updated_snapshot_is_rescanned(self):
+        snapshot = list(_make_backups(self.tmp_dir, 1))[0]
+        inodes = do_backup._load_snapshot_inodes(snapshot, 1)
+        with mock.patch.object(do_backup, '_scan_inodes') as scan_inodes:
+            self.assertEqual(inodes,
+                             do_backup._load_snapshot_inodes(snapshot, 1))
+            self.assertFalse(scan_inodes.called)
+        # Same inode, but updated in place as by a re-run in the period.
+        # The sleep lets the ctime of the directory move on.
+        time.sleep(0.05)
+        with open(os.path.join(snapshot.path, 'new'), 'w') as f:
+            f.write('new')
+        inodes = do_backup._load_snapshot_inodes(snapshot, 1)
+        self.assertEqual(2, len(inodes))
+
+
+class RestoreBeforeTest(TempDirTestCase):
+    def _parse(self, value):
+        return do_backup._parse_args(['--restore', 'etc/hosts',
+                                      '--restore-to', self.tmp_dir,
+                                      '--restore-before', value,
+                                      '-b', self.tmp_dir]).restore_before
+
+    def test_offset_is_converted_to_local_time(self):
+        catalog = _make_backups(self.tmp_dir, 3)
+        snapshots = list(catalog)
+        newest = snapshots[0].timestamp
+        # The newest backup's time, written with the UTC offset
+        before = self._parse(newest.astimezone(timezone.utc).isoformat())
+        self.assertIsNone(before.tzinfo)
+        self.assertEqual(newest, before)
+        versions = [do_backup.FileVersion(snapshot, None, 0, 0, 'file',
+                                          False) for snapshot in snapshots]
+        version = do_backup._select_version(versions, before=before)
+        self.assertEqual(snapshots[1].name, version.snapshot.name)
+
+    def test_naive_is_kept(self):
+        self.assertEqual(datetime(2026, 10, 13, 9, 0),
+                         self._parse('2026-10-13 09:00'))
+
+
+class AdaptiveThrottleTest(unittest.TestCase):
+    """\
+    Drives AdaptiveThrottle.update() with faked /proc readers. Every
+    update sees 100 I/Os and the given latency and rates over the last
+    interval.
+    """
+
+    def setUp(self):
+        self.read_net_received = do_backup._read_net_received
+        self.diskstats = (0, 0, 0)
+        self.received = 0
+        self.load = 0.1
+        for name, func in (('_read_diskstats', lambda d: self.diskstats),
+                           ('_read_net_received', lambda: self.received),
+                           ('_read_load_per_cpu', lambda: self.load)):
+            patcher = mock.patch.object(do_backup, name, side_effect=func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _make_throttle(self, **kwargs):
+        with mock.patch.object(do_backup, '_get_block_device_name',
+                               return_value='vda'):
+            throttle = do_backup.AdaptiveThrottle('/backup', 50, 2.0, 100,
+                                                  **kwargs)
+        throttle._last_diskstats = self.diskstats
+        throttle._last_received = self.received
+        return throttle
+
+    def _update(self, throttle, latency_ms=1, written_kbps=0,
+                received_kbps=0):
+        ios, msec, sectors = self.diskstats
+        self.diskstats = (ios + 100, msec + 100 * latency_ms,
+                          sectors + written_kbps * 2
+                          * do_backup._THROTTLE_INTERVAL)
+        self.received += received_kbps * 1024 * do_backup._THROTTLE_INTERVAL
+        throttle.update()
+        return throttle.kbps
+
+    def test_decrease_starts_from_written_rate(self):
+        throttle = self._make_throttle()
+        self.assertEqual(self._update(throttle, latency_ms=80,
+                                      written_kbps=10000), 7000)
+        self.assertEqual(self._update(throttle, latency_ms=80,
+                                      written_kbps=10000), 4900)
+
+    def test_decrease_on_load(self):
+        throttle = self._make_throttle(max_kbps=1000)
+        self.load = 3.0
+        self.assertEqual(self._update(throttle), 700)
+
+    def test_decrease_is_clamped_at_min(self):
+        throttle = self._make_throttle()
+        self.assertEqual(self._update(throttle, latency_ms=80,
+                                      written_kbps=120), 100)
+        self.assertEqual(self._update(throttle, latency_ms=80), 100)
+
+    def test_increase_is_clamped_at_max(self):
+        throttle = self._make_throttle(max_kbps=1000)
+        self._update(throttle, latency_ms=80)
+        self.assertEqual(throttle.kbps, 700)
+        self.assertEqual(self._update(throttle, written_kbps=700), 840)
+        self.assertEqual(self._update(throttle, written_kbps=840), 1000)
+        self.assertEqual(self._update(throttle, written_kbps=1000), 1000)
+
+    def test_back_to_unlimited(self):
+        throttle = self._make_throttle()
+        self._update(throttle, latency_ms=80, written_kbps=1000)
+        self.assertEqual(throttle.kbps, 700)
+        # Still writing as much as allowed: keep the limit.
+        self.assertEqual(self._update(throttle, written_kbps=700), 840)
+        # Writing far below the limit: it no longer matters.
+        self.assertIsNone(self._update(throttle, written_kbps=100))
+
+    def test_network_congestion(self):
+        throttle = self._make_throttle(max_net_kbps=5000)
+        # Unchanged files are hardly written: the received rate counts.
+        self.assertEqual(self._update(throttle, written_kbps=10,
+                                      received_kbps=10000), 7000)
+        self.assertEqual(self._update(throttle, written_kbps=10,
+                                      received_kbps=7000), 4900)
+        # Below max_net_kbps again, and still receiving as much as
+        # allowed although little is written.
+        self.assertEqual(self._update(throttle, written_kbps=10,
+                                      received_kbps=4900), 5880)
+
+    def test_network_ignored_without_limit(self):
+        throttle = self._make_throttle()
+        self.assertIsNone(self._update(throttle, received_kbps=100000))
+
+    def test_read_net_received(self):
+        data = ('Inter-|   Receive            |  Transmit\n'
+                ' face |bytes    packets errs|bytes    packets\n'
+                '    lo: 9999       10    0    9999       10\n'
+                '  eth0: 1000       10    0    2000       20\n'
+                '  eth1:24         1    0    0        0\n')
+        with mock.patch('builtins.open', mock.mock_open(read_data=data)):
+            self.assertEqual(self.read_net_received(), 1024)
+        with mock.patch('builtins.open', side_effect=OSError):
+            self.assertIsNone(self.read_net_received())
+
+    def test_should_restart(self):
+        throttle = self._make_throttle(max_kbps=1000)
+        self.assertFalse(throttle.should_restart(1000))
+        # Within _THROTTLE_RESTART_RATIO of the running limit.
+        self.assertFalse(throttle.should_restart(900))
+        self.assertTrue(throttle.should_restart(700))
+        # Shared by 2 transfers.
+        self.assertFalse(throttle.should_restart(500, share=2))
+        self.assertTrue(throttle.should_restart(1000, share=2))
+        self.assertTrue(throttle.should_restart(None))
+        throttle.kbps = None
+        self.assertTrue(throttle.should_restart(1000))
+        self.assertFalse(throttle.should_restart(None))
+
+
+class DaemonTest(TempDirTestCase):
+    def _write_table(self, line):
+        path = os.path.join(self.tmp_dir, 'jobs')
+        with open(path, 'w') as f:
+            f.write(line + '\n')
+        return path
+
+    def test_priority_in_job_line_is_rejected(self):
+        for opts in ['--nice 10', '--ionice-class idle']:
+            path = self._write_table('home hourly:01 {} -b {} /home'
+                                     .format(opts, self.tmp_dir))
+            self.assertRaises(do_backup.AppException,
+                              do_backup._load_job_table, path)
+
+    def test_first_run_waits_for_next_slot(self):
+        path = self._write_table('home hourly:00 -b {} /home'
+                                 .format(self.tmp_dir))
+        daemon = do_backup.BackupDaemon(path, do_backup._null_logger)
+        job = daemon.jobs[0]
+        now = datetime(2020, 1, 1, 10, 0)
+        self.assertFalse(daemon._is_due(job, now))
+        self.assertFalse(daemon._is_due(job, now + timedelta(minutes=59)))
+        self.assertTrue(daemon._is_due(job, now + timedelta(hours=1)))
+
+    def test_invalid_argv_is_not_fatal(self):
+        path = self._write_table('home hourly:00 -b {} /home'
+                                 .format(self.tmp_dir))
+        daemon = do_backup.BackupDaemon(path, do_backup._null_logger)
+        # e.g. an option renamed after the table was loaded
+        job = daemon.jobs[0]._replace(argv=['--no-such-option'])
+        slot = datetime(2020, 1, 1, 10, 0)
+        daemon._running[job.name] = None
+        with mock.patch('sys.stderr'):
+            daemon._run_job(job, slot)
+        self.assertNotIn(job.name, daemon._running)
+        self.assertEqual(slot, daemon.state[job.name])
+
+
+if __name__ == '__main__':
+    unittest.main()